@@ -0,0 +1,171 @@
+# coding=utf-8
+import glob
+import json
+import mmap
+import os
+import re
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+
+import numpy as np
+
+
+BLOB_FILE = "articles.bin"
+INDEX_FILE = "index.npy"
+IDS_FILE = "ids.txt"
+MANIFEST_FILE = "manifest.json"
+
+
+def article_id_from_filename(filename):
+    return os.path.basename(filename).split(".")[0][7:]
+
+
+def default_corpus_dir(data_folder, file_pattern="*.txt"):
+    """ The sibling directory of the corpus of `data_folder`, e.g. `articles.txt.corpus` for the "*.txt" files. """
+    pattern_name = re.sub(r"[^A-Za-z0-9._-]+", "-", file_pattern).strip("-.")
+    return "%s.%s.corpus" % (os.path.normpath(data_folder), pattern_name)
+
+
+def folder_manifest(data_folder, file_pattern="*.txt"):
+    """ The pattern and the sorted names, sizes and modification times of the files of the corpus. """
+    files = []
+    for filename in sorted(glob.glob(os.path.join(data_folder, file_pattern))):
+        stat = os.stat(filename)
+        files.append([os.path.basename(filename), stat.st_size, stat.st_mtime_ns])
+    return {"file_pattern": file_pattern, "files": files}
+
+
+def _replace(path, write):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def build_corpus(data_folder, corpus_dir, file_pattern="*.txt"):
+    """ Packs the articles from `data_folder` into `corpus_dir`: a single UTF-8 blob with all the articles,
+        an index with the byte offset, the byte length and the length in characters of every article,
+        and the table of the article ids, one per line, in the order of the sorted filenames.
+    """
+    if not os.path.exists(corpus_dir):
+        os.makedirs(corpus_dir)
+    manifest = folder_manifest(data_folder, file_pattern)
+    file_list = [os.path.join(data_folder, name) for name, _, _ in manifest["files"]]
+    index = np.zeros((len(file_list), 3), dtype=np.int64)
+
+    def write_blob(fout):
+        offset = 0
+        for i, filename in enumerate(file_list):
+            with open(filename, "r", encoding="utf-8") as f:
+                text = f.read()
+            data = text.encode("utf-8")
+            fout.write(data)
+            index[i] = (offset, len(data), len(text))
+            offset += len(data)
+
+    _replace(os.path.join(corpus_dir, BLOB_FILE), write_blob)
+    _replace(os.path.join(corpus_dir, IDS_FILE),
+             lambda f: f.write("".join(article_id_from_filename(name) + "\n" for name in file_list).encode("utf-8")))
+    _replace(os.path.join(corpus_dir, INDEX_FILE), lambda f: np.save(f, index))
+    # the manifest is written last, so a partially written corpus is never taken for an up to date one
+    _replace(os.path.join(corpus_dir, MANIFEST_FILE), lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+
+
+def is_corpus_stale(data_folder, corpus_dir, file_pattern="*.txt"):
+    """ A corpus is stale unless it was packed with the same pattern from files of the same names, sizes and
+        modification times, so replaced files are detected even when they are older than the corpus.
+    """
+    manifest_path = os.path.join(corpus_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return True
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        try:
+            manifest = json.load(f)
+        except ValueError:
+            return True
+    return manifest != folder_manifest(data_folder, file_pattern)
+
+
+class ArticleTexts(Sequence):
+    """ Lazy list of the article texts of an `ArticleCorpus`, in the order of its ids. """
+
+    def __init__(self, corpus):
+        self.corpus = corpus
+
+    def __len__(self):
+        return len(self.corpus)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.corpus.text(j) for j in range(*i.indices(len(self)))]
+        return self.corpus.text(i)
+
+
+class ArticleCorpus(Mapping):
+    """ Read-only mapping from article ids to article texts backed by a packed corpus (see `build_corpus`).
+
+        The blob is memory mapped and an article is decoded only when it is accessed, so opening a corpus
+        does not depend on its size. `slice(article_id, start, end)` returns `article[start:end]` and decodes
+        only the requested bytes when the article is ASCII, where character and byte offsets coincide.
+        Used as a context manager, the corpus is closed on exit.
+    """
+
+    def __init__(self, corpus_dir, cache_size=128):
+        self.corpus_dir = corpus_dir
+        self.index = np.load(os.path.join(corpus_dir, INDEX_FILE))
+        with open(os.path.join(corpus_dir, IDS_FILE), "r", encoding="utf-8") as f:
+            self.ids = f.read().splitlines()
+        self.positions = {article_id: i for i, article_id in enumerate(self.ids)}
+        self._file = open(os.path.join(corpus_dir, BLOB_FILE), "rb")
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._blob = b""
+        self.text = lru_cache(maxsize=cache_size)(self._decode)
+
+    @classmethod
+    def from_folder(cls, data_folder, corpus_dir=None, file_pattern="*.txt", **kwargs):
+        """ Opens the packed corpus of `data_folder`, packing it first if it is missing or out of date. """
+        corpus_dir = corpus_dir if corpus_dir else default_corpus_dir(data_folder, file_pattern)
+        if is_corpus_stale(data_folder, corpus_dir, file_pattern):
+            build_corpus(data_folder, corpus_dir, file_pattern)
+        return cls(corpus_dir, **kwargs)
+
+    def _decode(self, i):
+        offset, n_bytes, _ = self.index[i].tolist()
+        return self._blob[offset: offset + n_bytes].decode("utf-8")
+
+    def __getitem__(self, article_id):
+        return self.text(self.positions[article_id])
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, article_id):
+        return article_id in self.positions
+
+    def texts(self):
+        return ArticleTexts(self)
+
+    def slice(self, article_id, start, end):
+        i = self.positions[article_id]
+        offset, n_bytes, n_chars = self.index[i].tolist()
+        if n_bytes != n_chars:
+            return self.text(i)[start:end]
+        start, end, _ = slice(start, end).indices(n_chars)
+        return self._blob[offset + start: offset + max(start, end)].decode("ascii")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.text.cache_clear()
+        if isinstance(self._blob, mmap.mmap):
+            self._blob.close()
+        self._file.close()
@@ -8,19 +8,14 @@ task_SI_output_file = "baseline-output-SI.txt"
 #
 #
 
-import glob
-import os.path
 import random
+from article_corpus import ArticleCorpus
 
 random.seed(10) # to make runs deterministic
 
 # loading articles' content from *.txt files in the dev folder
-file_list = glob.glob(os.path.join(dev_folder, "*.txt"))
-articles_content, articles_id = ([], [])
-for filename in file_list:
-    with open(filename, "r", encoding="utf-8") as f:
-        articles_content.append(f.read())
-        articles_id.append(os.path.basename(filename).split(".")[0][7:])
+corpus = ArticleCorpus.from_folder(dev_folder)
+articles_content, articles_id = corpus.texts(), corpus.ids
 
 with open(propaganda_techniques_file, "r") as f:
     propaganda_techniques_names = [ line.rstrip() for line in f.readlines() ]
@@ -14,28 +14,19 @@ task_TC_output_file = "baseline-output-TC.txt"
 
 
 from sklearn.linear_model import LogisticRegression
-import glob
-import os.path
 import numpy as np
 import sys
-import codecs
+from article_corpus import ArticleCorpus
 
 def read_articles_from_file_list(folder_name, file_pattern="*.txt"):
     """
     Read articles from files matching patterns <file_pattern> from  
     the directory <folder_name>. 
-    The content of the article is saved in the dictionary whose key
-    is the id of the article (extracted from the file name).
-    Each element of <sentence_list> is one line of the article.
+    The articles are packed once into the <folder_name>.<pattern>.corpus directory
+    and returned as a read-only mapping whose key is the id of the article
+    (extracted from the file name); the content is read lazily on access.
     """
-    file_list = glob.glob(os.path.join(folder_name, file_pattern))
-    articles = {}
-    article_id_list, sentence_id_list, sentence_list = ([], [], [])
-    for filename in sorted(file_list):
-        article_id = os.path.basename(filename).split(".")[0][7:]
-        with codecs.open(filename, "r", encoding="utf8") as f:
-            articles[article_id] = f.read()
-    return articles
+    return ArticleCorpus.from_folder(folder_name, file_pattern=file_pattern)
 
 
 def read_predictions_from_file(filename):
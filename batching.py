@@ -0,0 +1,64 @@
+# coding=utf-8
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """ Yields batches of indices of sequences with similar `lengths`, so that `trim_collate` cuts most of the padding.
+
+        With `shuffle`, the indices are shuffled, split into chunks of `bucket_size` batches, sorted by length within
+        each chunk, and the batches are yielded in random order. Otherwise all the indices are sorted by length
+        (stable, so the batches are deterministic) and `order` gives the dataset index of every yielded item.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.order = np.argsort(self.lengths, kind="stable")
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths)).numpy()
+            chunk_size = self.batch_size * self.bucket_size
+            batches = []
+            for chunk_start in range(0, len(indices), chunk_size):
+                chunk = indices[chunk_start: chunk_start + chunk_size]
+                chunk = chunk[np.argsort(self.lengths[chunk], kind="stable")]
+                batches.extend(chunk[i: i + self.batch_size] for i in range(0, len(chunk), self.batch_size))
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        else:
+            batches = [self.order[i: i + self.batch_size] for i in range(0, len(self.order), self.batch_size)]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def restore_order(items, order):
+    """ Puts back in the dataset order the `items` predicted for the indices `order` of a `BucketBatchSampler`:
+        the rows of an array, or the elements of a list (rows of different lengths).
+    """
+    if isinstance(items, np.ndarray):
+        restored = np.empty_like(items)
+        restored[order] = items
+        return restored
+    restored = [None] * len(items)
+    for position, index in enumerate(order.tolist()):
+        restored[index] = items[position]
+    return restored
+
+
+def trim_collate(batch, sequence_fields, mask_field=1, pad_on_left=False):
+    """ Stacks the tensors of `batch` and cuts the `sequence_fields` to the longest sequence of the batch according
+        to the attention mask in `mask_field` (the padding is on the left for xlnet). The cut fields are made
+        contiguous, as the models `view` them.
+    """
+    fields = [torch.stack(field) for field in zip(*batch)]
+    max_length = max(int((fields[mask_field] != 0).sum(dim=1).max()), 1)
+    for i in sequence_fields:
+        fields[i] = (fields[i][:, -max_length:] if pad_on_left else fields[i][:, :max_length]).contiguous()
+    return fields
@@ -0,0 +1,3 @@
+from .predictors import SpanPredictor, TechniquePredictor, ArticlePredictor, load_predictor
+from .server import MicroBatcher, InferenceServer, run_server
+from .pipeline import iter_predictions, write_predictions, run_pipeline
@@ -0,0 +1,104 @@
+try:
+    from .predictors import load_predictor
+    from .pipeline import run_pipeline
+    from .server import run_server
+except:
+    from predictors import load_predictor
+    from pipeline import run_pipeline
+    from server import run_server
+
+import configargparse
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+def Main(args):
+    predictor = load_predictor(args)
+    if args.test_data_folder:
+        if not os.path.exists('results'):
+            os.makedirs('results')
+        output_file = os.path.join('results', args.output_file)
+        spans_output_file = os.path.join('results', args.spans_output_file) if args.spans_output_file else None
+        logger.info("Labeling the articles of %s into %s", args.test_data_folder, output_file)
+        run_pipeline(predictor, args.test_data_folder, output_file, spans_output_file, args.chunk_size)
+    else:
+        run_server(predictor, args.host, args.port, args.unix_socket, args.max_batch_size, args.max_wait_ms,
+                   args.num_workers)
+
+
+def main():
+    parser = configargparse.ArgumentParser()
+
+    parser.add_argument('--config', required=False, is_config_file=True, help='Config file path.')
+
+    parser.add_argument("--si_model_dir", default=None, type=str, required=True,
+                        help="The output directory of the trained SI model (CRF).")
+    parser.add_argument("--si_model_type", default="roberta", type=str, help="Model type of the SI model.")
+    parser.add_argument("--si_config_name", default="", type=str,
+                        help="Pretrained config name or path of the SI model if not the same as si_model_dir.")
+    parser.add_argument("--si_max_seq_length", default=256, type=int,
+                        help="The maximum total input sequence length of the SI model.")
+    parser.add_argument("--si_do_lower_case", action="store_true", help="The SI model is uncased.")
+    parser.add_argument("--si_rnn_layers", default=0, type=int,
+                        help="The number of BiLSTM layers of the SI model (--rnn_layers of SI).")
+    parser.add_argument("--si_exported_model", default=None, type=str,
+                        help="Use this TorchScript export of the SI model (see --export_model of SI) on the CPU.")
+    parser.add_argument("--spacy_model", default="en_core_web_sm", type=str,
+                        help="The spaCy model which splits the articles into words, as in the SI datasets.")
+    parser.add_argument("--window_stride", default=0, type=int,
+                        help="If > 0, sentences longer than si_max_seq_length are split into overlapping windows.")
+    parser.add_argument("--window_overlap_rule", default="center", type=str, choices=["first", "last", "center"],
+                        help="Which window predicts the words covered by several windows.")
+
+    parser.add_argument("--tc_model_dir", default=None, type=str,
+                        help="The output directory of the trained TC model. Without it, only spans are predicted.")
+    parser.add_argument("--tc_model_type", default="roberta", type=str, help="Model type of the TC model.")
+    parser.add_argument("--tc_max_seq_length", default=128, type=int,
+                        help="The maximum total input sequence length of the TC model.")
+    parser.add_argument("--tc_do_lower_case", action="store_true", help="The TC model is uncased.")
+    parser.add_argument("--tc_train_file", default=None, type=str,
+                        help="The TC train file (tsv); if given, the techniques are postprocessed as in the "
+                             "submission files.")
+    parser.add_argument("--tc_train_instances_file", default=None, type=str,
+                        help="The train instances of the TC models trained with --use_matchings.")
+
+    parser.add_argument("--batch_size", default=8, type=int,
+                        help="Batch size of the sequences inside the models.")
+    parser.add_argument("--quantize", action="store_true",
+                        help="Run the models on the CPU with the Linear layers dynamically quantized to int8.")
+    parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
+
+    parser.add_argument("--test_data_folder", default=None, type=str,
+                        help="Label the articles of this folder and exit instead of serving the models.")
+    parser.add_argument("--output_file", default="pipeline_output.txt", type=str,
+                        help="The file in the results folder with the labeled spans of test_data_folder, in the TC "
+                             "submission format (in the SI one without the TC model).")
+    parser.add_argument("--spans_output_file", default=None, type=str,
+                        help="If given, the spans are also written to this file of the results folder in the SI "
+                             "submission format.")
+    parser.add_argument("--chunk_size", default=32, type=int,
+                        help="The number of articles of test_data_folder predicted together.")
+    parser.add_argument("--host", default="127.0.0.1", type=str, help="The host of the server.")
+    parser.add_argument("--port", default=8000, type=int, help="The port of the server.")
+    parser.add_argument("--unix_socket", default=None, type=str,
+                        help="Serve on this Unix socket instead of host:port.")
+    parser.add_argument("--max_batch_size", default=8, type=int,
+                        help="The maximum number of articles predicted together.")
+    parser.add_argument("--max_wait_ms", default=10, type=float,
+                        help="How long the first article of a batch waits for other ones, in milliseconds.")
+    parser.add_argument("--num_workers", default=1, type=int,
+                        help="The number of batches predicted at the same time, in worker threads.")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+                        datefmt="%m/%d/%Y %H:%M:%S",
+                        level=logging.INFO)
+
+    Main(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# coding=utf-8
+""" End-to-end labeling of a folder of articles in a single process: the articles are streamed chunk by chunk
+    through an `ArticlePredictor` (words, SI tags, spans, TC features, techniques and their postprocessing are
+    passed in memory) and only the final labels are written.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import time
+
+from article_corpus import ArticleCorpus
+
+logger = logging.getLogger(__name__)
+
+
+def iter_predictions(predictor, articles_id, articles_content, chunk_size=32):
+    """ Yields (article_id, [(start, end, technique), ...]) for every article, predicting `chunk_size` articles at
+        once, so only the texts and the features of a chunk are kept in memory.
+    """
+    for chunk_start in range(0, len(articles_id), chunk_size):
+        chunk_ids = articles_id[chunk_start: chunk_start + chunk_size]
+        chunk_texts = articles_content[chunk_start: chunk_start + chunk_size]
+        for article_id, spans in zip(chunk_ids, predictor.predict(chunk_texts)):
+            yield article_id, spans
+
+
+def write_predictions(predictions, output_file, spans_output_file=None):
+    """ Writes the `predictions` of `iter_predictions` to `output_file` in the TC submission format
+        ("article_id\ttechnique\tstart\tend"), or in the SI one ("article_id\tstart\tend") if the spans have no
+        techniques. `spans_output_file`, if given, gets the spans in the SI format as well.
+        Returns the number of articles and spans.
+    """
+    num_articles, num_spans = 0, 0
+    spans_out = open(spans_output_file, "w") if spans_output_file else None
+    try:
+        with open(output_file, "w") as fout:
+            for article_id, spans in predictions:
+                num_articles += 1
+                for start, end, technique in spans:
+                    num_spans += 1
+                    if technique is None:
+                        fout.write("%s\t%s\t%s\n" % (article_id, start, end))
+                    else:
+                        fout.write("%s\t%s\t%s\t%s\n" % (article_id, technique, start, end))
+                    if spans_out is not None:
+                        spans_out.write("%s\t%s\t%s\n" % (article_id, start, end))
+    finally:
+        if spans_out is not None:
+            spans_out.close()
+    return num_articles, num_spans
+
+
+def run_pipeline(predictor, data_folder, output_file, spans_output_file=None, chunk_size=32):
+    """ Labels all the articles of `data_folder` with `predictor` (see `write_predictions`). """
+    with ArticleCorpus.from_folder(data_folder) as corpus:
+        start = time.time()
+        predictions = iter_predictions(predictor, list(corpus.ids), corpus.texts(), chunk_size)
+        num_articles, num_spans = write_predictions(predictions, output_file, spans_output_file)
+    seconds = time.time() - start
+    logger.info("Labeled %d spans in %d articles in %.1f s (%.2f articles per second)", num_spans, num_articles,
+                seconds, num_articles / seconds if seconds > 0 else float("inf"))
+    return num_articles, num_spans
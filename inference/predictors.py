@@ -0,0 +1,359 @@
+# coding=utf-8
+""" Models of both tasks loaded once and applied to raw article texts, without the intermediate files of the
+    `span_identification` and `technique_classification` command lines.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import os
+import pickle
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import spacy
+import torch
+from torch.utils.data import DataLoader, SequentialSampler, TensorDataset
+from transformers import WEIGHTS_NAME, InputExample
+from transformers import glue_convert_examples_to_features
+
+from batching import BucketBatchSampler, restore_order, trim_collate
+from quantization import load_quantized_model, model_signature
+from span_identification.dataset import BIO_tokens, TokenOffsets
+from span_identification.ner import BertLstmCrf
+from span_identification.ner.export import load_exported_model
+from span_identification.ner.run_ner_crf import MODEL_CLASSES as NER_MODEL_CLASSES
+from span_identification.ner.utils_ner import (InputExample as NerInputExample, convert_examples_to_features,
+                                               features_to_arrays, get_fast_tokenizer, get_labels,
+                                               merge_window_predictions, SEQUENCE_FIELDS as NER_SEQUENCE_FIELDS)
+from span_identification.submission import LABELS_CODES, get_spans_from_labels, merge_spans
+from span_identification.tokenization import TokenOffsetsCache, SPACY_UNUSED_COMPONENTS
+from technique_classification.dataset import dataset_to_pandas
+from technique_classification.submission import (get_insides, get_train_instances, postprocess_predictions,
+                                                 softmax_with_temperature)
+from technique_classification.transformers_classifier.run_glue import MODEL_CLASSES as CLF_MODEL_CLASSES
+from technique_classification.transformers_classifier.run_glue import get_matchings
+from technique_classification.transformers_classifier.utils import PropProcessor
+from technique_classification.transformers_classifier import utils as clf_utils
+
+logger = logging.getLogger(__name__)
+
+# the label of the words that are not the first sub-token of a word, as in the training
+PAD_TOKEN_LABEL_ID = -100
+
+
+def get_device(no_cuda=False):
+    return torch.device("cuda" if torch.cuda.is_available() and not no_cuda else "cpu")
+
+
+class SpanPredictor(object):
+    """ Finds the propaganda spans of article texts with the CRF model of `span_identification` saved in
+        `model_dir` (or with its TorchScript export, see `span_identification.ner.export`). The articles are
+        tokenized with spaCy and their sentences are labeled in batches of `batch_size` sequences of similar
+        lengths, the other parameters are those of the training. The token offsets of the last
+        `offsets_cache_size` articles are kept in memory.
+    """
+
+    def __init__(self, model_dir, model_type="roberta", config_name="", spacy_model="en_core_web_sm",
+                 max_seq_length=256, batch_size=8, window_stride=0, window_overlap_rule="center",
+                 do_lower_case=False, exported_model=None, quantize=False, device=None, offsets_cache_size=1024,
+                 rnn_layers=0):
+        self.model_type = model_type.lower()
+        self.max_seq_length = max_seq_length
+        self.batch_size = batch_size
+        self.window_stride = window_stride
+        self.window_overlap_rule = window_overlap_rule
+        self.labels = get_labels(None)
+        self.device = torch.device("cpu") if quantize or exported_model else (device or get_device())
+
+        config_class, model_class, tokenizer_class = NER_MODEL_CLASSES[self.model_type]
+        self.tokenizer = tokenizer_class.from_pretrained(model_dir, do_lower_case=do_lower_case)
+        self.fast_tokenizer = get_fast_tokenizer(self.tokenizer)
+        self.word_tokenizer = TokenOffsetsCache(spacy.load(spacy_model, disable=SPACY_UNUSED_COMPONENTS),
+                                                max_items=offsets_cache_size)
+
+        self.exported = bool(exported_model)
+        if self.exported:
+            self.model, metadata = load_exported_model(exported_model)
+            if metadata.get("labels", self.labels) != self.labels:
+                raise ValueError("The exported model %s predicts the labels %s instead of %s"
+                                 % (exported_model, metadata["labels"], self.labels))
+        else:
+            config = config_class.from_pretrained(config_name if config_name else model_dir,
+                                                  num_labels=len(self.labels))
+            if not hasattr(config, "hidden_dropout_prob"):
+                config.hidden_dropout_prob = config.dropout
+            weights_file = os.path.join(model_dir, WEIGHTS_NAME)
+
+            def load_model():
+                model = BertLstmCrf(
+                    model_class(config),
+                    num_labels=len(self.labels),
+                    embedding_dim=config.hidden_size,
+                    hidden_dim=int(config.hidden_size / 2),
+                    rnn_layers=rnn_layers,
+                    rnn_dropout=config.hidden_dropout_prob,
+                    output_dropout=config.hidden_dropout_prob,
+                )
+                model.load_state_dict(torch.load(weights_file, map_location="cpu"))
+                return model
+
+            if quantize:
+                self.model = load_quantized_model(load_model, weights_file, model_signature(
+                    BertLstmCrf, config, encoder=model_class.__name__, rnn_layers=rnn_layers))
+            else:
+                self.model = load_model()
+            self.model.to(self.device)
+        self.model.eval()
+
+    @staticmethod
+    def _example(index, words):
+        return NerInputExample(guid="predict-%d" % index, words=words, labels=["O"] * len(words))
+
+    def tokenize(self, texts):
+        """ Splits the `texts` into sentences of words as in the BIO files, returns the examples and the arrays of
+            the offsets of their words (see `span_identification.dataset.TokenOffsets`).
+        """
+        self.word_tokenizer.prefetch(texts)
+        examples, offsets = [], TokenOffsets()
+        for article_index, text in enumerate(texts):
+            words = []
+            for tok, start, end, prev_end in BIO_tokens(text, self.word_tokenizer):
+                if tok is not None and tok != "\n":
+                    words.append(tok)
+                    offsets.append(article_index, start, end, prev_end)
+                elif tok is not None and words:
+                    examples.append(self._example(len(examples), words))
+                    words = []
+            if words:
+                examples.append(self._example(len(examples), words))
+        return examples, offsets.to_arrays([str(i) for i in range(len(texts))])
+
+    def label_words(self, examples):
+        """ Returns the label codes of all the words of the `examples`, in order (0 for the truncated words). """
+        features = convert_examples_to_features(examples, self.labels, self.max_seq_length, self.tokenizer,
+                                                cls_token_at_end=bool(self.model_type in ["xlnet"]),
+                                                cls_token=self.tokenizer.cls_token,
+                                                cls_token_segment_id=2 if self.model_type in ["xlnet"] else 0,
+                                                sep_token=self.tokenizer.sep_token,
+                                                sep_token_extra=bool(self.model_type in ["roberta"]),
+                                                pad_on_left=bool(self.model_type in ["xlnet"]),
+                                                pad_token=self.tokenizer.convert_tokens_to_ids(
+                                                    [self.tokenizer.pad_token])[0],
+                                                pad_token_segment_id=4 if self.model_type in ["xlnet"] else 0,
+                                                pad_token_label_id=PAD_TOKEN_LABEL_ID,
+                                                window_stride=self.window_stride,
+                                                fast_tokenizer=self.fast_tokenizer)
+        arrays, segments = features_to_arrays(features)
+        dataset = TensorDataset(*(torch.from_numpy(arrays[name])
+                                  for name in ["input_ids", "input_mask", "segment_ids", "label_ids"]))
+        sampler = BucketBatchSampler(arrays["input_mask"].sum(axis=1), self.batch_size, shuffle=False)
+        dataloader = DataLoader(dataset, batch_sampler=sampler,
+                                collate_fn=partial(trim_collate, sequence_fields=NER_SEQUENCE_FIELDS,
+                                                   pad_on_left=bool(self.model_type in ["xlnet"])))
+        preds = []
+        with torch.no_grad():
+            for batch in dataloader:
+                batch = tuple(t.to(self.device).long() for t in batch)
+                is_word = batch[3] != PAD_TOKEN_LABEL_ID
+                if self.exported:
+                    tags = self.model(batch[0], batch[1], batch[2], is_word.long())[0].cpu().numpy()
+                else:
+                    inputs = {"input_ids": batch[0], "attention_mask": batch[1], "labels": batch[3]}
+                    if self.model_type in ["bert", "xlnet"]:
+                        inputs["token_type_ids"] = batch[2]
+                    tags = np.array(self.model(**inputs)[2])
+                preds.extend(row_tags[row_is_word].tolist() for row_tags, row_is_word in
+                             zip(tags, is_word.cpu().numpy()))
+        preds = restore_order(preds, sampler.order)
+        preds = merge_window_predictions(segments, preds, len(examples), self.window_overlap_rule)
+        codes = [LABELS_CODES.get(label, 0) for label in self.labels]
+        return np.array([codes[tag] for example, example_preds in zip(examples, preds)
+                         for tag in example_preds + [0] * (len(example.words) - len(example_preds))], dtype=np.int8)
+
+    def predict(self, texts):
+        """ Returns the sorted list of the (start, end) character spans of every text of `texts`. """
+        examples, offsets = self.tokenize(texts)
+        labels = self.label_words(examples) if examples else np.zeros(0, dtype=np.int8)
+        articles_id = offsets["articles_id"].tolist()
+        articles = dict(zip(articles_id, texts))
+        spans = get_spans_from_labels(labels, offsets, articles)
+        spans = merge_spans(spans, articles)
+        return [spans[article_id] for article_id in articles_id]
+
+
+def _technique_inputs(batch, model_type, use_length=False, join_embeddings=False, use_matchings=False):
+    """ The inputs of the TC models for a `batch` of the dataset, as in `run_glue.evaluate`. """
+    inputs = {'input_ids': batch[0], 'attention_mask': batch[1]}
+    if model_type != 'distilbert':
+        inputs['token_type_ids'] = batch[2] if model_type in ['bert', 'xlnet'] else None
+    # the length and the embeddings of the span, the first sentence of the pair
+    span_mask = batch[1] - batch[2]
+    if model_type == 'xlnet':
+        span_mask[span_mask < 0] = 0
+    if use_length and model_type in ['roberta', 'xlnet']:
+        inputs['lengths'] = span_mask.sum(dim=1, keepdim=True).float()
+    if use_matchings:
+        inputs['matchings'] = batch[4]
+    if join_embeddings and model_type in ['roberta', 'xlnet']:
+        inputs['embeddings_mask'] = span_mask
+    return inputs
+
+
+class TechniquePredictor(object):
+    """ Labels spans of article texts with the propaganda techniques, with the classifier of
+        `technique_classification` saved in `model_dir`. The span and its sentence context are built as in the TC
+        datasets. If the TC `train_file` is given, the predictions are postprocessed as in the submission files.
+        Models trained with `--use_matchings` also need the `train_instances_file` used in their predictions.
+    """
+
+    def __init__(self, model_dir, model_type="roberta", max_seq_length=128, batch_size=8, do_lower_case=False,
+                 train_file=None, train_instances_file=None, quantize=False, device=None):
+        self.model_type = model_type.lower()
+        self.max_seq_length = max_seq_length
+        self.batch_size = batch_size
+        self.label_list = PropProcessor().get_labels()
+        self.device = torch.device("cpu") if quantize else (device or get_device())
+
+        config_class, model_class, tokenizer_class = CLF_MODEL_CLASSES[self.model_type]
+        self.tokenizer = tokenizer_class.from_pretrained(model_dir, do_lower_case=do_lower_case)
+        if quantize:
+            self.model = load_quantized_model(lambda: model_class.from_pretrained(model_dir),
+                                              os.path.join(model_dir, WEIGHTS_NAME),
+                                              model_signature(model_class, config_class.from_pretrained(model_dir)))
+        else:
+            self.model = model_class.from_pretrained(model_dir)
+        self.model.to(self.device)
+        self.model.eval()
+        config = self.model.config
+        self.use_length = getattr(config, "use_length", False)
+        self.join_embeddings = getattr(config, "join_embeddings", False)
+        self.use_matchings = getattr(config, "use_matchings", False)
+
+        self.matching_instances = None
+        if self.use_matchings:
+            if not train_instances_file:
+                raise ValueError("The model %s uses matchings, the train instances file is required" % model_dir)
+            with open(train_instances_file, "rb") as f:
+                self.matching_instances = pickle.load(f)
+
+        self.insides, self.train_instances = None, None
+        if train_file:
+            data_train = pd.read_csv(train_file, sep='\t')
+            self.insides = get_insides(data_train)
+            self.train_instances = get_train_instances(data_train, None, save=False)
+
+    def classify(self, data):
+        """ Returns the logits of the spans of `data`, a TC dataset (see `dataset_to_pandas`). """
+        examples = [InputExample(guid=str(i), text_a=span, text_b=context, label=self.label_list[0])
+                    for i, (span, context) in enumerate(zip(data['span'].values, data['context'].values))]
+        features = glue_convert_examples_to_features(examples, self.tokenizer,
+                                                     label_list=self.label_list,
+                                                     max_length=self.max_seq_length,
+                                                     output_mode="classification",
+                                                     pad_on_left=bool(self.model_type in ['xlnet']),
+                                                     pad_token=self.tokenizer.convert_tokens_to_ids(
+                                                         [self.tokenizer.pad_token])[0],
+                                                     pad_token_segment_id=4 if self.model_type in ['xlnet'] else 0)
+        tensors = [torch.tensor([f.input_ids for f in features], dtype=torch.long),
+                   torch.tensor([f.attention_mask for f in features], dtype=torch.long),
+                   torch.tensor([f.token_type_ids for f in features], dtype=torch.long),
+                   torch.tensor([f.label for f in features], dtype=torch.long)]
+        if self.use_matchings:
+            tensors.append(torch.tensor([get_matchings(example.text_a, self.matching_instances)
+                                         for example in examples], dtype=torch.float))
+        dataset = TensorDataset(*tensors)
+        if self.model_type == 'roberta' and self.use_length and self.join_embeddings:
+            # this head averages over the padding too, see `run_glue.get_collate_fn`
+            sampler = None
+            dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=self.batch_size)
+        else:
+            sampler = BucketBatchSampler(tensors[1].sum(dim=1).numpy(), self.batch_size, shuffle=False)
+            dataloader = DataLoader(dataset, batch_sampler=sampler,
+                                    collate_fn=partial(trim_collate, sequence_fields=clf_utils.SEQUENCE_FIELDS,
+                                                       pad_on_left=bool(self.model_type in ['xlnet'])))
+        logits = []
+        with torch.no_grad():
+            for batch in dataloader:
+                batch = tuple(t.to(self.device) for t in batch)
+                inputs = _technique_inputs(batch, self.model_type, self.use_length, self.join_embeddings,
+                                           self.use_matchings)
+                logits.append(self.model(**inputs)[0].float().cpu().numpy())
+        logits = np.concatenate(logits)
+        return restore_order(logits, sampler.order) if sampler is not None else logits
+
+    def predict(self, texts, spans):
+        """ Returns the list of the techniques of the (start, end) `spans` of every text of `texts`. """
+        articles_id, span_starts, span_ends = [], [], []
+        for article_index, article_spans in enumerate(spans):
+            for start, end in article_spans:
+                articles_id.append(article_index)
+                span_starts.append(start)
+                span_ends.append(end)
+        if not articles_id:
+            return [[] for _ in texts]
+
+        data = dataset_to_pandas(dict(enumerate(texts)), articles_id, span_starts, span_ends,
+                                 ['?'] * len(articles_id))
+        logits = self.classify(data)
+        if self.insides is not None:
+            predictions = postprocess_predictions(softmax_with_temperature(logits, 1), data, self.insides,
+                                                  self.train_instances)
+        else:
+            predictions = [self.label_list[i] for i in np.argmax(logits, axis=1)]
+
+        techniques = [[] for _ in texts]
+        for article_index, technique in zip(articles_id, predictions):
+            techniques[article_index].append(technique)
+        return techniques
+
+
+class ArticlePredictor(object):
+    """ Finds the propaganda spans of article texts with `span_predictor` and labels them with
+        `technique_predictor`. Without the technique predictor, the spans are returned without techniques.
+    """
+
+    def __init__(self, span_predictor, technique_predictor=None):
+        self.span_predictor = span_predictor
+        self.technique_predictor = technique_predictor
+
+    def predict(self, texts):
+        """ Returns the list of the (start, end, technique) spans of every text of `texts`. """
+        spans = self.span_predictor.predict(texts)
+        if self.technique_predictor is None:
+            techniques = [[None] * len(article_spans) for article_spans in spans]
+        else:
+            techniques = self.technique_predictor.predict(texts, spans)
+        return [[(start, end, technique) for (start, end), technique in zip(article_spans, article_techniques)]
+                for article_spans, article_techniques in zip(spans, techniques)]
+
+
+def load_predictor(args):
+    """ Builds the `ArticlePredictor` of the models given in `args` (see `inference.__main__`). """
+    device = get_device(args.no_cuda)
+    span_predictor = SpanPredictor(args.si_model_dir,
+                                   model_type=args.si_model_type,
+                                   config_name=args.si_config_name,
+                                   spacy_model=args.spacy_model,
+                                   max_seq_length=args.si_max_seq_length,
+                                   batch_size=args.batch_size,
+                                   window_stride=args.window_stride,
+                                   window_overlap_rule=args.window_overlap_rule,
+                                   do_lower_case=args.si_do_lower_case,
+                                   exported_model=args.si_exported_model,
+                                   rnn_layers=args.si_rnn_layers,
+                                   quantize=args.quantize,
+                                   device=device)
+    technique_predictor = None
+    if args.tc_model_dir:
+        technique_predictor = TechniquePredictor(args.tc_model_dir,
+                                                 model_type=args.tc_model_type,
+                                                 max_seq_length=args.tc_max_seq_length,
+                                                 batch_size=args.batch_size,
+                                                 do_lower_case=args.tc_do_lower_case,
+                                                 train_file=args.tc_train_file,
+                                                 train_instances_file=args.tc_train_instances_file,
+                                                 quantize=args.quantize,
+                                                 device=device)
+    return ArticlePredictor(span_predictor, technique_predictor)
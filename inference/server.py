@@ -0,0 +1,202 @@
+# coding=utf-8
+""" Local HTTP service keeping the models in memory: the articles of concurrent requests are grouped into
+    micro-batches of similar lengths, which are predicted in a pool of worker threads.
+
+    POST /predict with {"text": "..."} returns {"spans": [{"start": ..., "end": ..., "technique": ...}, ...]},
+    with {"texts": ["...", ...]} it returns {"results": [{"spans": [...]}, ...]}. GET /health returns
+    {"status": "ok"}.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+HTTP_STATUSES = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                 500: "Internal Server Error"}
+
+
+class MicroBatcher(object):
+    """ Collects the items submitted concurrently and runs `predict(items)`, which returns the list of their
+        results, on batches of at most `max_batch_size` items in `num_workers` threads.
+
+        A batch is started when `max_batch_size` items are waiting or `max_wait_ms` milliseconds after its first
+        item. The items already waiting at that moment, up to a batch per worker, are sorted by `length(item)`
+        and split into batches, so that items of similar lengths are padded together.
+    """
+
+    def __init__(self, predict, max_batch_size=8, max_wait_ms=10, num_workers=1, length=len):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.num_workers = num_workers
+        self.length = length
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.queue = None
+        self.workers = None
+        self.task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.workers = asyncio.Semaphore(self.num_workers)
+        self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, item):
+        """ Returns the result of `item` once its batch is predicted. """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        pending = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(pending) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        while len(pending) < self.max_batch_size * self.num_workers and not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        return pending
+
+    async def _run(self):
+        while True:
+            pending = await self._collect()
+            pending.sort(key=lambda el: self.length(el[0]))
+            for batch_start in range(0, len(pending), self.max_batch_size):
+                await self.workers.acquire()
+                asyncio.ensure_future(self._predict_batch(pending[batch_start: batch_start + self.max_batch_size]))
+
+    async def _predict_batch(self, batch):
+        try:
+            items = [item for item, _ in batch]
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self.predict, items)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            logger.exception("Prediction of a batch of %d items failed", len(batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.workers.release()
+
+
+def spans_to_json(spans):
+    return [{"start": start, "end": end, "technique": technique} for start, end, technique in spans]
+
+
+class InferenceServer(object):
+    """ Serves the `predict(texts)` function of an `ArticlePredictor` over HTTP, on `host`:`port` or on the
+        Unix socket `unix_socket`, with the micro-batching of `MicroBatcher`.
+    """
+
+    def __init__(self, predict, host="127.0.0.1", port=8000, unix_socket=None, max_batch_size=8, max_wait_ms=10,
+                 num_workers=1):
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.batcher = MicroBatcher(predict, max_batch_size, max_wait_ms, num_workers)
+        self.server = None
+
+    async def start(self):
+        self.batcher.start()
+        if self.unix_socket:
+            self.server = await asyncio.start_unix_server(self.handle, path=self.unix_socket)
+            logger.info("Serving on %s", self.unix_socket)
+        else:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+            logger.info("Serving on http://%s:%s", self.host, self.server.sockets[0].getsockname()[1])
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def route(self, method, path, body):
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path != "/predict":
+            return 404, {"error": "Unknown path %s" % path}
+        if method != "POST":
+            return 405, {"error": "Use POST for /predict"}
+        try:
+            request = json.loads(body.decode("utf-8"))
+            if not isinstance(request, dict):
+                raise ValueError("the request must be a JSON object")
+            texts = request["texts"] if "texts" in request else [request["text"]]
+            # a string given as "texts" would be iterated character by character
+            if not isinstance(texts, list):
+                raise ValueError("texts must be a list")
+            if not all(isinstance(text, str) for text in texts):
+                raise ValueError("texts must be strings")
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {"error": "Expected {\"text\": str} or {\"texts\": [str, ...]}: %s" % e}
+        try:
+            results = await asyncio.gather(*[self.batcher.submit(text) for text in texts])
+        except Exception as e:
+            return 500, {"error": str(e)}
+        results = [{"spans": spans_to_json(spans)} for spans in results]
+        return 200, {"results": results} if "texts" in request else results[0]
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            try:
+                method, path = request_line.decode("latin-1").split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+            except (ValueError, asyncio.IncompleteReadError) as e:
+                status, response = 400, {"error": "Malformed request: %s" % e}
+            else:
+                status, response = await self.route(method.upper(), path.split("?")[0], body)
+            data = json.dumps(response).encode("utf-8")
+            writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n"
+                          "Connection: close\r\n\r\n" % (status, HTTP_STATUSES[status], len(data))).encode("latin-1"))
+            writer.write(data)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def run_server(predictor, host="127.0.0.1", port=8000, unix_socket=None, max_batch_size=8, max_wait_ms=10,
+               num_workers=1):
+    server = InferenceServer(predictor.predict, host, port, unix_socket, max_batch_size, max_wait_ms, num_workers)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
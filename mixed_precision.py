@@ -0,0 +1,46 @@
+# coding=utf-8
+import contextlib
+import logging
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+def autocast_dtype(args):
+    """ Returns the dtype of the mixed precision selected by `--fp16` or `--bf16`, None for fp32. """
+    if getattr(args, "bf16", False):
+        return torch.bfloat16
+    if getattr(args, "fp16", False):
+        return torch.float16
+    return None
+
+
+def check_mixed_precision(args):
+    """ Validates the mixed precision flags against `args.device`: fp16 needs a GPU, bf16 runs on both. """
+    if getattr(args, "fp16", False) and getattr(args, "bf16", False):
+        raise ValueError("--fp16 and --bf16 are mutually exclusive")
+    if getattr(args, "fp16", False) and args.device.type != "cuda":
+        raise ValueError("--fp16 needs a GPU, use --bf16 for mixed precision on the CPU")
+    if autocast_dtype(args) == torch.bfloat16 and args.device.type == "cuda" and not torch.cuda.is_bf16_supported():
+        raise ValueError("This GPU does not support bf16, use --fp16")
+
+
+def autocast(args):
+    """ The `torch.autocast` context of the runners: matmuls and convolutions run in fp16 or bf16 on `args.device`,
+        the reductions and the losses stay in fp32. A no-op without mixed precision.
+    """
+    dtype = autocast_dtype(args)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=args.device.type, dtype=dtype)
+
+
+def get_grad_scaler(args):
+    """ Returns the loss scaler of fp16 training on a GPU, None otherwise: bf16 has the exponent range of fp32,
+        so its gradients do not underflow.
+    """
+    if autocast_dtype(args) == torch.float16 and args.device.type == "cuda":
+        return torch.cuda.amp.GradScaler()
+    return None
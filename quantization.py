@@ -0,0 +1,129 @@
+# coding=utf-8
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+QUANTIZED_MODEL_FILE = "quantized_model.pt"
+
+
+def quantize_model(model):
+    """ Applies dynamic int8 quantization to the Linear layers of `model`: their weights are stored in int8 and
+        their inputs are quantized on the fly, which only runs on the CPU. `model` itself is left unchanged.
+    """
+    model = model.to("cpu").eval()
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def quantized_model_file(weights_file):
+    return os.path.join(os.path.dirname(weights_file), QUANTIZED_MODEL_FILE)
+
+
+def model_signature(model_class, config, **kwargs):
+    """ Describes the architecture of a model: the name of its class, the hash of its transformers `config` and
+        the other arguments it is built with (`kwargs`, e.g. the LSTM layers of `BertLstmCrf`).
+    """
+    config_hash = hashlib.sha1(config.to_json_string().encode("utf-8")).hexdigest()
+    return dict(kwargs, model_class=model_class.__name__, config_hash=config_hash)
+
+
+def quantized_model_manifest(weights_file, signature):
+    """ What a cached quantized model depends on: the `signature` of the model (see `model_signature`), the torch
+        version that pickled it and the size and modification time of the fp32 weights.
+    """
+    stat = os.stat(weights_file)
+    return {"signature": signature, "torch_version": torch.__version__,
+            "weights": [os.path.basename(weights_file), stat.st_size, stat.st_mtime_ns]}
+
+
+def _read_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return None
+
+
+def _load_module(path):
+    try:
+        return torch.load(path, map_location="cpu", weights_only=False)
+    except TypeError:
+        # older torch versions have no weights_only and always unpickle the whole module
+        return torch.load(path, map_location="cpu")
+
+
+def load_quantized_model(build_model, weights_file, signature, cache_file=None):
+    """ Returns the quantized model of the checkpoint `weights_file`. The quantized model is cached in `cache_file`
+        (`quantized_model.pt` next to the weights by default) with its manifest (`quantized_model.json`, see
+        `quantized_model_manifest`) and reused while the manifest matches, so the fp32 model is only built with
+        `build_model()` when the cache is missing or was made from other weights, for another architecture
+        `signature` or by another torch version.
+    """
+    cache_file = cache_file if cache_file else quantized_model_file(weights_file)
+    manifest_file = os.path.splitext(cache_file)[0] + ".json"
+    manifest = quantized_model_manifest(weights_file, signature)
+    if os.path.exists(cache_file) and _read_manifest(manifest_file) == json.loads(json.dumps(manifest)):
+        logger.info("Loading quantized model from %s", cache_file)
+        return _load_module(cache_file).eval()
+    model = quantize_model(build_model())
+    logger.info("Saving quantized model to %s", cache_file)
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    tmp_file = cache_file + ".tmp"
+    torch.save(model, tmp_file)
+    os.replace(tmp_file, cache_file)
+    # the manifest is written last, so an interrupted save is never taken for an up to date cache
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
+    return model
+
+
+def benchmark(evaluate, model, num_examples, batch_size):
+    """ Runs `evaluate(model)`, which returns a dict of metrics, and returns these metrics together with the
+        latency per batch and the throughput of the run.
+    """
+    start = time.time()
+    results = evaluate(model)
+    seconds = time.time() - start
+    num_batches = max(1, math.ceil(num_examples / batch_size))
+    return results, {"seconds": seconds,
+                     "latency_ms_per_batch": 1000 * seconds / num_batches,
+                     "examples_per_second": num_examples / seconds if seconds > 0 else float("inf")}
+
+
+def quantization_report(evaluate, model, quantized_model, num_examples, batch_size):
+    """ Evaluates the fp32 `model` and its `quantized_model` with `evaluate` and returns a flat dict with the
+        metrics and timings of both, prefixed with "fp32_" and "int8_", and the "delta_" of every metric.
+        Both models are run on the CPU, where the quantized one runs.
+    """
+    report = {}
+    fp32_results, fp32_timings = benchmark(evaluate, model.to("cpu"), num_examples, batch_size)
+    int8_results, int8_timings = benchmark(evaluate, quantized_model, num_examples, batch_size)
+    for key in sorted(fp32_results):
+        report["fp32_" + key] = fp32_results[key]
+        report["int8_" + key] = int8_results[key]
+        report["delta_" + key] = int8_results[key] - fp32_results[key]
+    for key in fp32_timings:
+        report["fp32_" + key] = fp32_timings[key]
+        report["int8_" + key] = int8_timings[key]
+    report["speedup"] = fp32_timings["seconds"] / int8_timings["seconds"] if int8_timings["seconds"] > 0 else 1.0
+    return report
+
+
+def write_report(report, output_file):
+    logger.info("***** Quantization results *****")
+    with open(output_file, "w") as writer:
+        for key in sorted(report):
+            logger.info("  %s = %s", key, str(report[key]))
+            writer.write("{} = {}\n".format(key, str(report[key])))
@@ -1,13 +1,16 @@
 try:
     from .ner import transformers_ner_crf, transformers_ner
-    from .dataset import load_data, get_train_dev_files, get_test_file, create_subfolder
+    from .dataset import load_data, get_train_dev_files, get_test_file, create_subfolder, create_token_offsets, token_offsets_file
     from .submission import get_submission_format
+    from .tokenization import TokenOffsetsCache, SPACY_UNUSED_COMPONENTS
 except:
     from ner import transformers_ner_crf, transformers_ner
-    from dataset import load_data, get_train_dev_files, get_test_file, create_subfolder
+    from dataset import load_data, get_train_dev_files, get_test_file, create_subfolder, create_token_offsets, token_offsets_file
     from submission import get_submission_format
+    from tokenization import TokenOffsetsCache, SPACY_UNUSED_COMPONENTS
     
 import configargparse
+import contextlib
 import spacy
 import logging
 import os
@@ -18,44 +21,69 @@ import tempfile
 logger = logging.getLogger(__name__)
 
 
+def load_tokenizer(args):
+    tokens_cache_dir = args.tokens_cache_dir if args.tokens_cache_dir else os.path.join(args.data_dir, 'tokens_cache')
+    nlp = spacy.load(args.spacy_model, disable=SPACY_UNUSED_COMPONENTS)
+    return TokenOffsetsCache(nlp, tokens_cache_dir, args.spacy_batch_size, args.spacy_n_process)
+
+
 def Main(args):
-    nlp = spacy.load("en_core_web_sm")
     if not os.path.exists(args.data_dir):
         os.makedirs(args.data_dir)
-    
+    # the article corpora are closed when Main returns
+    with contextlib.ExitStack() as corpora:
+        run(args, corpora)
+
+
+def run(args, corpora):
     if args.do_train or args.do_eval or args.split_dataset:
-        articles_content, articles_id, propaganda_techniques_names = load_data(args.train_data_folder, 
-                                                                           args.propaganda_techniques_file)
+        articles, propaganda_techniques_names = load_data(args.train_data_folder, args.propaganda_techniques_file)
+        corpora.enter_context(articles)
         train_file_path = os.path.join(args.data_dir, args.train_file)
         dev_file_path = os.path.join(args.data_dir, args.dev_file)
         if not os.path.exists(train_file_path) or not os.path.exists(dev_file_path) or args.overwrite_cache:
             logger.info("Creating 'ner' train/dev files: %s, %s", train_file_path, dev_file_path)
-            train_ids, dev_ids = get_train_dev_files(articles_id, articles_content, nlp, args.labels_path, train_file_path,
+            tokenizer = load_tokenizer(args)
+            tokenizer.prefetch(articles.texts())
+            train_ids, dev_ids = get_train_dev_files(articles, tokenizer, args.labels_path, train_file_path,
                                                      dev_file_path, args.split_by_ids, args.dev_size, args.random_state)
             if args.split_dataset:
                 create_subfolder(os.path.join(args.data_dir, 'train-train-articles'),  args.train_data_folder, train_ids)
                 create_subfolder(os.path.join(args.data_dir, 'train-dev-articles'),  args.train_data_folder, dev_ids)
     
     if args.do_predict or args.create_submission_file or args.do_eval_spans:
-        test_articles_content, test_articles_id, _ = load_data(args.test_data_folder, args.propaganda_techniques_file)
+        test_articles, _ = load_data(args.test_data_folder, args.propaganda_techniques_file)
+        corpora.enter_context(test_articles)
         test_file_path = os.path.join(args.data_dir, args.test_file)
         if (not os.path.exists(test_file_path) or args.overwrite_cache) and not args.do_eval_spans:
             logger.info("Creating 'ner' test file: %s", test_file_path)
-            get_test_file(test_file_path, test_articles_id, test_articles_content, nlp)            
+            tokenizer = load_tokenizer(args)
+            tokenizer.prefetch(test_articles.texts())
+            get_test_file(test_file_path, test_articles.ids, test_articles.texts(), tokenizer)            
     
-    if args.do_train or args.do_eval or args.do_predict:
+    if args.do_train or args.do_eval or args.do_predict or args.export_model:
         if args.use_crf:
             transformers_ner_crf(args)
         else:
+            if args.export_model:
+                logger.warning("Only the CRF model can be exported, --export_model is ignored without --use_crf")
             transformers_ner(args)
             
+    if args.do_eval_spans or args.create_submission_file:
+        # spans are decoded with the token offsets saved next to the BIO file, spaCy is only needed
+        # for BIO files created before the offsets were saved
+        offsets_file = token_offsets_file(test_file_path)
+        if not os.path.exists(offsets_file):
+            logger.info("Creating token offsets file: %s", offsets_file)
+            create_token_offsets(test_file_path, test_articles.ids, test_articles.texts(), load_tokenizer(args))
+
     if args.do_eval_spans:
         logger.info("Evaluating file %s with competition metrics", args.output_file)
         output_file = os.path.join('results', args.output_file)
-        get_submission_format(args.predicted_labels_files, test_articles_id, test_articles_content, nlp, output_file)
+        get_submission_format(args.predicted_labels_files, offsets_file, test_articles, output_file)
         if args.gold_annot_file is None:
             gold_annot_file = next(tempfile._get_candidate_names())
-            get_submission_format([test_file_path], test_articles_id, test_articles_content, nlp, gold_annot_file)
+            get_submission_format([test_file_path], offsets_file, test_articles, gold_annot_file)
         else:
             gold_annot_file = args.gold_annot_file
         cmd = "python tools/task-SI_scorer.py -s {} -r {}".format(output_file, gold_annot_file)
@@ -68,7 +96,8 @@ def Main(args):
             os.makedirs('results')
         output_file = os.path.join('results', args.output_file)
         logger.info("Creating a submission file: %s", output_file)
-        get_submission_format(args.predicted_labels_files, test_articles_id, test_articles_content, nlp, output_file)
+        confidence_file = os.path.join('results', args.confidence_file) if args.confidence_file else None
+        get_submission_format(args.predicted_labels_files, offsets_file, test_articles, output_file, confidence_file)
 
 
 def main(): 
@@ -95,6 +124,9 @@ def main():
                         help="The predicted filenames of labels that will be used to form the final result")
     parser.add_argument("--output_file", default=None, type=str, required=True,
                         help="The submission filename")
+    parser.add_argument("--confidence_file", default=None, type=str,
+                        help="If given, the submitted spans are also written to this file with their confidence "
+                             "(from the span probabilities of the CRF predictions, which --do_predict then computes).")
     parser.add_argument("--dev_size", default=0.3, type=float, help="Dev data size.")
     parser.add_argument("--split_dataset", action="store_true", 
                         help="Split the dataset into the train/dev parts")
@@ -106,8 +138,19 @@ def main():
     parser.add_argument("--do_eval_spans", action="store_true", 
                         help="Whether to run eval on the dev set with the competition metrics.")
     parser.add_argument("--gold_annot_file", default=None, type=str, help="Gold annotation file.")
+    parser.add_argument("--spacy_model", default="en_core_web_sm", type=str,
+                        help="The spaCy model used to split articles into tokens.")
+    parser.add_argument("--tokens_cache_dir", default="", type=str,
+                        help="The directory for cached token offsets of articles (data_dir/tokens_cache by default).")
+    parser.add_argument("--spacy_n_process", default=1, type=int,
+                        help="Number of processes used to tokenize articles with spaCy.")
+    parser.add_argument("--spacy_batch_size", default=32, type=int,
+                        help="Number of articles sent to each spaCy worker at once.")
 
     parser.add_argument("--use_crf", action="store_true", help="Use Conditional Random Field over the model")
+    parser.add_argument("--rnn_layers", default=0, type=int,
+                        help="With --use_crf, the number of BiLSTM layers run over the hidden states of the words "
+                             "between the encoder and the CRF (0: the CRF reads the token classifier logits).")
     parser.add_argument("--use_quotes", action="store_true")
     
     MODEL_CLASSES = ["bert", "roberta", "distilbert", "camembert"]
@@ -129,6 +172,30 @@ def main():
     parser.add_argument("--max_seq_length", default=128, type=int,
                         help="The maximum total input sequence length after tokenization. Sequences longer "
                              "than this will be truncated, sequences shorter will be padded.")
+    parser.add_argument("--window_stride", default=0, type=int,
+                        help="If > 0, sentences longer than max_seq_length are split into overlapping windows "
+                             "starting every window_stride sub-tokens instead of being truncated.")
+    parser.add_argument("--window_overlap_rule", default="center", type=str, choices=["first", "last", "center"],
+                        help="Which window predicts the words covered by several windows: the first, the last or "
+                             "the one where the word is the farthest from the window edges.")
+    parser.add_argument("--pack_sentences", action="store_true",
+                        help="Put consecutive short sentences into the same sequence up to max_seq_length.")
+    parser.add_argument("--fast_tokenizer", action="store_true",
+                        help="Tokenize the datasets in batches with the tokenizers library (same features, faster).")
+    parser.add_argument("--bucket_by_length", action="store_true",
+                        help="Make train batches of sequences with similar lengths. Batches are always padded only "
+                             "to their longest sequence, and evaluation always groups sequences by length.")
+    parser.add_argument("--quantize", action="store_true",
+                        help="Evaluate and predict on the CPU with the Linear layers dynamically quantized to int8. "
+                             "The quantized model is cached next to the checkpoint. With evaluation, it is compared "
+                             "with the fp32 model (metrics, latency and throughput in quantization_results.txt).")
+    parser.add_argument("--export_model", action="store_true",
+                        help="Export the trained CRF model (without LSTM) with its Viterbi decoding to TorchScript, "
+                             "checking its tags against the checkpoint on the first dev batches.")
+    parser.add_argument("--export_file", default=None, type=str,
+                        help="File of the exported model, exported_model.pt in the output directory by default.")
+    parser.add_argument("--export_check_batches", default=8, type=int,
+                        help="Number of dev batches on which the exported model is checked.")
     parser.add_argument("--do_train", action="store_true",
                         help="Whether to run training.")
     parser.add_argument("--do_eval", action="store_true",
@@ -177,10 +244,9 @@ def main():
                         help="random seed for initialization")
 
     parser.add_argument("--fp16", action="store_true",
-                        help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit")
-    parser.add_argument("--fp16_opt_level", type=str, default="O1",
-                        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-                             "See details at https://nvidia.github.io/apex/amp.html")
+                        help="Train and evaluate with fp16 mixed precision (torch.autocast with loss scaling, GPU only)")
+    parser.add_argument("--bf16", action="store_true",
+                        help="Train and evaluate with bf16 mixed precision (torch.autocast, on the GPU or the CPU)")
     parser.add_argument("--local_rank", type=int, default=-1,
                         help="For distributed training: local_rank")
     parser.add_argument("--server_ip", type=str, default="", help="For distant debugging.")
@@ -1,5 +1,4 @@
 # coding=utf-8
-import glob
 import os
 from shutil import copyfile, rmtree
 import random
@@ -7,20 +6,19 @@ import pandas as pd
 import numpy as np
 from sklearn.model_selection import train_test_split
 from tqdm import tqdm
+from article_corpus import ArticleCorpus
 
 
 def load_data(data_folder, propaganda_techniques_file):
-    file_list = glob.glob(os.path.join(data_folder, "*.txt"))
-    articles_content, articles_id = ([], [])
-    for filename in sorted(file_list):
-        with open(filename, "r", encoding="utf-8") as f:
-            articles_content.append(f.read())
-            articles_id.append(os.path.basename(filename).split(".")[0][7:])
+    """ Returns the `ArticleCorpus` of `data_folder`, a mapping from the article ids to their texts that the caller
+        closes, and the names of the propaganda techniques.
+    """
+    articles = ArticleCorpus.from_folder(data_folder)
 
     with open(propaganda_techniques_file, "r") as f:
         propaganda_techniques_names = [line.rstrip() for line in f.readlines()]
     
-    return articles_content, articles_id, propaganda_techniques_names
+    return articles, propaganda_techniques_names
 
 
 def read_predictions_from_file(filename):
@@ -42,9 +40,8 @@ def group_spans_by_article_ids(span_list):
     return data
 
 
-def get_train_dev_files(articles_id, articles_content, nlp, labels_path, train_file, dev_file, split_by_ids=True, 
+def get_train_dev_files(articles, tokenizer, labels_path, train_file, dev_file, split_by_ids=True, 
                      dev_size=0.3, random_state=42):
-    articles_content_dict = dict(zip(articles_id, articles_content))
     articles_id, gold_spans = read_predictions_from_file(labels_path)
     span_list = list(zip(articles_id, gold_spans))
     
@@ -60,38 +57,97 @@ def get_train_dev_files(articles_id, articles_content, nlp, labels_path, train_f
         train_ids = [example[0] for example in train_data]
         dev_ids = [example[0] for example in dev_data]
     
-    create_BIO_labeled(train_file, train_data, articles_content_dict, nlp)
-    create_BIO_labeled(dev_file, dev_data, articles_content_dict, nlp)
+    create_BIO_labeled(train_file, train_data, articles, tokenizer)
+    create_BIO_labeled(dev_file, dev_data, articles, tokenizer)
     
     return train_ids, dev_ids
     
                     
-def get_test_file(file, articles_id, articles_content, nlp):
-    create_BIO_unlabeled(file, articles_id, articles_content, nlp)
+def get_test_file(file, articles_id, articles_content, tokenizer):
+    create_BIO_unlabeled(file, articles_id, articles_content, tokenizer)
     
 
-def token_label_from_spans(pos, spans):
-    for el in spans:
-        if el[0] <= int(pos) < el[1]:
-            return "PROP"
-    return 'O'
+def token_labels_from_spans(idx, spans):
+    """ Returns a boolean mask marking the token positions `idx` that fall inside any of the `spans`.
+        A position is inside some span iff the largest end among the spans starting at or before it
+        lies to the right of it, so the spans are sorted once and every position is resolved
+        with a single `np.searchsorted`.
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    if len(spans) == 0:
+        return np.zeros(len(idx), dtype=bool)
+    spans = np.asarray(spans, dtype=np.int64).reshape(-1, 2)
+    order = np.argsort(spans[:, 0], kind='stable')
+    starts = spans[order, 0]
+    max_ends = np.maximum.accumulate(spans[order, 1])
+    pos = np.searchsorted(starts, idx, side='right') - 1
+    return (pos >= 0) & (max_ends[np.maximum(pos, 0)] > idx)
 
-                    
-def create_BIO_labeled(file, data, articles_content_dict, nlp):
+
+def BIO_tokens(text, tokenizer):
+    """ Yields (tok, start, end, prev_end) for every spaCy token of `text`, where `tok` is the token written to
+        the BIO file, '\n' if the token is skipped and ends a sentence, or None if it is skipped silently.
+        `prev_end` is the end offset of the preceding spaCy token, which is where a predicted span closed
+        by this token ends.
+    """
+    idx, tokens = tokenizer.tokenize(text)
+    prev_tok = '\n'
+    prev_end = -1
+    for start, token in zip(idx.tolist(), tokens):
+        end = start + len(token.strip().replace('\n', ' ').replace('\t', ' '))
+        tok = token.replace('\n', ' ').replace('\t', ' ').strip()
+        if len(tok) != 0 and repr(tok) != repr('\ufeff') and repr(tok) != repr('\u200f'):
+            tok = token.strip().replace('\n', ' ').replace('\t', ' ')
+            prev_tok = tok
+            yield tok, start, end, prev_end
+        elif prev_tok != '\n':
+            prev_tok = '\n'
+            yield '\n', start, end, prev_end
+        else:
+            yield None, start, end, prev_end
+        prev_end = end
+
+
+def token_offsets_file(file):
+    return file + '.offsets.npz'
+
+
+class TokenOffsets(object):
+    """ Offsets sidecar of a BIO file: for each token line, the index of its article and its start, end and
+        prev_end character offsets, as yielded by `BIO_tokens`.
+    """
+
+    def __init__(self):
+        self.article_index, self.starts, self.ends, self.prev_ends = ([], [], [], [])
+
+    def append(self, article_index, start, end, prev_end):
+        self.article_index.append(article_index)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.prev_ends.append(prev_end)
+
+    def to_arrays(self, articles_id):
+        return dict(articles_id=np.array(articles_id, dtype=str),
+                    article_index=np.array(self.article_index, dtype=np.int32),
+                    starts=np.array(self.starts, dtype=np.int32),
+                    ends=np.array(self.ends, dtype=np.int32),
+                    prev_ends=np.array(self.prev_ends, dtype=np.int32))
+
+    def save(self, file, articles_id):
+        np.savez(token_offsets_file(file), **self.to_arrays(articles_id))
+
+
+def create_BIO_labeled(file, data, articles, tokenizer):
     prev_label = 'O'
+    offsets = TokenOffsets()
     with open(file, 'w') as f:
-        for article_id, spans in tqdm(data):
-            text = articles_content_dict[article_id]
-            tokens = [(token.idx, token.text) for token in nlp(text)]
-            idx = np.array(tokens)[:,0]
-            tokens = np.array(tokens)[:,1]
-            prev_tok = '\n'
-            
-            for i in range(len(tokens)):
-                tok = tokens[i].replace('\n', ' ').replace('\t', ' ').strip()
-                if len(tok) != 0 and repr(tok) != repr('\ufeff') and repr(tok) != repr('\u200f'):
-                    tok = tokens[i].strip().replace('\n', ' ').replace('\t', ' ')
-                    label =  token_label_from_spans(idx[i], spans)
+        for article_index, (article_id, spans) in enumerate(tqdm(data)):
+            bio_tokens = list(BIO_tokens(articles[article_id], tokenizer))
+            in_spans = iter(token_labels_from_spans([el[1] for el in bio_tokens if el[0] not in (None, '\n')], spans))
+
+            for tok, start, end, prev_end in bio_tokens:
+                if tok is not None and tok != '\n':
+                    label = 'PROP' if next(in_spans) else 'O'
                     if label != 'O':
                         if prev_label != 'O':
                             label = 'I-' + 'PROP'
@@ -99,38 +155,37 @@ def create_BIO_labeled(file, data, articles_content_dict, nlp):
                             label = 'B-' + 'PROP'
                     f.write(tok + '\t' + label + '\n')
                     prev_label = label
-                    prev_tok = tok
+                    offsets.append(article_index, start, end, prev_end)
                 else:
-                    if prev_tok != '\n':
+                    if tok is not None:
                         f.write('\n')
-                        prev_tok = '\n'
                     prev_label = 'O'
+    offsets.save(file, [article_id for article_id, _ in data])
 
-                    
-def create_BIO_unlabeled(file, articles_id, articles_content, nlp):
-    prev_label = 'O'
+
+def create_BIO_unlabeled(file, articles_id, articles_content, tokenizer):
+    offsets = TokenOffsets()
     with open(file, 'w') as f:
-        for article_id, text in tqdm(zip(articles_id, articles_content)):
-            tokens = [(token.idx, token.text) for token in nlp(text)]
-            idx = np.array(tokens)[:,0]
-            tokens = np.array(tokens)[:,1]
-            prev_tok = '\n'
-            
-            for i in range(len(tokens)):
-                tok = tokens[i].replace('\n', ' ').replace('\t', ' ').strip()
-                if len(tok) != 0 and repr(tok) != repr('\ufeff') and repr(tok) != repr('\u200f'):
-                    tok = tokens[i].strip().replace('\n', ' ').replace('\t', ' ')
-                    label = 'O'
-                    f.write(tok + '\t' + label + '\n')
-                    prev_label = label
-                    prev_tok = tok
-                else:
-                    if prev_tok != '\n':
-                        f.write('\n')
-                        prev_tok = '\n'
-                    prev_label = 'O'
+        for article_index, text in enumerate(tqdm(articles_content)):
+            for tok, start, end, prev_end in BIO_tokens(text, tokenizer):
+                if tok == '\n':
+                    f.write('\n')
+                elif tok is not None:
+                    f.write(tok + '\t' + 'O' + '\n')
+                    offsets.append(article_index, start, end, prev_end)
+    offsets.save(file, articles_id)
+
+
+def create_token_offsets(file, articles_id, articles_content, tokenizer):
+    """ Creates only the offsets sidecar of a BIO `file` built from the given articles. """
+    offsets = TokenOffsets()
+    for article_index, text in enumerate(articles_content):
+        for tok, start, end, prev_end in BIO_tokens(text, tokenizer):
+            if tok is not None and tok != '\n':
+                offsets.append(article_index, start, end, prev_end)
+    offsets.save(file, articles_id)
+
 
-                    
 def create_subfolder(subfolder, source_folder, articles_id):
     if os.path.exists(subfolder):
         rmtree(subfolder)
@@ -0,0 +1,86 @@
+# coding=utf-8
+""" Compares the python and the fast (`tokenizers`) paths of `convert_examples_to_features` on a BIO file:
+    checks that both produce the same features for the BERT, RoBERTa and XLNet layouts and reports their timings.
+
+    python -m span_identification.ner.benchmark_features --data_file cached_datasets/SI/train.tsv \
+        --model_type roberta --tokenizer_name roberta-large --do_lower_case
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import logging
+import time
+
+from transformers import BertTokenizer, RobertaTokenizer
+
+from .utils_ner import convert_examples_to_features, get_fast_tokenizer, get_labels, read_examples_from_file
+
+TOKENIZER_CLASSES = {
+    "bert": BertTokenizer,
+    "roberta": RobertaTokenizer,
+}
+
+LAYOUTS = {
+    "bert": dict(cls_token_at_end=False, cls_token_segment_id=0, sep_token_extra=False, pad_on_left=False,
+                 pad_token_segment_id=0),
+    "roberta": dict(cls_token_at_end=False, cls_token_segment_id=0, sep_token_extra=True, pad_on_left=False,
+                    pad_token_segment_id=0),
+    "xlnet": dict(cls_token_at_end=True, cls_token_segment_id=2, sep_token_extra=False, pad_on_left=True,
+                  pad_token_segment_id=4),
+}
+
+
+def convert(examples, labels, tokenizer, max_seq_length, layout, fast_tokenizer=None):
+    start = time.time()
+    features = convert_examples_to_features(examples, labels, max_seq_length, tokenizer,
+                                            cls_token=tokenizer.cls_token,
+                                            sep_token=tokenizer.sep_token,
+                                            pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+                                            pad_token_label_id=-100,
+                                            fast_tokenizer=fast_tokenizer,
+                                            **LAYOUTS[layout])
+    return features, time.time() - start
+
+
+def compare(examples, labels, tokenizer, max_seq_length, layouts):
+    fast_tokenizer = get_fast_tokenizer(tokenizer)
+    if fast_tokenizer is None:
+        raise ValueError("There is no fast counterpart of {} (is the tokenizers library installed?)".format(
+            type(tokenizer).__name__))
+    results = {}
+    for layout in layouts:
+        features, slow_time = convert(examples, labels, tokenizer, max_seq_length, layout)
+        fast_features, fast_time = convert(examples, labels, tokenizer, max_seq_length, layout, fast_tokenizer)
+        mismatches = sum(1 for a, b in zip(features, fast_features) if vars(a) != vars(b))
+        mismatches += abs(len(features) - len(fast_features))
+        results[layout] = {"slow": slow_time, "fast": fast_time, "mismatches": mismatches, "features": len(features)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_file", required=True, type=str, help="BIO file to convert.")
+    parser.add_argument("--model_type", default="roberta", type=str, choices=sorted(TOKENIZER_CLASSES),
+                        help="Type of the tokenizer.")
+    parser.add_argument("--tokenizer_name", required=True, type=str, help="Pretrained tokenizer name or path.")
+    parser.add_argument("--do_lower_case", action="store_true")
+    parser.add_argument("--labels", default="", type=str, help="Path to a file containing all labels.")
+    parser.add_argument("--max_seq_length", default=256, type=int)
+    parser.add_argument("--layouts", default=["bert", "roberta", "xlnet"], nargs="*", choices=sorted(LAYOUTS),
+                        help="Layouts of the special tokens and the padding to compare.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARN)
+
+    tokenizer = TOKENIZER_CLASSES[args.model_type].from_pretrained(args.tokenizer_name,
+                                                                   do_lower_case=args.do_lower_case)
+    examples = read_examples_from_file(args.data_file, "benchmark")
+    results = compare(examples, get_labels(args.labels), tokenizer, args.max_seq_length, args.layouts)
+    for layout, result in results.items():
+        print("{}: {} features, python {:.2f}s, fast {:.2f}s ({:.1f}x), {} mismatches".format(
+            layout, result["features"], result["slow"], result["fast"], result["slow"] / max(result["fast"], 1e-9),
+            result["mismatches"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,18 +9,28 @@ based on
 
 # coding=utf-8
 # coding=utf-8
-import copy
 from typing import cast, List
 import numpy as np
 
 import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
-from torch.autograd import Variable
 import torch
 
 from .conditional_random_field import ConditionalRandomField, allowed_transitions
 
 
+def word_positions(is_word: torch.Tensor):
+    """
+    Returns the rows and the columns of the words marked in the (batch_size, seq_length) `is_word` mask, and their
+    columns once the words of every row are moved to its beginning. Can be compiled with TorchScript.
+    """
+    positions = is_word.nonzero()
+    rows, word_columns = positions[:, 0], positions[:, 1]
+    columns = is_word.long().cumsum(1)[rows, word_columns] - 1
+    return rows, word_columns, columns
+
+
 class BertLstmCrf(nn.Module):
     """
     bert_lstm_crf model
@@ -72,65 +82,80 @@ class BertLstmCrf(nn.Module):
 
         self.output_dropout = nn.Dropout(p=output_dropout)
 
-    def rand_init_hidden(self, batch_size):
+    def rand_init_hidden(self, batch_size, device=None, dtype=None):
         """
-        random initialize hidden variable
+        random initialize hidden variable, directly on the device of the inputs
         """
-        return Variable(
-            torch.randn(2 * self.rnn_layers, batch_size, self.hidden_dim)), Variable(
-            torch.randn(2 * self.rnn_layers, batch_size, self.hidden_dim))
-    
+        size = (2 * self.rnn_layers, batch_size, self.hidden_dim)
+        return (torch.randn(size, device=device, dtype=dtype),
+                torch.randn(size, device=device, dtype=dtype))
+
     def clear_subtokens(self, logits, labels, mask):
-        clear_labels = torch.zeros_like(labels)
-        clear_logits = torch.zeros_like(logits)
-        clear_mask = torch.zeros_like(mask)
-
-        for i in range(len(labels)):
-            assert (mask[i][labels[i] != -100] == 1).all()
-            cor = labels[i][labels[i] != -100]
-            clear_labels[i][:len(cor)] = cor
-            clear_logits[i][:len(cor)] = logits[i][labels[i] != - 100]
-            clear_mask[i][:len(cor)] = 1
+        """
+        Moves the logits and the labels of the first sub-tokens of the words (the positions whose label is not -100)
+        to the beginning of every row, the rest is filled with zeros. The new mask covers the moved positions.
+        """
+        is_word = labels != -100
+        assert (mask[is_word] == 1).all()
+        rows, word_columns, columns = word_positions(is_word)
+
+        clear_labels = torch.zeros_like(labels).index_put((rows, columns), labels[is_word])
+        clear_logits = torch.zeros_like(logits).index_put((rows, columns), logits[is_word])
+        clear_mask = torch.zeros_like(mask).index_put((rows, columns), mask.new_ones(()))
         return clear_logits, clear_labels, clear_mask
 
-    def forward(self, **kwargs):
+    def restore_subtokens(self, clear_logits, labels):
+        """
+        Inverse of `clear_subtokens` for the logits: puts them back to the positions of the first sub-tokens,
+        the other positions get zeros.
+        """
+        rows, word_columns, columns = word_positions(labels != -100)
+        return torch.zeros_like(clear_logits).index_put((rows, word_columns), clear_logits[rows, columns])
+
+    def forward(self, return_probabilities=False, **kwargs):
         '''
         args:
             sentence (word_seq_len, batch_size) : word-level representation of sentence
             hidden: initial hidden state
+            return_probabilities: also compute the CRF marginals (forward-backward over the batch)
 
         return:
-            crf output (word_seq_len, batch_size, tag_size, tag_size), hidden
+            (loss, logits, predicted tags) and, with `return_probabilities`, the probabilities of the words to be
+            inside a span
         '''
 
-        kwargs_copy = copy.deepcopy(kwargs)
-        if "labels" in kwargs_copy:
-            kwargs_copy.pop("labels")
-
         batch_size = kwargs["input_ids"].size(0)
         seq_length = kwargs["input_ids"].size(1)
 
-        bert_outputs = self.bert_encoder(
-            **kwargs
-        )
-        sequence_output = bert_outputs[1]
-
         if self.lstm is not None:
-            hidden = self.rand_init_hidden(batch_size)
-            if kwargs["input_ids"].is_cuda:
-                hidden = (i.cuda() for i in hidden)
-            sequence_output, hidden = self.lstm(sequence_output, hidden)
-            sequence_output = sequence_output.contiguous().view(-1, self.hidden_dim * 2)
-            sequence_output = self.output_dropout(sequence_output)
-            
-            sequence_output = self.liner(sequence_output)
-
-        #out = self.liner(sequence_output)
-        out = sequence_output
-        logits = out.contiguous().view(batch_size, seq_length, -1)
-        
-        clear_logits, clear_labels, clear_mask = self.clear_subtokens(logits, kwargs['labels'], kwargs["attention_mask"])
-        
+            # the LSTM reads the hidden states of the encoder (`embedding_dim` features), not the logits of its
+            # token classification head, and runs over the first sub-tokens of the words only, packed to skip
+            # the padding
+            encoder_inputs = {name: value for name, value in kwargs.items() if name != "labels"}
+            sequence_output = self.bert_encoder.base_model(**encoder_inputs)[0]
+            clear_output, clear_labels, clear_mask = self.clear_subtokens(
+                sequence_output, kwargs['labels'], kwargs["attention_mask"])
+            lengths = clear_mask.sum(1).clamp(min=1).cpu()
+            packed_output = pack_padded_sequence(clear_output, lengths, batch_first=True, enforce_sorted=False)
+            hidden = self.rand_init_hidden(batch_size, sequence_output.device, sequence_output.dtype)
+            packed_output, hidden = self.lstm(packed_output, hidden)
+            clear_output, _ = pad_packed_sequence(packed_output, batch_first=True, total_length=seq_length)
+            clear_output = self.output_dropout(clear_output)
+
+            clear_logits = self.liner(clear_output) * clear_mask.unsqueeze(-1).to(clear_output.dtype)
+            logits = self.restore_subtokens(clear_logits, kwargs['labels'])
+        else:
+            bert_outputs = self.bert_encoder(
+                **kwargs
+            )
+            sequence_output = bert_outputs[1]
+            #out = self.liner(sequence_output)
+            out = sequence_output
+            logits = out.contiguous().view(batch_size, seq_length, -1)
+
+            clear_logits, clear_labels, clear_mask = self.clear_subtokens(
+                logits, kwargs['labels'], kwargs["attention_mask"])
+
         """
         best_paths = self.crf.viterbi_tags(
             logits,
@@ -138,25 +163,41 @@ class BertLstmCrf(nn.Module):
             top_k=1
         )
         """
-        best_paths = self.crf.viterbi_tags(
-            clear_logits,
-            clear_mask.long(),
-            top_k=1
-        )
+        # under mixed precision the emissions come in fp16 or bf16, the CRF and its log-likelihood run in fp32
+        clear_logits = clear_logits.float()
+        crf_precision = torch.autocast(device_type=clear_logits.device.type, enabled=False)
+        with crf_precision:
+            best_paths = self.crf.viterbi_tags(
+                clear_logits,
+                clear_mask.long(),
+                top_k=1
+            )
         # Just get the top tags and ignore the scores.
         predicted_tags = cast(List[List[int]], [x[0][0] for x in best_paths])
-        
+        outputs = (logits, predicted_tags)
+        if return_probabilities:
+            # the probability of every word to be inside a span (B or I, as O is the tag 0), from the CRF marginals
+            with crf_precision:
+                span_probabilities = 1 - self.crf.marginals(clear_logits, clear_mask)[:, :, 0]
+            span_probabilities = [row[:len(tags)] for row, tags in zip(span_probabilities.tolist(), predicted_tags)]
+            outputs += (span_probabilities,)
+
         if kwargs.get("labels") is not None:
-            labels = kwargs.get("labels").cpu()
+            labels = kwargs.get("labels").cpu().numpy()
             #log_likelihood = self.crf(logits, kwargs.get("labels"), kwargs["attention_mask"])
-            log_likelihood = self.crf(clear_logits, clear_labels, clear_mask)
+            with crf_precision:
+                log_likelihood = self.crf(clear_logits, clear_labels, clear_mask)
             loss = -log_likelihood
-            correct_predicted_tags = np.zeros_like(labels)
-            for i in range(len(labels)):
-                correct_predicted_tags[i][labels[i] != -100] = predicted_tags[i]
-            return (loss, logits, list(correct_predicted_tags))
-
-        return (None, logits, predicted_tags)
+            # the tags of every row go back to the positions of its words, in order
+            is_word = labels != -100
+            correct_outputs = []
+            for word_outputs, dtype in zip(outputs[1:], [labels.dtype, np.float32]):
+                correct_word_outputs = np.zeros(labels.shape, dtype=dtype)
+                correct_word_outputs[is_word] = [value for values in word_outputs for value in values]
+                correct_outputs.append(list(correct_word_outputs))
+            return (loss, logits) + tuple(correct_outputs)
+
+        return (None,) + outputs
 
 
 if __name__ == "__main__":
@@ -232,6 +232,8 @@ class ConditionalRandomField(torch.nn.Module):
                 constraint_mask[i, j] = 1.0
 
         self._constraint_mask = torch.nn.Parameter(constraint_mask, requires_grad=False)
+        # (key, transitions) of the last augmented transition matrix built by ``_augmented_transitions``
+        self._transitions_cache = None
 
         # Also need logits for transitioning from "start" state and to "end" state.
         self.include_start_end_transitions = include_start_end_transitions
@@ -294,6 +296,48 @@ class ConditionalRandomField(torch.nn.Module):
         # Finally we log_sum_exp along the num_tags dim, result is (batch_size,)
         return logsumexp(stops)
 
+    def marginals(self, logits: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """
+        Computes the (batch_size, sequence_length, num_tags) marginal probabilities of the tags at
+        every position with the forward-backward algorithm, in log space like ``_input_likelihood``.
+        As in ``forward()``, the constraints are not applied. The masked positions get zeros.
+        """
+        batch_size, sequence_length, num_tags = logits.size()
+
+        # Transpose batch size and sequence dimensions
+        mask = mask.float().transpose(0, 1).contiguous()
+        logits = logits.float().transpose(0, 1).contiguous()
+        transition_scores = self.transitions.float().view(1, num_tags, num_tags)
+
+        # Forward pass: alpha[i] are the scores of all the paths ending with each tag at timestep i.
+        if self.include_start_end_transitions:
+            alpha = self.start_transitions.float().view(1, num_tags) + logits[0]
+        else:
+            alpha = logits[0]
+        alphas = [alpha]
+        for i in range(1, sequence_length):
+            inner = alpha.view(batch_size, num_tags, 1) + logits[i].view(batch_size, 1, num_tags) + transition_scores
+            alpha = logsumexp(inner, 1) * mask[i].view(batch_size, 1) + alpha * (1 - mask[i]).view(batch_size, 1)
+            alphas.append(alpha)
+
+        # Backward pass: beta[i] are the scores of all the paths starting from each tag at timestep i,
+        # without the logits of timestep i. The last unmasked timestep transitions to the stop tag.
+        if self.include_start_end_transitions:
+            stops = self.end_transitions.float().view(1, num_tags).expand(batch_size, num_tags)
+        else:
+            stops = logits.new_zeros(batch_size, num_tags)
+        beta = stops
+        betas = [beta]
+        for i in range(sequence_length - 1, 0, -1):
+            inner = transition_scores + (logits[i] + beta).view(batch_size, 1, num_tags)
+            beta = logsumexp(inner, 2) * mask[i].view(batch_size, 1) + stops * (1 - mask[i]).view(batch_size, 1)
+            betas.append(beta)
+        betas.reverse()
+
+        # alpha + beta sums to the log partition over the tags at every unmasked timestep
+        probabilities = torch.softmax(torch.stack(alphas) + torch.stack(betas), dim=-1)
+        return (probabilities * mask.unsqueeze(-1)).transpose(0, 1)
+
     def _joint_likelihood(
         self, logits: torch.Tensor, tags: torch.Tensor, mask: torch.LongTensor
     ) -> torch.Tensor:
@@ -373,6 +417,61 @@ class ConditionalRandomField(torch.nn.Module):
 
         return torch.sum(log_numerator - log_denominator)
 
+    def _augmented_transitions(self, device: torch.device) -> torch.Tensor:
+        """
+        Returns the (num_tags + 2, num_tags + 2) transition matrix used for decoding: the transitions
+        with the start and end transitions appended as the ``num_tags`` and ``num_tags + 1`` tags and
+        the disallowed transitions set to -10000. The matrix is rebuilt only when the parameters have
+        changed (their version counters are bumped by every in-place update) or for another device.
+        """
+        parameters = [self.transitions, self._constraint_mask]
+        if self.include_start_end_transitions:
+            parameters += [self.start_transitions, self.end_transitions]
+        key = (device,) + tuple((id(parameter), parameter._version) for parameter in parameters)
+        if self._transitions_cache is not None and self._transitions_cache[0] == key:
+            return self._transitions_cache[1]
+
+        num_tags = self.num_tags
+        start_tag = num_tags
+        end_tag = num_tags + 1
+        constraint_mask = self._constraint_mask.detach()
+        transitions = torch.Tensor(num_tags + 2, num_tags + 2).fill_(-10000.0)
+
+        # Apply transition constraints
+        constrained_transitions = self.transitions.detach() * constraint_mask[
+            :num_tags, :num_tags
+        ] + -10000.0 * (1 - constraint_mask[:num_tags, :num_tags])
+        transitions[:num_tags, :num_tags] = constrained_transitions
+
+        if self.include_start_end_transitions:
+            transitions[start_tag, :num_tags] = self.start_transitions.detach() * constraint_mask[
+                start_tag, :num_tags
+            ] + -10000.0 * (1 - constraint_mask[start_tag, :num_tags])
+            transitions[:num_tags, end_tag] = self.end_transitions.detach() * constraint_mask[
+                :num_tags, end_tag
+            ] + -10000.0 * (1 - constraint_mask[:num_tags, end_tag])
+        else:
+            transitions[start_tag, :num_tags] = -10000.0 * (1 - constraint_mask[start_tag, :num_tags])
+            transitions[:num_tags, end_tag] = -10000.0 * (1 - constraint_mask[:num_tags, end_tag])
+
+        transitions = transitions.to(device)
+        self._transitions_cache = (key, transitions)
+        return transitions
+
+    def _batched_viterbi(self, logits: torch.Tensor, mask: torch.Tensor) -> List[VITERBI_DECODING]:
+        """
+        Finds the best tag sequence of every batch member at once with ``batched_viterbi_decode``.
+        """
+        transitions = self._augmented_transitions(logits.device)
+        lengths = mask.long().sum(-1)
+        viterbi_paths, viterbi_scores = batched_viterbi_decode(logits, lengths, transitions)
+        return [
+            (viterbi_path[:sequence_length], viterbi_score)
+            for viterbi_path, sequence_length, viterbi_score in zip(
+                viterbi_paths.tolist(), lengths.tolist(), viterbi_scores.tolist()
+            )
+        ]
+
     def viterbi_tags(
         self, logits: torch.Tensor, mask: torch.Tensor, top_k: int = None
     ) -> Union[List[VITERBI_DECODING], List[List[VITERBI_DECODING]]]:
@@ -384,6 +483,8 @@ class ConditionalRandomField(torch.nn.Module):
         Each decoding is a tuple  (tag_sequence, viterbi_score)
         For backwards compatibility, if top_k is None, then instead returns a flat list of
         tag sequences (the top tag sequence for each batch item).
+        The top path of all the batch members is decoded at once (see ``_batched_viterbi``),
+        top_k > 1 falls back to ``viterbi_decode`` on every sequence.
         """
         if top_k is None:
             top_k = 1
@@ -396,35 +497,15 @@ class ConditionalRandomField(torch.nn.Module):
         # Get the tensors out of the variables
         logits, mask = logits.data, mask.data
 
-        # Augment transitions matrix with start and end transitions
+        if top_k == 1:
+            best_paths = [[top_path] for top_path in self._batched_viterbi(logits, mask)]
+            if flatten_output:
+                return [top_k_paths[0] for top_k_paths in best_paths]
+            return best_paths
+
         start_tag = num_tags
         end_tag = num_tags + 1
-        transitions = torch.Tensor(num_tags + 2, num_tags + 2).fill_(-10000.0)
-
-        # Apply transition constraints
-        constrained_transitions = self.transitions * self._constraint_mask[
-            :num_tags, :num_tags
-        ] + -10000.0 * (1 - self._constraint_mask[:num_tags, :num_tags])
-        transitions[:num_tags, :num_tags] = constrained_transitions.data
-
-        if self.include_start_end_transitions:
-            transitions[
-                start_tag, :num_tags
-            ] = self.start_transitions.detach() * self._constraint_mask[
-                start_tag, :num_tags
-            ].data + -10000.0 * (
-                1 - self._constraint_mask[start_tag, :num_tags].detach()
-            )
-            transitions[:num_tags, end_tag] = self.end_transitions.detach() * self._constraint_mask[
-                :num_tags, end_tag
-            ].data + -10000.0 * (1 - self._constraint_mask[:num_tags, end_tag].detach())
-        else:
-            transitions[start_tag, :num_tags] = -10000.0 * (
-                1 - self._constraint_mask[start_tag, :num_tags].detach()
-            )
-            transitions[:num_tags, end_tag] = -10000.0 * (
-                1 - self._constraint_mask[:num_tags, end_tag].detach()
-            )
+        transitions = self._augmented_transitions(torch.device("cpu"))
 
         best_paths = []
         # Pad the max sequence length by 2 to account for start_tag + end_tag.
@@ -636,3 +717,73 @@ def viterbi_decode(
         return viterbi_paths[0], viterbi_scores[0]
 
     return viterbi_paths, viterbi_scores
+
+
+def batched_viterbi_decode(
+    logits: torch.Tensor, lengths: torch.Tensor, transition_matrix: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Perform Viterbi decoding of a whole batch at once. This is the same decoding as
+    ``viterbi_decode`` with ``top_k=1`` on every sequence padded with the START and END steps, but
+    the max-product recursion runs over the whole (batch_size, sequence_length + 2, num_tags + 2)
+    tensor and the paths are recovered with gathers. The steps after the END step of a shorter
+    sequence keep its scores and point back to the same tag. The function can be compiled with
+    TorchScript.
+    Parameters
+    ----------
+    logits : torch.Tensor, required.
+        A tensor of shape (batch_size, sequence_length, num_tags) representing the unary potentials.
+    lengths : torch.Tensor, required.
+        A tensor of shape (batch_size,) with the length of every sequence; the logits after the
+        length of a sequence are ignored.
+    transition_matrix : torch.Tensor, required.
+        A tensor of shape (num_tags + 2, num_tags + 2) with the transitions, where the tags
+        ``num_tags`` and ``num_tags + 1`` are the START and END tags.
+    Returns
+    -------
+    viterbi_paths : torch.Tensor
+        A (batch_size, sequence_length) tensor of the best tags, only the first ``lengths``
+        tags of every sequence are meaningful.
+    viterbi_scores : torch.Tensor
+        The (batch_size,) scores of the viterbi paths.
+    """
+    batch_size, max_seq_length, num_tags = logits.size()
+    device = logits.device
+    start_tag = num_tags
+    end_tag = num_tags + 1
+
+    steps = torch.arange(max_seq_length + 2, device=device)
+    # Start with everything totally unlikely
+    tag_sequence = torch.full(
+        (batch_size, max_seq_length + 2, num_tags + 2), -10000.0, dtype=torch.float, device=device
+    )
+    # At timestep 0 we must have the START_TAG
+    tag_sequence[:, 0, start_tag] = 0.0
+    # At steps 1, ..., sequence_length we just use the incoming prediction
+    in_sequence = (steps[1:-1].unsqueeze(0) <= lengths.unsqueeze(1)).unsqueeze(2)
+    tag_sequence[:, 1:-1, :num_tags] = torch.where(
+        in_sequence, logits.float(), tag_sequence[:, 1:-1, :num_tags]
+    )
+    # And at the last timestep we must have the END_TAG
+    tag_sequence[torch.arange(batch_size, device=device), lengths + 1, end_tag] = 0.0
+
+    path_scores = tag_sequence[:, 0]
+    identity = torch.arange(num_tags + 2, device=device).expand(batch_size, num_tags + 2)
+    path_indices: List[torch.Tensor] = []
+    for timestep in range(1, max_seq_length + 2):
+        # Best pairwise potential path score from the previous timestep.
+        summed_potentials = path_scores.unsqueeze(2) + transition_matrix
+        scores, paths = summed_potentials.max(1)
+        active = (timestep <= lengths + 1).unsqueeze(1)
+        path_scores = torch.where(active, tag_sequence[:, timestep] + scores, path_scores)
+        path_indices.append(torch.where(active, paths, identity))
+
+    # Construct the most likely sequences backwards.
+    viterbi_scores, best_tags = path_scores.max(1)
+    viterbi_paths = [best_tags]
+    for backward_timestep in range(len(path_indices) - 1, -1, -1):
+        viterbi_paths.append(
+            path_indices[backward_timestep].gather(1, viterbi_paths[-1].unsqueeze(1)).squeeze(1)
+        )
+    # Get rid of START and END sentinels.
+    return torch.stack(viterbi_paths, 1).flip([1])[:, 1:-1], viterbi_scores
@@ -0,0 +1,111 @@
+# coding=utf-8
+""" TorchScript export of `BertLstmCrf` for serving: the encoder with its emission layer is traced and the word
+    compaction and the constrained Viterbi decoding of the CRF are scripted, so the whole batch is decoded inside
+    the graph. The exported file runs on the CPU with `load_exported_model`, without the training code.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import logging
+from typing import Tuple
+
+import numpy as np
+import torch
+
+from .bert_lstm_crf import word_positions
+from .conditional_random_field import batched_viterbi_decode
+
+logger = logging.getLogger(__name__)
+
+METADATA_FILE = "metadata.json"
+
+
+class EncoderEmissions(torch.nn.Module):
+    """ The encoder of `BertLstmCrf` with its token classification head, returning the logits of every token. """
+
+    def __init__(self, encoder, use_token_type_ids=False):
+        super(EncoderEmissions, self).__init__()
+        self.encoder = encoder
+        self.use_token_type_ids = use_token_type_ids
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        if self.use_token_type_ids:
+            return self.encoder(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+
+class ExportedSpanTagger(torch.nn.Module):
+    """ Tags the words of a batch: the emissions of their first sub-tokens (the positions of `word_mask`) are moved to
+        the beginning of the rows and decoded with the constrained transitions of the CRF, then the tags are put
+        back to the word positions. The other positions get `pad_tag`.
+    """
+
+    def __init__(self, emissions, transitions, pad_tag=-100):
+        super(ExportedSpanTagger, self).__init__()
+        self.emissions = emissions
+        self.register_buffer("transitions", transitions)
+        self.pad_tag = pad_tag
+
+    def forward(self, input_ids, attention_mask, token_type_ids, word_mask) -> Tuple[torch.Tensor, torch.Tensor]:
+        logits = self.emissions(input_ids, attention_mask, token_type_ids)
+        is_word = word_mask > 0
+        rows, word_columns, columns = word_positions(is_word)
+        clear_logits = torch.zeros_like(logits).index_put((rows, columns), logits[is_word])
+        lengths = is_word.long().sum(1)
+        paths, scores = batched_viterbi_decode(clear_logits, lengths, self.transitions)
+        tags = torch.full_like(input_ids, self.pad_tag).index_put((rows, word_columns), paths[rows, columns])
+        return tags, scores
+
+
+def export_model(model, example_inputs, export_file, use_token_type_ids=False, metadata=None):
+    """ Exports the CRF model `model` (`BertLstmCrf` without the LSTM) to the TorchScript file `export_file`.
+
+        `example_inputs` are (input_ids, attention_mask, token_type_ids) used to trace the encoder. `metadata` is
+        a json-serializable dict stored in the file (the labels, the model type, ...).
+    """
+    if model.lstm is not None:
+        raise ValueError("Only the models without the LSTM can be exported (rnn_layers=0)")
+    model = model.to("cpu").eval()
+    example_inputs = tuple(tensor.to("cpu") for tensor in example_inputs)
+    with torch.no_grad():
+        emissions = torch.jit.trace(EncoderEmissions(model.bert_encoder, use_token_type_ids), example_inputs,
+                                    check_trace=False)
+    transitions = model.crf._augmented_transitions(torch.device("cpu")).clone()
+    tagger = torch.jit.script(ExportedSpanTagger(emissions, transitions))
+    extra_files = {METADATA_FILE: json.dumps(metadata or {})}
+    torch.jit.save(tagger, export_file, _extra_files=extra_files)
+    logger.info("Saved the exported model to %s", export_file)
+    return tagger
+
+
+def load_exported_model(export_file):
+    """ Loads an exported model on the CPU, returns the model and its metadata. The model is called with the
+        (input_ids, attention_mask, token_type_ids, word_mask) tensors of a batch and returns the (batch_size,
+        seq_length) tags, -100 out of the word positions, and the scores of the paths.
+    """
+    extra_files = {METADATA_FILE: ""}
+    tagger = torch.jit.load(export_file, map_location="cpu", _extra_files=extra_files)
+    tagger.eval()
+    for parameter in tagger.parameters():
+        parameter.requires_grad_(False)
+    return tagger, json.loads(extra_files[METADATA_FILE] or "{}")
+
+
+def check_parity(model, exported_model, batches, use_token_type_ids=False):
+    """ Runs the eager `model` and the exported one on `batches` of (input_ids, attention_mask, token_type_ids,
+        label_ids) tensors and returns the number of words and the number of words whose tags differ.
+    """
+    model = model.to("cpu").eval()
+    num_words, num_mismatches = 0, 0
+    with torch.no_grad():
+        for input_ids, attention_mask, token_type_ids, label_ids in batches:
+            inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "labels": label_ids}
+            if use_token_type_ids:
+                inputs["token_type_ids"] = token_type_ids
+            eager_tags = torch.as_tensor(np.array(model(**inputs)[2]))
+            is_word = label_ids != -100
+            tags, _ = exported_model(input_ids, attention_mask, token_type_ids, is_word.long())
+            num_words += int(is_word.sum())
+            num_mismatches += int((tags[is_word] != eager_tags[is_word]).sum())
+    return num_words, num_mismatches
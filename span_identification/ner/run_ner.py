@@ -35,7 +35,11 @@ from torch.nn import CrossEntropyLoss
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
-from .utils_ner import convert_examples_to_features, get_labels, read_examples_from_file
+from .utils_ner import convert_examples_to_features, get_labels, read_examples_from_file, merge_window_predictions
+from .utils_ner import features_cache_key, features_to_arrays, save_features_cache, load_features_cache
+from .utils_ner import get_fast_tokenizer
+from mixed_precision import autocast, autocast_dtype, check_mixed_precision, get_grad_scaler
+from quantization import load_quantized_model, model_signature, quantization_report, write_report
 
 from transformers import AdamW, get_linear_schedule_with_warmup
 from transformers import WEIGHTS_NAME, BertConfig, BertForTokenClassification, BertTokenizer
@@ -94,18 +98,14 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
     ]
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=t_total)
-    if args.fp16:
-        try:
-            from apex import amp
-        except ImportError:
-            raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
-        model, optimizer = amp.initialize(model, optimizer, opt_level=args.fp16_opt_level)
-
-    # multi-gpu training (should be after apex fp16 initialization)
+    # the loss is scaled with fp16 on a GPU only
+    scaler = get_grad_scaler(args)
+
+    # multi-gpu training
     if args.n_gpu > 1:
         model = torch.nn.DataParallel(model)
 
-    # Distributed training (should be after apex fp16 initialization)
+    # Distributed training
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
                                                           output_device=args.local_rank,
@@ -131,7 +131,7 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
         epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0], position=0, leave=True)
         for step, batch in enumerate(epoch_iterator):
             model.train()
-            batch = tuple(t.to(args.device) for t in batch)
+            batch = tuple(t.to(args.device).long() for t in batch)
             inputs = {"input_ids": batch[0],
                       "attention_mask": batch[1],
                       "labels": batch[3]}
@@ -139,7 +139,8 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
                 inputs["token_type_ids"] = batch[2] if args.model_type in ["bert", "xlnet"] else None  # XLM and RoBERTa don"t use segment_ids
             if args.use_quotes:
                 inputs['quotes'] = batch[4]
-            outputs = model(**inputs)
+            with autocast(args):
+                outputs = model(**inputs)
             loss = outputs[0]  # model outputs are always tuple in pytorch-transformers (see doc)
 
             if args.n_gpu > 1:
@@ -147,21 +148,23 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
 
-            if args.fp16:
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
+            if scaler is not None:
+                scaler.scale(loss).backward()
             else:
                 loss.backward()
 
             tr_loss += loss.item()
             if (step + 1) % args.gradient_accumulation_steps == 0:
-                if args.fp16:
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-                else:
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                if scaler is not None:
+                    scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
 
                 scheduler.step()  # Update learning rate schedule
-                optimizer.step()
+                if scaler is not None:
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    optimizer.step()
                 model.zero_grad()
                 global_step += 1
 
@@ -199,7 +202,7 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
 
 
 def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""):
-    eval_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode=mode)
+    eval_dataset, eval_segments = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode=mode)
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
@@ -220,9 +223,9 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
     out_label_ids = None
     model.eval()
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
-        batch = tuple(t.to(args.device) for t in batch)
+        batch = tuple(t.to(args.device).long() for t in batch)
 
-        with torch.no_grad():
+        with torch.no_grad(), autocast(args):
             inputs = {"input_ids": batch[0],
                       "attention_mask": batch[1],
                       "labels": batch[3]}
@@ -239,10 +242,10 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
             eval_loss += tmp_eval_loss.item()
         nb_eval_steps += 1
         if preds is None:
-            preds = logits.detach().cpu().numpy()
+            preds = logits.detach().float().cpu().numpy()
             out_label_ids = inputs["labels"].detach().cpu().numpy()
         else:
-            preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
+            preds = np.append(preds, logits.detach().float().cpu().numpy(), axis=0)
             out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
 
     eval_loss = eval_loss / nb_eval_steps
@@ -263,6 +266,12 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
                 else:
                     preds_list[i].append('O')
 
+    # sequences may hold windows of long sentences or several packed sentences, the metrics and the
+    # predictions are computed for the original sentences
+    num_examples = eval_segments[-1][-1][0] + 1 if eval_segments else 0
+    out_label_list = merge_window_predictions(eval_segments, out_label_list, num_examples, args.window_overlap_rule)
+    preds_list = merge_window_predictions(eval_segments, preds_list, num_examples, args.window_overlap_rule)
+
     results = {
         "loss": eval_loss,
         "precision": precision_score(out_label_list, preds_list),
@@ -283,16 +292,22 @@ def load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode):
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
     # Load data features from cache or dataset file
-    cached_features_file = os.path.join(args.data_dir, "cached_{}_{}_{}".format(mode,
-        list(filter(None, args.model_name_or_path.split("/"))).pop(),
-        str(args.max_seq_length)))
-    if False and os.path.exists(cached_features_file) and not args.overwrite_cache:
-        logger.info("Loading features from cached file %s", cached_features_file)
-        features = torch.load(cached_features_file)
+    files = {'train': args.train_file, 'dev': args.dev_file, 'test': args.test_file}
+    file_path = os.path.join(args.data_dir, files[mode])
+    cache_key = features_cache_key(file_path, tokenizer, labels, args.max_seq_length, args.model_type,
+                                   pad_token_label_id=pad_token_label_id, window_stride=args.window_stride,
+                                   pack=args.pack_sentences, use_quotes=args.use_quotes)
+    cached_features_dir = os.path.join(args.data_dir, "cached_features", "{}_{}".format(mode, cache_key))
+    if os.path.exists(cached_features_dir) and not args.overwrite_cache:
+        logger.info("Loading features from cached dir %s", cached_features_dir)
+        arrays, segments = load_features_cache(cached_features_dir)
     else:
         logger.info("Creating features from dataset file at %s", args.data_dir)
-        files = {'train': args.train_file, 'dev': args.dev_file, 'test': args.test_file}
-        examples = read_examples_from_file(os.path.join(args.data_dir, files[mode]), mode)
+        examples = read_examples_from_file(file_path, mode)
+        fast_tokenizer = get_fast_tokenizer(tokenizer) if args.fast_tokenizer else None
+        if args.fast_tokenizer and fast_tokenizer is None:
+            logger.warning("No fast tokenizer available for %s, falling back to the python one",
+                           type(tokenizer).__name__)
         features = convert_examples_to_features(examples, labels, args.max_seq_length, tokenizer,
                                                 cls_token_at_end=bool(args.model_type in ["xlnet"]),
                                                 # xlnet has a cls token at the end
@@ -305,15 +320,18 @@ def load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode):
                                                 # pad on the left for xlnet
                                                 pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
                                                 pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
-                                                pad_token_label_id=pad_token_label_id
+                                                pad_token_label_id=pad_token_label_id,
+                                                window_stride=args.window_stride,
+                                                pack=args.pack_sentences,
+                                                fast_tokenizer=fast_tokenizer
                                                 )
         if args.use_quotes:
-            assert len(features) == len(examples)            
             for i in range(len(features)):
                 tokens = []
-                for word in examples[i].words:
-                    word_tokens = tokenizer.tokenize(word)
-                    tokens.extend(word_tokens)
+                for example_index, word_start, word_end in features[i].segments:
+                    for word in examples[example_index].words[word_start:word_end]:
+                        word_tokens = tokenizer.tokenize(word)
+                        tokens.extend(word_tokens)
                 tokens = ['cls_token'] + tokens
                 quotes = np.zeros(args.max_seq_length, dtype=np.float32)
                 for j in range(1, min(len(tokens), args.max_seq_length)):
@@ -321,24 +339,27 @@ def load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode):
                         quotes[j] = 1
                 features[i].quotes = quotes[:, None]
                 
+        arrays, segments = features_to_arrays(features)
+        if args.use_quotes:
+            arrays["quotes"] = np.array([f.quotes for f in features], dtype=np.int8)
         if args.local_rank in [-1, 0]:
-            logger.info("Saving features into cached file %s", cached_features_file)
-            torch.save(features, cached_features_file)
+            logger.info("Saving features into cached dir %s", cached_features_dir)
+            save_features_cache(cached_features_dir, arrays, segments)
 
     if args.local_rank == 0 and not evaluate:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_ids for f in features], dtype=torch.long)
+    # Build dataset from the (memory mapped) arrays, the batches are converted to long on the fly
+    all_input_ids = torch.from_numpy(arrays["input_ids"])
+    all_input_mask = torch.from_numpy(arrays["input_mask"])
+    all_segment_ids = torch.from_numpy(arrays["segment_ids"])
+    all_label_ids = torch.from_numpy(arrays["label_ids"])
     if args.use_quotes:
-        all_quotes = torch.tensor([f.quotes for f in features], dtype=torch.long)
+        all_quotes = torch.from_numpy(arrays["quotes"])
         dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids, all_quotes)
     else:
         dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
-    return dataset
+    return dataset, segments
 
 
 def transformers_ner(args):
@@ -371,8 +392,9 @@ def transformers_ner(args):
     logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
                         datefmt="%m/%d/%Y %H:%M:%S",
                         level=logging.INFO if args.local_rank in [-1, 0] else logging.WARN)
-    logger.warning("Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
-                   args.local_rank, device, args.n_gpu, bool(args.local_rank != -1), args.fp16)
+    logger.warning("Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, mixed precision: %s",
+                   args.local_rank, device, args.n_gpu, bool(args.local_rank != -1), autocast_dtype(args))
+    check_mixed_precision(args)
 
     # Set seed
     set_seed(args)
@@ -411,7 +433,7 @@ def transformers_ner(args):
 
     # Training
     if args.do_train:
-        train_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode="train")
+        train_dataset, _ = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode="train")
         global_step, tr_loss = train(args, train_dataset, model, tokenizer, labels, pad_token_label_id)
         logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
 
@@ -433,6 +455,11 @@ def transformers_ner(args):
         # Good practice: save your training arguments together with the trained model
         torch.save(args, os.path.join(args.output_dir, "training_args.bin"))
 
+    if args.quantize and (args.do_eval or args.do_predict):
+        # dynamically quantized models only run on the CPU, in int8 and fp32
+        args.device, args.n_gpu = torch.device("cpu"), 0
+        args.fp16 = args.bf16 = False
+
     # Evaluation
     results = {}
     if args.do_eval and args.local_rank in [-1, 0]:
@@ -447,7 +474,17 @@ def transformers_ner(args):
             
             model = model_class.from_pretrained(checkpoint)
             model.to(args.device)
-            result, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev", prefix=global_step)
+            if args.quantize:
+                # compare the quantized model with the fp32 one on the dev set
+                quantized_model = load_quantized_model(lambda: model, os.path.join(checkpoint, WEIGHTS_NAME),
+                                                       model_signature(model_class, model.config))
+                eval_dataset, _ = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode="dev")
+                result = quantization_report(
+                    lambda m: evaluate(args, m, tokenizer, labels, pad_token_label_id, mode="dev", prefix=global_step)[0],
+                    model, quantized_model, len(eval_dataset), args.per_gpu_eval_batch_size)
+                write_report(result, os.path.join(checkpoint, "quantization_results.txt"))
+            else:
+                result, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev", prefix=global_step)
             if global_step:
                 result = {"{}_{}".format(global_step, k): v for k, v in result.items()}
             results.update(result)
@@ -466,7 +503,13 @@ def transformers_ner(args):
         for checkpoint in checkpoints:
             global_step = checkpoint.split("-")[-1] if len(checkpoints) > 1 else ""
             
-            model = model_class.from_pretrained(checkpoint)
+            if args.quantize:
+                # the fp32 model is not even built when the quantized one is cached
+                model = load_quantized_model(lambda: model_class.from_pretrained(checkpoint),
+                                             os.path.join(checkpoint, WEIGHTS_NAME),
+                                             model_signature(model_class, config_class.from_pretrained(checkpoint)))
+            else:
+                model = model_class.from_pretrained(checkpoint)
             model.to(args.device)
             result, predictions = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="test")
             if global_step:
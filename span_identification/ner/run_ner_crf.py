@@ -22,6 +22,7 @@ import glob
 import logging
 import os
 import random
+from functools import partial
 
 import pickle
 import numpy as np
@@ -33,8 +34,14 @@ from torch.nn import CrossEntropyLoss
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
-from .utils_ner import convert_examples_to_features, get_labels, read_examples_from_file
+from .utils_ner import convert_examples_to_features, get_labels, read_examples_from_file, merge_window_predictions
+from .utils_ner import features_cache_key, features_to_arrays, save_features_cache, load_features_cache
+from .utils_ner import get_fast_tokenizer, SEQUENCE_FIELDS
 from .bert_lstm_crf import BertLstmCrf
+from .export import export_model, check_parity
+from batching import BucketBatchSampler, restore_order, trim_collate
+from mixed_precision import autocast, autocast_dtype, check_mixed_precision, get_grad_scaler
+from quantization import load_quantized_model, model_signature, quantization_report, write_report
 
 from transformers import AdamW, get_linear_schedule_with_warmup
 from transformers import WEIGHTS_NAME, BertConfig, BertForTokenClassification, BertTokenizer
@@ -73,8 +80,15 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
         tb_writer = SummaryWriter()
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    collate_fn = partial(trim_collate, sequence_fields=SEQUENCE_FIELDS,
+                         pad_on_left=bool(args.model_type in ["xlnet"]))
+    if args.bucket_by_length and args.local_rank == -1:
+        train_sampler = BucketBatchSampler(train_dataset.tensors[1].sum(dim=1).numpy(), args.train_batch_size)
+        train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=collate_fn)
+    else:
+        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size,
+                                      collate_fn=collate_fn)
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -91,18 +105,14 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
     ]
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=t_total)
-    if args.fp16:
-        try:
-            from apex import amp
-        except ImportError:
-            raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
-        model, optimizer = amp.initialize(model, optimizer, opt_level=args.fp16_opt_level)
-
-    # multi-gpu training (should be after apex fp16 initialization)
+    # the loss is scaled with fp16 on a GPU only
+    scaler = get_grad_scaler(args)
+
+    # multi-gpu training
     if args.n_gpu > 1:
         model = torch.nn.DataParallel(model)
 
-    # Distributed training (should be after apex fp16 initialization)
+    # Distributed training
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
                                                           output_device=args.local_rank,
@@ -128,14 +138,15 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
         epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0], position=0, leave=True)
         for step, batch in enumerate(epoch_iterator):
             model.train()
-            batch = tuple(t.to(args.device) for t in batch)
+            batch = tuple(t.to(args.device).long() for t in batch)
             inputs = {"input_ids": batch[0],
                       "attention_mask": batch[1],
                       "labels": batch[3]}
             if args.model_type != "distilbert":
                 inputs["token_type_ids"] = batch[2] if args.model_type in ["bert", "xlnet"] else None  # XLM and RoBERTa don"t use segment_ids
 
-            outputs = model(**inputs)
+            with autocast(args):
+                outputs = model(**inputs)
             loss = outputs[0]  # model outputs are always tuple in pytorch-transformers (see doc)
 
             if args.n_gpu > 1:
@@ -143,28 +154,30 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
 
-            if args.fp16:
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
+            if scaler is not None:
+                scaler.scale(loss).backward()
             else:
                 loss.backward()
 
             tr_loss += loss.item()
             if (step + 1) % args.gradient_accumulation_steps == 0:
-                if args.fp16:
-                    torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
-                else:
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                if scaler is not None:
+                    scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
 
                 scheduler.step()  # Update learning rate schedule
-                optimizer.step()
+                if scaler is not None:
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    optimizer.step()
                 model.zero_grad()
                 global_step += 1
 
                 if args.local_rank in [-1, 0] and args.logging_steps > 0 and global_step % args.logging_steps == 0:
                     # Log metrics
                     if args.local_rank == -1 and args.evaluate_during_training:  # Only evaluate when single GPU otherwise metrics may not average well
-                        results, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev")
+                        results, _, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev")
                         for key, value in results.items():
                             tb_writer.add_scalar("eval_{}".format(key), value, global_step)
                     tb_writer.add_scalar("lr", scheduler.get_lr()[0], global_step)
@@ -196,13 +209,25 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id):
     return global_step, tr_loss / global_step
 
 
-def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""):
-    eval_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode=mode)
+def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix="", return_probabilities=False):
+    """ Returns the metrics, the predicted labels of the words and, with `return_probabilities`, the probabilities
+        of the words to be inside a span (None otherwise), which cost a forward-backward pass of the CRF.
+    """
+    eval_dataset, eval_segments = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode=mode)
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-    # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    collate_fn = partial(trim_collate, sequence_fields=SEQUENCE_FIELDS,
+                         pad_on_left=bool(args.model_type in ["xlnet"]))
+    if args.local_rank == -1:
+        # sequences of similar lengths are evaluated together, the predictions are put back in order below
+        eval_sampler = BucketBatchSampler(eval_dataset.tensors[1].sum(dim=1).numpy(), args.eval_batch_size,
+                                          shuffle=False)
+        eval_dataloader = DataLoader(eval_dataset, batch_sampler=eval_sampler, collate_fn=collate_fn)
+    else:
+        # Note that DistributedSampler samples randomly
+        eval_sampler = DistributedSampler(eval_dataset)
+        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size,
+                                     collate_fn=collate_fn)
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -214,50 +239,68 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
     logger.info("  Batch size = %d", args.eval_batch_size)
     eval_loss = 0.0
     nb_eval_steps = 0
-    preds = None
-    out_label_ids = None
+    preds = []
+    span_probabilities = []
+    out_label_ids = []
     model.eval()
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
-        batch = tuple(t.to(args.device) for t in batch)
+        batch = tuple(t.to(args.device).long() for t in batch)
 
-        with torch.no_grad():
+        with torch.no_grad(), autocast(args):
             inputs = {"input_ids": batch[0],
                       "attention_mask": batch[1],
-                      "labels": batch[3]}
+                      "labels": batch[3],
+                      "return_probabilities": return_probabilities}
             if args.model_type != "distilbert":
                 inputs["token_type_ids"] = batch[2] if args.model_type in ["bert", "xlnet"] else None  # XLM and RoBERTa don"t use segment_ids
             outputs = model(**inputs)
-            tmp_eval_loss, logits, predicted_tags = outputs
+            tmp_eval_loss, logits, predicted_tags = outputs[:3]
 
             if args.n_gpu > 1:
                 tmp_eval_loss = tmp_eval_loss.mean()  # mean() to average on multi-gpu parallel evaluating
 
             eval_loss += tmp_eval_loss.item()
         nb_eval_steps += 1
-        if preds is None:
-            #preds = logits.detach().cpu().numpy()
-            preds = predicted_tags
-            out_label_ids = inputs["labels"].detach().cpu().numpy()
-        else:
-            #preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-            preds.extend(predicted_tags)
-            out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
+        # batches are padded to different lengths, so the rows are kept separately
+        preds.extend(predicted_tags)
+        if return_probabilities:
+            span_probabilities.extend(outputs[3])
+        out_label_ids.extend(inputs["labels"].detach().cpu().numpy())
 
     eval_loss = eval_loss / nb_eval_steps
+    if isinstance(eval_sampler, BucketBatchSampler):
+        preds = restore_order(preds, eval_sampler.order)
+        if return_probabilities:
+            span_probabilities = restore_order(span_probabilities, eval_sampler.order)
+        out_label_ids = restore_order(out_label_ids, eval_sampler.order)
     #preds_logits = softmax(preds, axis=2)
     #preds = np.argmax(preds, axis=2)
 
     label_map = {i: label for i, label in enumerate(labels)}
 
-    out_label_list = [[] for _ in range(out_label_ids.shape[0])]
-    preds_list = [[] for _ in range(out_label_ids.shape[0])]
+    out_label_list = [[] for _ in range(len(out_label_ids))]
+    preds_list = [[] for _ in range(len(out_label_ids))]
+    probabilities_list = [[] for _ in range(len(out_label_ids))]
 
-    for i in range(out_label_ids.shape[0]):
-        for j in range(out_label_ids.shape[1]):
-            if out_label_ids[i, j] != pad_token_label_id:
+    for i in range(len(out_label_ids)):
+        for j in range(len(out_label_ids[i])):
+            if out_label_ids[i][j] != pad_token_label_id:
                 out_label_list[i].append(label_map[out_label_ids[i][j]])
                 preds_list[i].append(label_map[preds[i][j]])
+                if return_probabilities:
+                    probabilities_list[i].append(float(span_probabilities[i][j]))
     
+    # sequences may hold windows of long sentences or several packed sentences, the metrics and the
+    # predictions are computed for the original sentences
+    num_examples = eval_segments[-1][-1][0] + 1 if eval_segments else 0
+    out_label_list = merge_window_predictions(eval_segments, out_label_list, num_examples, args.window_overlap_rule)
+    preds_list = merge_window_predictions(eval_segments, preds_list, num_examples, args.window_overlap_rule)
+    if return_probabilities:
+        probabilities_list = merge_window_predictions(eval_segments, probabilities_list, num_examples,
+                                                      args.window_overlap_rule)
+    else:
+        probabilities_list = None
+
     results = {
         "loss": eval_loss,
         "precision": precision_score(out_label_list, preds_list),
@@ -270,7 +313,7 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
     for key in sorted(results.keys()):
         logger.info("  %s = %s", key, str(results[key]))
 
-    return results, preds_list
+    return results, preds_list, probabilities_list
 
 
 def load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode):
@@ -278,16 +321,22 @@ def load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode):
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
     # Load data features from cache or dataset file
-    cached_features_file = os.path.join(args.data_dir, "cached_{}_{}_{}".format(mode,
-        list(filter(None, args.model_name_or_path.split("/"))).pop(),
-        str(args.max_seq_length)))
-    if False and os.path.exists(cached_features_file) and not args.overwrite_cache:
-        logger.info("Loading features from cached file %s", cached_features_file)
-        features = torch.load(cached_features_file)
+    files = {'train': args.train_file, 'dev': args.dev_file, 'test': args.test_file}
+    file_path = os.path.join(args.data_dir, files[mode])
+    cache_key = features_cache_key(file_path, tokenizer, labels, args.max_seq_length, args.model_type,
+                                   pad_token_label_id=pad_token_label_id, window_stride=args.window_stride,
+                                   pack=args.pack_sentences)
+    cached_features_dir = os.path.join(args.data_dir, "cached_features", "{}_{}".format(mode, cache_key))
+    if os.path.exists(cached_features_dir) and not args.overwrite_cache:
+        logger.info("Loading features from cached dir %s", cached_features_dir)
+        arrays, segments = load_features_cache(cached_features_dir)
     else:
         logger.info("Creating features from dataset file at %s", args.data_dir)
-        files = {'train': args.train_file, 'dev': args.dev_file, 'test': args.test_file}
-        examples = read_examples_from_file(os.path.join(args.data_dir, files[mode]), mode)
+        examples = read_examples_from_file(file_path, mode)
+        fast_tokenizer = get_fast_tokenizer(tokenizer) if args.fast_tokenizer else None
+        if args.fast_tokenizer and fast_tokenizer is None:
+            logger.warning("No fast tokenizer available for %s, falling back to the python one",
+                           type(tokenizer).__name__)
         features = convert_examples_to_features(examples, labels, args.max_seq_length, tokenizer,
                                                 cls_token_at_end=bool(args.model_type in ["xlnet"]),
                                                 # xlnet has a cls token at the end
@@ -300,23 +349,27 @@ def load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode):
                                                 # pad on the left for xlnet
                                                 pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
                                                 pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
-                                                pad_token_label_id=pad_token_label_id
+                                                pad_token_label_id=pad_token_label_id,
+                                                window_stride=args.window_stride,
+                                                pack=args.pack_sentences,
+                                                fast_tokenizer=fast_tokenizer
                                                 )
+        arrays, segments = features_to_arrays(features)
         if args.local_rank in [-1, 0]:
-            logger.info("Saving features into cached file %s", cached_features_file)
-            torch.save(features, cached_features_file)
+            logger.info("Saving features into cached dir %s", cached_features_dir)
+            save_features_cache(cached_features_dir, arrays, segments)
 
     if args.local_rank == 0 and not evaluate:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_ids for f in features], dtype=torch.long)
+    # Build dataset from the (memory mapped) arrays, the batches are converted to long on the fly
+    all_input_ids = torch.from_numpy(arrays["input_ids"])
+    all_input_mask = torch.from_numpy(arrays["input_mask"])
+    all_segment_ids = torch.from_numpy(arrays["segment_ids"])
+    all_label_ids = torch.from_numpy(arrays["label_ids"])
 
     dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
-    return dataset
+    return dataset, segments
 
 
 def transformers_ner_crf(args):
@@ -349,8 +402,9 @@ def transformers_ner_crf(args):
     logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
                         datefmt="%m/%d/%Y %H:%M:%S",
                         level=logging.INFO if args.local_rank in [-1, 0] else logging.WARN)
-    logger.warning("Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
-                   args.local_rank, device, args.n_gpu, bool(args.local_rank != -1), args.fp16)
+    logger.warning("Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, mixed precision: %s",
+                   args.local_rank, device, args.n_gpu, bool(args.local_rank != -1), autocast_dtype(args))
+    check_mixed_precision(args)
 
     # Set seed
     set_seed(args)
@@ -385,7 +439,7 @@ def transformers_ner_crf(args):
         num_labels=num_labels,
         embedding_dim=config.hidden_size,
         hidden_dim=int(config.hidden_size / 2),
-        rnn_layers=0,
+        rnn_layers=args.rnn_layers,
         rnn_dropout=config.hidden_dropout_prob,
         output_dropout=config.hidden_dropout_prob,
         use_cuda=True
@@ -400,7 +454,7 @@ def transformers_ner_crf(args):
 
     # Training
     if args.do_train:
-        train_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode="train")
+        train_dataset, _ = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode="train")
         global_step, tr_loss = train(args, train_dataset, model, tokenizer, labels, pad_token_label_id)
         logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
 
@@ -422,6 +476,11 @@ def transformers_ner_crf(args):
         # Good practice: save your training arguments together with the trained model
         torch.save(args, os.path.join(args.output_dir, "training_args.bin"))
 
+    if args.quantize and (args.do_eval or args.do_predict):
+        # dynamically quantized models only run on the CPU, in int8 and fp32
+        args.device, args.n_gpu = torch.device("cpu"), 0
+        args.fp16 = args.bf16 = False
+
     # Evaluation
     results = {}
     if args.do_eval and args.local_rank in [-1, 0]:
@@ -441,7 +500,7 @@ def transformers_ner_crf(args):
                 num_labels=num_labels,
                 embedding_dim=config.hidden_size,
                 hidden_dim=int(config.hidden_size / 2),
-                rnn_layers=0,
+                rnn_layers=args.rnn_layers,
                 rnn_dropout=config.hidden_dropout_prob,
                 output_dropout=config.hidden_dropout_prob,
                 use_cuda=True
@@ -453,7 +512,18 @@ def transformers_ner_crf(args):
             
             # model = model_class.from_pretrained(checkpoint)
             model.to(args.device)
-            result, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev", prefix=global_step)
+            if args.quantize:
+                # compare the quantized model with the fp32 one on the dev set
+                quantized_model = load_quantized_model(
+                    lambda: model, checkpoint, model_signature(BertLstmCrf, config, encoder=model_class.__name__,
+                                                               rnn_layers=args.rnn_layers))
+                eval_dataset, _ = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode="dev")
+                result = quantization_report(
+                    lambda m: evaluate(args, m, tokenizer, labels, pad_token_label_id, mode="dev", prefix=global_step)[0],
+                    model, quantized_model, len(eval_dataset), args.per_gpu_eval_batch_size)
+                write_report(result, os.path.join(os.path.dirname(checkpoint), "quantization_results.txt"))
+            else:
+                result, _, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev", prefix=global_step)
             if global_step:
                 result = {"{}_{}".format(global_step, k): v for k, v in result.items()}
             results.update(result)
@@ -470,29 +540,40 @@ def transformers_ner_crf(args):
             logging.getLogger("pytorch_transformers.modeling_utils").setLevel(logging.WARN)  # Reduce logging
         logger.info("Evaluate the following checkpoints: %s", checkpoints)
         for checkp in checkpoints:
-            model = BertLstmCrf(
-                bert_model,
-                num_labels=num_labels,
-                embedding_dim=config.hidden_size,
-                hidden_dim=int(config.hidden_size / 2),
-                rnn_layers=0,
-                rnn_dropout=config.hidden_dropout_prob,
-                output_dropout=config.hidden_dropout_prob,
-                use_cuda=True
-            )
             checkpoint = os.path.join(checkp, WEIGHTS_NAME)
-            state_dict = torch.load(checkpoint)
-            model.load_state_dict(state_dict)
 
+            def load_model():
+                model = BertLstmCrf(
+                    bert_model,
+                    num_labels=num_labels,
+                    embedding_dim=config.hidden_size,
+                    hidden_dim=int(config.hidden_size / 2),
+                    rnn_layers=args.rnn_layers,
+                    rnn_dropout=config.hidden_dropout_prob,
+                    output_dropout=config.hidden_dropout_prob,
+                    use_cuda=True
+                )
+                state_dict = torch.load(checkpoint)
+                model.load_state_dict(state_dict)
+                return model
+
+            # the fp32 model is not even built when the quantized one is cached
+            if args.quantize:
+                model = load_quantized_model(load_model, checkpoint, model_signature(
+                    BertLstmCrf, config, encoder=model_class.__name__, rnn_layers=args.rnn_layers))
+            else:
+                model = load_model()
             model.to(args.device)
-            result, predictions = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="test")
+            # the span probabilities are only needed for the confidences of the submitted spans
+            result, predictions, probabilities = evaluate(args, model, tokenizer, labels, pad_token_label_id,
+                                                          mode="test", return_probabilities=bool(args.confidence_file))
 
             # Save results
             output_test_results_file = os.path.join(checkp, "test_results.txt")
             with open(output_test_results_file, "w") as writer:
                 for key in sorted(result.keys()):
                     writer.write("{} = {}\n".format(key, str(result[key])))
-            # Save predictions
+            # Save predictions, with the probability of every word to be inside a span in the third column if any
             output_test_predictions_file = os.path.join(checkp, "test_predictions.txt")
             with open(output_test_predictions_file, "w") as writer:
                 with open(os.path.join(args.data_dir, args.test_file), "r") as f:
@@ -503,10 +584,44 @@ def transformers_ner_crf(args):
                             if not predictions[example_id]:
                                 example_id += 1
                         elif predictions[example_id]:
-                            output_line = line.split('\t')[0] + "\t" + predictions[example_id].pop(0) + "\n"
-                            writer.write(output_line)
+                            output_line = "{}\t{}".format(line.split('\t')[0], predictions[example_id].pop(0))
+                            if probabilities is not None:
+                                output_line += "\t{:.6f}".format(probabilities[example_id].pop(0))
+                            writer.write(output_line + "\n")
                         else:
                             logger.warning("Maximum sequence length exceeded: No prediction for '%s'.", line.split()[0])
 
+    if args.export_model and args.local_rank in [-1, 0]:
+        tokenizer = tokenizer_class.from_pretrained(args.output_dir, do_lower_case=args.do_lower_case)
+        model = BertLstmCrf(
+            bert_model,
+            num_labels=num_labels,
+            embedding_dim=config.hidden_size,
+            hidden_dim=int(config.hidden_size / 2),
+            rnn_layers=args.rnn_layers,
+            rnn_dropout=config.hidden_dropout_prob,
+            output_dropout=config.hidden_dropout_prob,
+            use_cuda=True
+        )
+        model.load_state_dict(torch.load(os.path.join(args.output_dir, WEIGHTS_NAME), map_location="cpu"))
+        export_file = args.export_file if args.export_file else os.path.join(args.output_dir, "exported_model.pt")
+        use_token_type_ids = args.model_type in ["bert", "xlnet"]
+        # the exported tags are checked against the eager model on the first dev batches
+        dataset, _ = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode="dev")
+        collate_fn = partial(trim_collate, sequence_fields=SEQUENCE_FIELDS,
+                         pad_on_left=bool(args.model_type in ["xlnet"]))
+        dataloader = DataLoader(dataset, batch_size=args.per_gpu_eval_batch_size, collate_fn=collate_fn)
+        batches = [tuple(t.long() for t in batch) for batch, _ in zip(dataloader, range(args.export_check_batches))]
+        exported_model = export_model(model, batches[0][:3], export_file, use_token_type_ids,
+                                      metadata={"labels": labels, "model_type": args.model_type,
+                                                "max_seq_length": args.max_seq_length,
+                                                "use_token_type_ids": use_token_type_ids})
+        num_words, num_mismatches = check_parity(model, exported_model, batches, use_token_type_ids)
+        if num_mismatches:
+            raise RuntimeError("The exported model predicts %d of %d words differently from the checkpoint"
+                               % (num_mismatches, num_words))
+        logger.info("The exported model predicts the %d words of %d dev batches as the checkpoint",
+                    num_words, len(batches))
+
     return results
 
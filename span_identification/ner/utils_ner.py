@@ -17,10 +17,21 @@
 
 from __future__ import absolute_import, division, print_function
 
+import hashlib
 import logging
 import os
+import shutil
+import weakref
+from functools import lru_cache
 from io import open
 
+import numpy as np
+
+try:
+    from tokenizers import BertWordPieceTokenizer, ByteLevelBPETokenizer
+except ImportError:
+    BertWordPieceTokenizer, ByteLevelBPETokenizer = (None, None)
+
 logger = logging.getLogger(__name__)
 
 
@@ -44,11 +55,13 @@ class InputExample(object):
 class InputFeatures(object):
     """A single set of features of data."""
 
-    def __init__(self, input_ids, input_mask, segment_ids, label_ids):
+    def __init__(self, input_ids, input_mask, segment_ids, label_ids, segments=None):
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.segment_ids = segment_ids
         self.label_ids = label_ids
+        # (example_index, word_start, word_end) of every part of an example that the sequence contains
+        self.segments = segments
 
 
 def read_examples_from_file(file_path, mode):
@@ -81,6 +94,92 @@ def read_examples_from_file(file_path, mode):
     return examples
 
 
+def split_into_windows(word_lengths, max_tokens, stride):
+    """ Splits a sentence whose words have `word_lengths` sub-tokens into windows of at most `max_tokens`
+        sub-tokens (a single longer word makes a window of its own). A new window starts at the first word
+        `stride` sub-tokens after the start of the previous one, so the windows overlap if `stride` is smaller
+        than the window size. Returns the list of (word_start, word_end) of the windows.
+    """
+    word_offsets = np.concatenate([[0], np.cumsum(word_lengths)])
+    windows = []
+    start = 0
+    while True:
+        end = int(np.searchsorted(word_offsets, word_offsets[start] + max_tokens, side="right")) - 1
+        end = min(max(end, start + 1), len(word_lengths))
+        windows.append((start, end))
+        if end == len(word_lengths):
+            return windows
+        next_start = int(np.searchsorted(word_offsets, word_offsets[start] + stride, side="left"))
+        start = min(max(next_start, start + 1), end)
+
+
+def merge_window_predictions(segments, predictions, num_examples, rule="center"):
+    """ Merges the per-word predictions of the sequences back into one list per example.
+
+        `segments[i]` are the segments of the i-th sequence (see `InputFeatures.segments`) and `predictions[i]`
+        has an item for each word of these segments. A word covered by several windows takes the prediction
+        of the first window (`rule="first"`), of the last one (`rule="last"`) or of the window where it is
+        the farthest from the window edges (`rule="center"`). Truncated words are left out.
+    """
+    if rule not in ["first", "last", "center"]:
+        raise ValueError("Unknown window overlap rule '{}'".format(rule))
+    merged = [dict() for _ in range(num_examples)]
+    for sequence_index, (sequence_segments, sequence_predictions) in enumerate(zip(segments, predictions)):
+        sequence_predictions = iter(sequence_predictions)
+        for example_index, word_start, word_end in sequence_segments:
+            for word_index in range(word_start, word_end):
+                if rule == "first":
+                    score = -sequence_index
+                elif rule == "last":
+                    score = sequence_index
+                else:
+                    score = min(word_index - word_start, word_end - 1 - word_index)
+                prediction = next(sequence_predictions)
+                if word_index not in merged[example_index] or score > merged[example_index][word_index][0]:
+                    merged[example_index][word_index] = (score, prediction)
+    return [[example_predictions[j][1] for j in range(len(example_predictions))] for example_predictions in merged]
+
+
+def get_fast_tokenizer(tokenizer):
+    """ Builds a `tokenizers` (Rust) tokenizer with the vocabulary and the normalization of the python `tokenizer`,
+        which `encode_words` uses to tokenize whole lists of examples at once. Returns None if the `tokenizers`
+        library is not installed or if there is no fast counterpart for the tokenizer (only the byte-level BPE of
+        GPT-2/RoBERTa and the WordPiece of BERT are supported, without added tokens).
+    """
+    if ByteLevelBPETokenizer is None or getattr(tokenizer, "added_tokens_encoder", None):
+        return None
+    lowercase = bool(getattr(tokenizer, "init_kwargs", {}).get("do_lower_case", False))
+    if hasattr(tokenizer, "bpe_ranks") and hasattr(tokenizer, "encoder"):
+        merges = [pair for pair, _ in sorted(tokenizer.bpe_ranks.items(), key=lambda el: el[1])]
+        return ByteLevelBPETokenizer(dict(tokenizer.encoder), merges, add_prefix_space=False, lowercase=lowercase)
+    if hasattr(tokenizer, "wordpiece_tokenizer") and hasattr(tokenizer, "basic_tokenizer"):
+        return BertWordPieceTokenizer(dict(tokenizer.vocab),
+                                      unk_token=tokenizer.unk_token,
+                                      clean_text=True,
+                                      handle_chinese_chars=tokenizer.basic_tokenizer.tokenize_chinese_chars,
+                                      lowercase=tokenizer.basic_tokenizer.do_lower_case or lowercase,
+                                      wordpieces_prefix="##")
+    return None
+
+
+def encode_words(fast_tokenizer, examples_words, batch_size=1000):
+    """ Tokenizes the words of every example with `fast_tokenizer`, batch by batch of examples, and returns for every
+        example the list of the sub-token ids of each of its words (derived from the word ids of the encodings).
+    """
+    examples_word_ids = []
+    for batch_start in range(0, len(examples_words), batch_size):
+        # the python tokenizers strip the text around the special tokens, so surrounding whitespace is dropped as well
+        batch = [[word.strip() for word in words] for words in examples_words[batch_start: batch_start + batch_size]]
+        encodings = fast_tokenizer.encode_batch(batch, is_pretokenized=True, add_special_tokens=False)
+        for words, encoding in zip(batch, encodings):
+            word_ids = [[] for _ in words]
+            words_of_ids = encoding.word_ids if hasattr(encoding, "word_ids") else encoding.words
+            for token_id, word_index in zip(encoding.ids, words_of_ids):
+                word_ids[word_index].append(token_id)
+            examples_word_ids.append(word_ids)
+    return examples_word_ids
+
+
 def convert_examples_to_features(examples,
                                  label_list,
                                  max_seq_length,
@@ -95,34 +194,79 @@ def convert_examples_to_features(examples,
                                  pad_token_segment_id=0,
                                  pad_token_label_id=-1,
                                  sequence_a_segment_id=0,
-                                 mask_padding_with_zero=True):
+                                 mask_padding_with_zero=True,
+                                 window_stride=0,
+                                 pack=False,
+                                 fast_tokenizer=None):
     """ Loads a data file into a list of `InputBatch`s
         `cls_token_at_end` define the location of the CLS token:
             - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
             - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
         `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+        `window_stride` if > 0, the examples longer than `max_seq_length` are split into windows starting every
+            `window_stride` sub-tokens (see `split_into_windows`) instead of being truncated
+        `pack` if True, consecutive examples are put into the same sequence as long as they fit into it
+        `fast_tokenizer` if given (see `get_fast_tokenizer`), the words of all the examples are tokenized with it in
+            batches instead of one by one with `tokenizer`, the features are the same
     """
 
     label_map = {label: i for i, label in enumerate(label_list)}
+    # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
+    special_tokens_count = 3 if sep_token_extra else 2
+    max_tokens = max_seq_length - special_tokens_count
 
-    features = []
+    if fast_tokenizer is not None:
+        examples_word_ids = encode_words(fast_tokenizer, [example.words for example in examples])
+    else:
+        examples_word_ids = [[tokenizer.convert_tokens_to_ids(tokenizer.tokenize(word)) for word in example.words]
+                             for example in examples]
+
+    examples_label_ids = []
+    sequences = []
+    packed_length = None
     for (ex_index, example) in enumerate(examples):
-        if ex_index % 10000 == 0:
-            logger.info("Writing example %d of %d", ex_index, len(examples))
+        words_ids = examples_word_ids[ex_index]
+        # Use the real label id for the first token of the word, and padding ids for the remaining tokens
+        examples_label_ids.append([[label_map[label]] + [pad_token_label_id] * (len(word_ids) - 1)
+                                   for word_ids, label in zip(words_ids, example.labels)])
 
-        tokens = []
+        word_lengths = [len(word_ids) for word_ids in words_ids]
+        length = sum(word_lengths)
+        if length <= max_tokens or window_stride <= 0:
+            windows = [(0, len(words_ids))]
+        else:
+            windows = split_into_windows(word_lengths, max_tokens, window_stride)
+
+        if pack and length <= max_tokens and packed_length is not None and packed_length + length <= max_tokens:
+            sequences[-1].append((ex_index, 0, len(words_ids)))
+            packed_length += length
+            continue
+        packed_length = length if pack and length <= max_tokens else None
+        for word_start, word_end in windows:
+            sequences.append([(ex_index, word_start, word_end)])
+
+    cls_token_id, sep_token_id = tokenizer.convert_tokens_to_ids([cls_token, sep_token])
+
+    features = []
+    for (seq_index, segments) in enumerate(sequences):
+        if seq_index % 10000 == 0:
+            logger.info("Writing sequence %d of %d", seq_index, len(sequences))
+
+        input_ids = []
         label_ids = []
-        for word, label in zip(example.words, example.labels):
-            word_tokens = tokenizer.tokenize(word)
-            tokens.extend(word_tokens)
-            # Use the real label id for the first token of the word, and padding ids for the remaining tokens
-            label_ids.extend([label_map[label]] + [pad_token_label_id] * (len(word_tokens) - 1))
-
-        # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
-        special_tokens_count = 3 if sep_token_extra else 2
-        if len(tokens) > max_seq_length - special_tokens_count:
-            tokens = tokens[:(max_seq_length - special_tokens_count)]
-            label_ids = label_ids[:(max_seq_length - special_tokens_count)]
+        for example_index, word_start, word_end in segments:
+            for word_index in range(word_start, word_end):
+                input_ids.extend(examples_word_ids[example_index][word_index])
+                label_ids.extend(examples_label_ids[example_index][word_index])
+
+        if len(input_ids) > max_tokens:
+            # only a sequence with a single segment can be too long, its words starting after the cut are dropped
+            example_index, word_start, word_end = segments[0]
+            word_lengths = [len(word_ids) for word_ids in examples_word_ids[example_index][word_start:word_end]]
+            word_end = word_start + int(np.searchsorted(np.cumsum(word_lengths) - word_lengths, max_tokens))
+            segments = [(example_index, word_start, word_end)]
+            input_ids = input_ids[:max_tokens]
+            label_ids = label_ids[:max_tokens]
 
         # The convention in BERT is:
         # (a) For sequence pairs:
@@ -142,25 +286,23 @@ def convert_examples_to_features(examples,
         # For classification tasks, the first vector (corresponding to [CLS]) is
         # used as as the "sentence vector". Note that this only makes sense because
         # the entire model is fine-tuned.
-        tokens += [sep_token]
+        input_ids += [sep_token_id]
         label_ids += [pad_token_label_id]
         if sep_token_extra:
             # roberta uses an extra separator b/w pairs of sentences
-            tokens += [sep_token]
+            input_ids += [sep_token_id]
             label_ids += [pad_token_label_id]
-        segment_ids = [sequence_a_segment_id] * len(tokens)
+        segment_ids = [sequence_a_segment_id] * len(input_ids)
 
         if cls_token_at_end:
-            tokens += [cls_token]
+            input_ids += [cls_token_id]
             label_ids += [pad_token_label_id]
             segment_ids += [cls_token_segment_id]
         else:
-            tokens = [cls_token] + tokens
+            input_ids = [cls_token_id] + input_ids
             label_ids = [pad_token_label_id] + label_ids
             segment_ids = [cls_token_segment_id] + segment_ids
 
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
         # The mask has 1 for real tokens and 0 for padding tokens. Only real
         # tokens are attended to.
         input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
@@ -183,10 +325,10 @@ def convert_examples_to_features(examples,
         assert len(segment_ids) == max_seq_length
         assert len(label_ids) == max_seq_length
 
-        if ex_index < 5:
+        if seq_index < 5:
             logger.info("*** Example ***")
-            logger.info("guid: %s", example.guid)
-            logger.info("tokens: %s", " ".join([str(x) for x in tokens]))
+            logger.info("guid: %s", ", ".join(examples[example_index].guid for example_index, _, _ in segments))
+            logger.info("tokens: %s", " ".join([str(x) for x in tokenizer.convert_ids_to_tokens(input_ids)]))
             logger.info("input_ids: %s", " ".join([str(x) for x in input_ids]))
             logger.info("input_mask: %s", " ".join([str(x) for x in input_mask]))
             logger.info("segment_ids: %s", " ".join([str(x) for x in segment_ids]))
@@ -196,10 +338,103 @@ def convert_examples_to_features(examples,
                 InputFeatures(input_ids=input_ids,
                               input_mask=input_mask,
                               segment_ids=segment_ids,
-                              label_ids=label_ids))
+                              label_ids=label_ids,
+                              segments=segments))
     return features
 
 
+# bump when the layout of the cached features or the way they are computed changes
+FEATURES_CACHE_VERSION = 1
+FEATURES_CACHE_DTYPES = {"input_ids": np.int32, "input_mask": np.int8, "segment_ids": np.int8, "label_ids": np.int16}
+
+
+# fingerprints of the live tokenizers with their sizes, so that a tokenizer is hashed once per run
+_tokenizer_fingerprints = weakref.WeakKeyDictionary()
+
+
+def _hash_tokenizer(tokenizer):
+    sha1 = hashlib.sha1()
+    sha1.update(repr((type(tokenizer).__name__, getattr(tokenizer, "init_kwargs", {}).get("do_lower_case"),
+                      sorted(getattr(tokenizer, "added_tokens_encoder", {}).items()))).encode("utf-8"))
+    for token in tokenizer.convert_ids_to_tokens(list(range(len(tokenizer)))):
+        sha1.update(str(token).encode("utf-8") + b"\n")
+    return sha1.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    """ Identifies the tokenizer by its class, its lowercasing, its vocabulary and its added tokens. The vocabulary
+        is hashed once per tokenizer object, and again only if tokens are added to it.
+    """
+    size, fingerprint = _tokenizer_fingerprints.get(tokenizer, (None, None))
+    if size != len(tokenizer):
+        size, fingerprint = len(tokenizer), _hash_tokenizer(tokenizer)
+        _tokenizer_fingerprints[tokenizer] = (size, fingerprint)
+    return fingerprint
+
+
+@lru_cache(maxsize=64)
+def _hash_file(file_path, size, mtime_ns):
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_fingerprint(file_path):
+    """ The hash of the content of `file_path`, computed again only when its size or modification time change. """
+    stat = os.stat(file_path)
+    return _hash_file(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+
+def features_cache_key(file_path, tokenizer, label_list, max_seq_length, model_type, **params):
+    """ Hash of everything the features of `file_path` depend on, `params` are the other conversion options. """
+    sha1 = hashlib.sha1()
+    sha1.update(repr((FEATURES_CACHE_VERSION, file_fingerprint(file_path), tokenizer_fingerprint(tokenizer),
+                      list(label_list), max_seq_length, model_type, sorted(params.items()))).encode("utf-8"))
+    return sha1.hexdigest()
+
+
+def features_to_arrays(features):
+    """ Returns a dict with an array per field of the features (see `FEATURES_CACHE_DTYPES`) and their segments. """
+    arrays = {name: np.array([getattr(f, name) for f in features], dtype=dtype)
+              for name, dtype in FEATURES_CACHE_DTYPES.items()}
+    return arrays, [f.segments for f in features]
+
+
+def save_features_cache(cache_dir, arrays, segments):
+    """ Saves each of the `arrays` as a .npy file, and the segments of the sequences as a flat array with offsets.
+        The files are written into a temporary directory which is renamed at the end, so a cache directory
+        always holds complete features.
+    """
+    tmp_dir = cache_dir + ".tmp{}".format(os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + ".npy"), array)
+    np.save(os.path.join(tmp_dir, "segments.npy"),
+            np.array([segment for el in segments for segment in el], dtype=np.int32).reshape(-1, 3))
+    np.save(os.path.join(tmp_dir, "segments_offsets.npy"), np.cumsum([0] + [len(el) for el in segments]))
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+
+def load_features_cache(cache_dir):
+    """ Returns the arrays saved by `save_features_cache` memory mapped copy-on-write, so `torch.from_numpy`
+        wraps them without copying, and the segments of the sequences.
+    """
+    arrays = {os.path.splitext(name)[0]: np.load(os.path.join(cache_dir, name), mmap_mode="c")
+              for name in os.listdir(cache_dir) if name.endswith(".npy")}
+    segments, offsets = arrays.pop("segments").tolist(), arrays.pop("segments_offsets").tolist()
+    return arrays, [[tuple(el) for el in segments[offsets[i]: offsets[i + 1]]] for i in range(len(offsets) - 1)]
+
+
+# the fields of the features padded to max_seq_length: input ids, input mask, segment ids and label ids
+SEQUENCE_FIELDS = (0, 1, 2, 3)
+
+
 def get_labels(path):
     if path:
         with open(path, "r") as f:
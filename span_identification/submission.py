@@ -6,11 +6,10 @@ import nltk
 from nltk.corpus import stopwords
 
 
-def merge_spans(spans, articles_id, articles_content):
+def merge_spans(spans, articles):
     res = dict()
-    articles_content_dict = dict(zip(articles_id, articles_content))
     for article_id in spans:
-        article = articles_content_dict[article_id]
+        article = articles[article_id]
         res[article_id] = []
         mask = np.zeros(len(article))
         for span in spans[article_id]:
@@ -32,12 +31,11 @@ def merge_spans(spans, articles_id, articles_content):
     return res
 
 
-def correct_spans(spans, articles_id, articles_content):
+def correct_spans(spans, articles):
     stop_words = set(stopwords.words('english'))
     res = dict()
-    articles_content_dict = dict(zip(articles_id, articles_content))
     for article_id in spans:
-        article = articles_content_dict[article_id]
+        article = articles[article_id]
         res[article_id] = []
         mask = np.zeros(len(article))
         for span in spans[article_id]:
@@ -80,66 +78,142 @@ def correct_spans(spans, articles_id, articles_content):
                     length += 1
         
         if start != -1:
-            if unidecode(article[start - 1]) == '"':
+            if start > 0 and unidecode(article[start - 1]) == '"':
                 start -= 1
                 length += 1
-            if unidecode(article[start + length]) == '"':
+            if start + length < len(article) and unidecode(article[start + length]) == '"':
                 length += 1
             if unidecode(article[start + length - 1]) != '"':
                 while not article[start + length - 1].isalnum():
                     length -= 1
             if length > 0:
                 res[article_id].append((start, start + length))
-    return res # merge_spans(res, articles_id, articles_content)
+    return res # merge_spans(res, articles)
 
 
-def get_spans_from_file(file, articles_id, articles_content, nlp):
-    pred_spans = dict()
+LABELS_CODES = {'B-PROP': 1, 'I-PROP': 2}
+# technique column of the span confidence file, which follows the AnnotationWithConfidence format of propaganda/src
+SPAN_LABEL = 'propaganda'
+
+
+def read_labels_from_file(file):
+    """ Returns the predicted labels of the token lines of `file`, coded as 0 (O), 1 (B-PROP) and 2 (I-PROP). """
+    labels = []
     with open(file, 'r') as f:
-        for article_id, text in zip(articles_id, articles_content):
-            pred_spans.setdefault(article_id, [])
-            tokens = [(token.idx, token.text) for token in nlp(text)]
-            idx = np.array(tokens)[:,0]
-            tokens = np.array(tokens)[:,1]
-            tokens = [token.strip().replace('\n', ' ').replace('\t', ' ') for token in tokens]
-            
-            i = 0
-            start = -1
-            for i in range(len(tokens)):
-                tok = tokens[i]
-                if len(tok) != 0 and repr(tok) != repr('\ufeff') and repr(tok) != repr('\u200f'):
-                    token, label = f.readline().split('\t')
-                    label = label.strip()
-                    if label == 'B-PROP' or (label == 'I-PROP' and start == -1):
-                        if start != -1:
-                            pred_spans[article_id].append((start, int(idx[i - 1]) + len(tokens[i - 1])))
-                        start = int(idx[i])                        
-                    if label == 'O':
-                        if start != -1:
-                            pred_spans[article_id].append((start, int(idx[i - 1]) + len(tokens[i - 1])))
-                        start = -1
-                    assert token == tok
-                    assert tok == text[int(idx[i]): int(idx[i]) + len(tok)]
-                    prev_label = label
-                    prev_tok = tok
-                else:
-                    if prev_tok != '\n':
-                        f.readline()
-                        prev_tok = '\n'
-                    prev_label = 'O'
-    
-    return correct_spans(pred_spans, articles_id, articles_content)
+        for line in f:
+            if line.strip():
+                labels.append(LABELS_CODES.get(line.rstrip('\n').split('\t')[1].strip(), 0))
+    return np.array(labels, dtype=np.int8)
 
 
-def get_submission_format(predicted_labels_files, articles_id, articles_content, nlp, output_file):    
+def read_span_probabilities_from_file(file):
+    """ Returns the probabilities of the token lines of `file` to be inside a span, from the optional third column
+        of the predictions (1.0 for the lines without it).
+    """
+    probabilities = []
+    with open(file, 'r') as f:
+        for line in f:
+            if line.strip():
+                columns = line.rstrip('\n').split('\t')
+                probabilities.append(float(columns[2]) if len(columns) > 2 and columns[2].strip() else 1.0)
+    return np.array(probabilities, dtype=np.float32)
+
+
+def get_span_confidences(spans, offsets_file, token_probabilities):
+    """ Returns {article_id: [(start, end, confidence), ...]} for the `spans`, where the confidence of a span is the
+        mean probability to be inside a span of the tokens it overlaps (see `read_span_probabilities_from_file`).
+    """
+    offsets = np.load(offsets_file)
+    if len(token_probabilities) != len(offsets['starts']):
+        raise ValueError("%d token probabilities are given, but %s has the offsets of %d tokens"
+                         % (len(token_probabilities), offsets_file, len(offsets['starts'])))
+    article_index = offsets['article_index']
+    # tokens of the i-th article are in [bounds[i], bounds[i + 1]), in the order of the text
+    bounds = np.searchsorted(article_index, np.arange(len(offsets['articles_id']) + 1))
+    positions = {article_id: i for i, article_id in enumerate(offsets['articles_id'].tolist())}
+    cumulative = np.concatenate([[0.0], np.cumsum(token_probabilities, dtype=np.float64)])
+
+    res = dict()
+    for article_id, article_spans in spans.items():
+        res[article_id] = []
+        if not article_spans:
+            continue
+        i = positions[article_id]
+        starts = offsets['starts'][bounds[i]: bounds[i + 1]]
+        ends = offsets['ends'][bounds[i]: bounds[i + 1]]
+        span_starts, span_ends = np.array(article_spans, dtype=np.int64).reshape(-1, 2).T
+        first = bounds[i] + np.searchsorted(ends, span_starts, side='right')
+        last = bounds[i] + np.searchsorted(starts, span_ends, side='left')
+        confidences = (cumulative[last] - cumulative[first]) / np.maximum(last - first, 1)
+        res[article_id] = list(zip(span_starts.tolist(), span_ends.tolist(), confidences.tolist()))
+    return res
+
+
+def get_spans_from_labels(labels, offsets, articles):
+    """ Turns the `labels` of the tokens (see `read_labels_from_file`) into character spans, using their `offsets`
+        (the arrays of the offsets sidecar, see `span_identification.dataset.TokenOffsets`). `articles` maps the
+        article ids to their texts, e.g. an `ArticleCorpus`, which decodes only the articles that are looked up.
+    """
+    pred_spans = dict()
+    for article_id in articles:
+        pred_spans.setdefault(article_id, [])
+    if len(labels) == 0:
+        return correct_spans(pred_spans, articles)
+
+    article_index = offsets['article_index']
+    first = np.ones(len(labels), dtype=bool)
+    first[1:] = article_index[1:] != article_index[:-1]
+    prev_labels = np.concatenate([[0], labels[:-1]])
+
+    # a span is open before token k if k is not the first token of its article and the label of k - 1 is not O
+    is_open = ~first & (prev_labels != 0)
+    opens = (labels == 1) | ((labels == 2) & ~is_open)
+    closes = is_open & (labels != 2)
+    last_open = np.maximum.accumulate(np.where(opens, np.arange(len(labels)), 0))
+
+    close_pos = np.flatnonzero(closes)
+    span_starts = offsets['starts'][last_open[close_pos - 1]]
+    span_ends = offsets['prev_ends'][close_pos]
+    span_articles = offsets['articles_id'][article_index[close_pos]]
+    for article_id, start, end in zip(span_articles.tolist(), span_starts.tolist(), span_ends.tolist()):
+        pred_spans.setdefault(article_id, []).append((start, end))
+
+    return correct_spans(pred_spans, articles)
+
+
+def get_spans_from_file(file, offsets_file, articles):
+    """ Turns the labels predicted for the BIO `file` into character spans, using the offsets sidecar
+        written together with the BIO file, so the articles are never tokenized again.
+    """
+    offsets = np.load(offsets_file)
+    labels = read_labels_from_file(file)
+    if len(labels) != len(offsets['starts']):
+        raise ValueError("%s has %d labeled tokens, but %s has the offsets of %d tokens"
+                         % (file, len(labels), offsets_file, len(offsets['starts'])))
+    return get_spans_from_labels(labels, offsets, articles)
+
+
+def get_submission_format(predicted_labels_files, offsets_file, articles, output_file, confidence_file=None):
+    """ Writes the spans predicted in `predicted_labels_files` to `output_file` in the submission format.
+        If `confidence_file` is given, the spans are also written there with their confidence, averaged over
+        the prediction files (see `get_span_confidences`), as "article_id\tpropaganda\tstart\tend\tconfidence".
+    """
     agg_result = dict()
     for file in predicted_labels_files:
-        result = get_spans_from_file(file, articles_id, articles_content, nlp)
+        result = get_spans_from_file(file, offsets_file, articles)
         for el in result:
             agg_result[el] = agg_result.get(el, []) + result[el]
-    agg_result = merge_spans(agg_result, articles_id, articles_content)
+    agg_result = merge_spans(agg_result, articles)
     
     with open(output_file, "w") as fout:
         for article_id, spans in agg_result.items():
             for span in spans:
                 fout.write("%s\t%s\t%s\n" % (article_id, span[0], span[1]))
+
+    if confidence_file is not None:
+        token_probabilities = np.mean([read_span_probabilities_from_file(file) for file in predicted_labels_files],
+                                      axis=0)
+        with open(confidence_file, "w") as fout:
+            for article_id, spans in get_span_confidences(agg_result, offsets_file, token_probabilities).items():
+                for start, end, confidence in spans:
+                    fout.write("%s\t%s\t%s\t%s\t%.6f\n" % (article_id, SPAN_LABEL, start, end, confidence))
@@ -0,0 +1,109 @@
+# coding=utf-8
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import spacy
+
+
+# only token offsets and texts are used, so none of the statistical components are loaded
+SPACY_UNUSED_COMPONENTS = ["tok2vec", "tagger", "parser", "ner", "attribute_ruler", "lemmatizer", "senter"]
+
+
+class TokenOffsetsCache(object):
+    """ Persistent cache of spaCy token offsets shared by the dataset and submission code.
+
+        Every article is stored as an int32 array of shape (n_tokens, 2) with the start offset and the length
+        of each token. The cache key is the hash of the article text together with the spaCy model name and
+        version, so an article is tokenized only once across runs as long as the model does not change.
+        If `cache_dir` is None, the offsets are kept in memory only. With `max_items`, only the offsets of the
+        `max_items` most recently used articles are kept in memory, so a long-lived process does not grow with
+        every article it sees.
+
+        Only the tokenizer of `nlp` is run: the rest of the pipeline is disabled while tokenizing, and
+        `prefetch` streams all the missing articles through `nlp.pipe` with `n_process` workers.
+    """
+
+    def __init__(self, nlp, cache_dir=None, batch_size=32, n_process=1, max_items=None):
+        self.nlp = nlp
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.model_id = "{}_{}-{}/spacy-{}".format(nlp.meta.get("lang"), nlp.meta.get("name"),
+                                                   nlp.meta.get("version"), spacy.__version__)
+        self.max_items = max_items
+        self._offsets = OrderedDict()
+        self._lock = threading.Lock()
+        if self.cache_dir is not None and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _key(self, text):
+        return hashlib.sha1((self.model_id + "\n" + text).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def _save(self, key, offsets):
+        path = self._path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so that concurrent runs never read a partially written array
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, offsets)
+        os.replace(tmp_path, path)
+
+    def _remember(self, key, offsets):
+        with self._lock:
+            self._offsets[key] = offsets
+            self._offsets.move_to_end(key)
+            if self.max_items is not None and len(self._offsets) > self.max_items:
+                self._offsets.popitem(last=False)
+
+    def _load(self, key):
+        with self._lock:
+            offsets = self._offsets.get(key)
+            if offsets is not None:
+                self._offsets.move_to_end(key)
+        if offsets is None and self.cache_dir is not None and os.path.exists(self._path(key)):
+            offsets = np.load(self._path(key))
+            self._remember(key, offsets)
+        return offsets
+
+    def _add(self, key, doc):
+        offsets = np.array([(token.idx, len(token)) for token in doc], dtype=np.int32).reshape(-1, 2)
+        if self.cache_dir is not None:
+            self._save(key, offsets)
+        self._remember(key, offsets)
+        return offsets
+
+    def prefetch(self, texts):
+        """ Tokenizes all the articles from `texts` that are not cached yet in a single `nlp.pipe` pass. """
+        missing = dict()
+        for text in texts:
+            key = self._key(text)
+            if key not in missing and self._load(key) is None:
+                missing[key] = text
+        if not missing:
+            return
+        with self.nlp.disable_pipes(*self.nlp.pipe_names):
+            docs = self.nlp.pipe(missing.values(), batch_size=self.batch_size, n_process=self.n_process)
+            for key, doc in zip(missing.keys(), docs):
+                self._add(key, doc)
+
+    def offsets(self, text):
+        """ Returns (starts, lengths) int32 arrays of the tokens of `text`. """
+        key = self._key(text)
+        offsets = self._load(key)
+        if offsets is None:
+            with self.nlp.disable_pipes(*self.nlp.pipe_names):
+                offsets = self._add(key, self.nlp(text))
+        return offsets[:, 0], offsets[:, 1]
+
+    def tokenize(self, text):
+        """ Returns token start offsets and token texts, i.e. `token.idx` and `token.text` of the spaCy tokens. """
+        starts, lengths = self.offsets(text)
+        return starts, [text[start: start + length] for start, length in zip(starts.tolist(), lengths.tolist())]
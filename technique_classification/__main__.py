@@ -2,12 +2,15 @@ try:
     from .transformers_classifier import transformers_clf
     from .dataset import load_data, get_train_dev_files, get_test_file
     from .submission import create_submission_file, eval_submission
+    from .normalization import get_span_normalizer
 except:
     from transformers_classifier import transformers_clf
     from dataset import load_data, get_train_dev_files, get_test_file
     from submission import create_submission_file, eval_submission
+    from normalization import get_span_normalizer
     
 import configargparse
+import contextlib
 import ipdb
 import logging
 import os
@@ -20,10 +23,21 @@ logger = logging.getLogger(__name__)
 def Main(args):
     if not os.path.exists(args.data_dir):
         os.makedirs(args.data_dir)
-    
+    if args.span_cache_file:
+        get_span_normalizer(args.span_cache_file)
+    # the article corpora are closed when Main returns
+    with contextlib.ExitStack() as corpora:
+        run(args, corpora)
+
+    if args.span_cache_file:
+        get_span_normalizer().save()
+
+
+def run(args, corpora):
     if args.do_train or args.do_eval or args.split_dataset or args.create_submission_file:
         articles, ref_articles_id, ref_span_starts, ref_span_ends, labels = load_data(args.train_data_folder, 
                                                                            args.labels_path)
+        corpora.enter_context(articles)
         train_file_path = os.path.join(args.data_dir, args.train_file)
         dev_file_path = os.path.join(args.data_dir, args.dev_file)
         if not os.path.exists(train_file_path) or not os.path.exists(dev_file_path) or args.overwrite_cache:
@@ -36,6 +50,7 @@ def Main(args):
         test_file_path = os.path.join(args.data_dir, args.test_file)
         test_articles, test_articles_id, test_span_starts, test_span_ends, test_labels = load_data(args.test_data_folder,
                                                                                       args.test_template_labels_path)
+        corpora.enter_context(test_articles)
         if not os.path.exists(test_file_path) or args.overwrite_cache:
             logger.info("Creating roberta-type test file: %s", test_file_path)
             get_test_file(test_articles, test_articles_id, test_span_starts, test_span_ends, test_labels, test_file_path)
@@ -107,6 +122,16 @@ def main():
     parser.add_argument('--use_length', action='store_true')
     parser.add_argument('--join_embeddings', action='store_true')
     parser.add_argument('--use_matchings', action='store_true')
+    parser.add_argument('--bucket_by_length', action='store_true',
+                        help="Make train batches of sequences with similar lengths. Batches are always padded only "
+                             "to their longest sequence, and evaluation always groups sequences by length.")
+    parser.add_argument('--quantize', action='store_true',
+                        help="Evaluate and predict on the CPU with the Linear layers dynamically quantized to int8. "
+                             "The quantized model is cached next to the checkpoint. With evaluation, it is compared "
+                             "with the fp32 model (metrics, latency and throughput in quantization_results.txt).")
+    parser.add_argument('--span_cache_file', default=None, type=str,
+                        help="The file keeping the tokenized and stemmed spans of the matchings and the "
+                             "postprocessing between the runs.")
     
     MODEL_CLASSES = ["bert", "roberta", "distilbert", "camembert"]
     parser.add_argument("--model_type", default=None, type=str, required=True,
@@ -176,11 +201,10 @@ def main():
     parser.add_argument('--seed', type=int, default=42,
                         help="random seed for initialization")
 
-    # parser.add_argument('--fp16', action='store_true',
-    #                     help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit")
-    # parser.add_argument('--fp16_opt_level', type=str, default='O1',
-    #                     help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-    #                          "See details at https://nvidia.github.io/apex/amp.html")
+    parser.add_argument('--fp16', action='store_true',
+                        help="Train and evaluate with fp16 mixed precision (torch.autocast with loss scaling, GPU only)")
+    parser.add_argument('--bf16', action='store_true',
+                        help="Train and evaluate with bf16 mixed precision (torch.autocast, on the GPU or the CPU)")
     parser.add_argument("--local_rank", type=int, default=-1,
                         help="For distributed training: local_rank")
     parser.add_argument('--server_ip', type=str, default='', help="For distant debugging.")
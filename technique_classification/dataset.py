@@ -1,21 +1,12 @@
-import codecs
-import glob
-import os
 import numpy as np
 import pandas as pd
 from nltk.tokenize.punkt import PunktSentenceTokenizer
 from sklearn.model_selection import train_test_split
+from article_corpus import ArticleCorpus
 
 
 def read_articles_from_file_list(folder_name, file_pattern="*.txt"):
-    file_list = glob.glob(os.path.join(folder_name, file_pattern))
-    articles = {}
-    article_id_list, sentence_id_list, sentence_list = ([], [], [])
-    for filename in sorted(file_list):
-        article_id = os.path.basename(filename).split(".")[0][7:]
-        with codecs.open(filename, "r", encoding="utf8") as f:
-            articles[article_id] = f.read()
-    return articles
+    return ArticleCorpus.from_folder(folder_name, file_pattern=file_pattern)
 
 
 def read_predictions_from_file(filename):
@@ -37,6 +28,7 @@ def load_data(data_folder, labels_file):
 
 
 def sents_token_bounds(text):
+    """ Returns the sorted start offsets of the sentences of `text`, followed by the 100000 sentinel. """
     sents_starts = []
     for start, end in PunktSentenceTokenizer().span_tokenize(text):
         sents_starts.append(start)
@@ -48,11 +40,21 @@ def clear(text):
     return text.strip().replace('\t', ' ').replace('\n', ' ')
 
 
-def get_context(article, span_start, span_end):
-    bounds = sents_token_bounds(article)
-    context_start = bounds[np.where(bounds <= span_start)[0][-1]]
-    context_end = bounds[np.where(bounds >= span_end)[0][0]]
-    return clear(article[context_start:context_end])
+def get_contexts(article, span_starts, span_ends, bounds=None):
+    """ Returns the contexts of the spans of `article`: the sentences from the one where a span starts to the one
+        where it ends. `bounds` are the `sents_token_bounds` of the article, computed once for all its spans.
+    """
+    if bounds is None:
+        bounds = sents_token_bounds(article)
+    start_index = np.searchsorted(bounds, span_starts, side='right') - 1
+    context_starts = np.where(start_index >= 0, bounds[start_index], 0)
+    end_index = np.minimum(np.searchsorted(bounds, span_ends, side='left'), len(bounds) - 1)
+    context_ends = bounds[end_index]
+    return [clear(article[start:end]) for start, end in zip(context_starts, context_ends)]
+
+
+def get_context(article, span_start, span_end, bounds=None):
+    return get_contexts(article, [span_start], [span_end], bounds)[0]
 
 
 def balance_pandas(data):
@@ -64,15 +66,23 @@ def balance_pandas(data):
 
 
 def dataset_to_pandas(articles, ref_articles_id, ref_span_starts, ref_span_ends, train_gold_labels):
-    data = pd.DataFrame.from_dict({'article_id': ref_articles_id, 
-              'article': [articles[id] for id in ref_articles_id], 
-              'span_start': np.array(ref_span_starts).astype(int), 
-              'span_end': np.array(ref_span_ends).astype(int),
-              'label': train_gold_labels
-             })
-    data['span'] = data.apply(lambda x: clear(x['article'][x['span_start']:x['span_end']]), axis=1)
-    data['context'] = data.apply(lambda x: get_context(x['article'], x['span_start'], x['span_end']), axis=1)
-    return data[['article_id', 'span_start', 'span_end', 'span', 'context', 'label']]
+    span_starts = np.array(ref_span_starts).astype(int)
+    span_ends = np.array(ref_span_ends).astype(int)
+    spans = np.empty(len(span_starts), dtype=object)
+    contexts = np.empty(len(span_starts), dtype=object)
+    # the spans are grouped by article, every article is read and split into sentences once
+    articles_rows = pd.Series(ref_articles_id).groupby(ref_articles_id, sort=False).indices
+    for article_id, rows in articles_rows.items():
+        article = articles[article_id]
+        spans[rows] = [clear(article[start:end]) for start, end in zip(span_starts[rows], span_ends[rows])]
+        contexts[rows] = get_contexts(article, span_starts[rows], span_ends[rows])
+    return pd.DataFrame.from_dict({'article_id': ref_articles_id,
+                                   'span_start': span_starts,
+                                   'span_end': span_ends,
+                                   'span': spans,
+                                   'context': contexts,
+                                   'label': train_gold_labels
+                                  })
 
 
 def get_train_dev_files(articles, ref_articles_id, ref_span_starts, ref_span_ends, labels, train_file, dev_file,
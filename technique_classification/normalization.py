@@ -0,0 +1,128 @@
+# coding=utf-8
+""" Normalized forms of the span texts shared by the TC stages (train instances, matchings and postprocessing):
+    the texts are tokenized and stemmed once per distinct span and every word is stemmed once.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import logging
+import os
+import pickle
+import string
+import threading
+from collections import OrderedDict
+
+import nltk
+from nltk.corpus import stopwords
+from nltk.stem import PorterStemmer
+from nltk.tokenize import word_tokenize
+from unidecode import unidecode
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+
+
+class SpanNormalizer(object):
+    """ Memoized span normalization.
+
+        `stemmed(span)` is the " "-joined stems of the words of the lowercased span (the key of the train
+        instances and the matchings), `stemmed_content(span)` the same for the transliterated span without the
+        stop words and the punctuation (the key of the repetitions). Both are kept for the `max_spans` most recently
+        used texts, the stems of the words without limit. With `cache_file`, the memos are loaded from it and
+        written back by `save`.
+    """
+
+    def __init__(self, max_spans=100000, cache_file=None):
+        self.max_spans = max_spans
+        self.cache_file = cache_file
+        self.stemmer = PorterStemmer()
+        self._stop_words = None
+        self._lock = threading.Lock()
+        self.word_stems = {}
+        self.spans = {"stemmed": OrderedDict(), "content": OrderedDict()}
+        if cache_file and os.path.exists(cache_file):
+            self.load(cache_file)
+
+    @property
+    def stop_words(self):
+        if self._stop_words is None:
+            self._stop_words = set(stopwords.words('english'))
+        return self._stop_words
+
+    def stem_words(self, words):
+        """ Returns the stems of `words`, every distinct word being stemmed once. """
+        stems = []
+        for word in words:
+            stem = self.word_stems.get(word)
+            if stem is None:
+                stem = self.word_stems[word] = self.stemmer.stem(word)
+            stems.append(stem)
+        return stems
+
+    def _memoized(self, kind, span, normalize):
+        cache = self.spans[kind]
+        with self._lock:
+            if span in cache:
+                cache.move_to_end(span)
+                return cache[span]
+        result = normalize(span)
+        with self._lock:
+            cache[span] = result
+            if len(cache) > self.max_spans:
+                cache.popitem(last=False)
+        return result
+
+    def _stemmed(self, span):
+        return " ".join(self.stem_words(word_tokenize(span.lower())))
+
+    def _stemmed_content(self, span):
+        words = [word for word in word_tokenize(unidecode(span.lower()))
+                 if word not in self.stop_words and word not in string.punctuation]
+        return " ".join(self.stem_words(words))
+
+    def stemmed(self, span):
+        return self._memoized("stemmed", span, self._stemmed)
+
+    def stemmed_content(self, span):
+        return self._memoized("content", span, self._stemmed_content)
+
+    def stem_spans(self, spans):
+        return [self.stemmed(span) for span in spans]
+
+    def load(self, cache_file):
+        with open(cache_file, "rb") as f:
+            cache = pickle.load(f)
+        if cache.get("version") != (CACHE_VERSION, nltk.__version__):
+            logger.info("Ignoring the span normalization cache %s of another version", cache_file)
+            return
+        self.word_stems.update(cache["word_stems"])
+        for kind, spans in cache["spans"].items():
+            self.spans[kind].update(spans)
+        logger.info("Loaded %d normalized spans from %s", sum(len(spans) for spans in self.spans.values()),
+                    cache_file)
+
+    def save(self, cache_file=None):
+        cache_file = cache_file if cache_file else self.cache_file
+        with self._lock:
+            cache = {"version": (CACHE_VERSION, nltk.__version__), "word_stems": dict(self.word_stems),
+                     "spans": {kind: OrderedDict(spans) for kind, spans in self.spans.items()}}
+        tmp_file = cache_file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+
+
+_span_normalizer = None
+
+
+def get_span_normalizer(cache_file=None):
+    """ Returns the normalizer shared by the TC stages, created on the first call (with `cache_file`, if any). """
+    global _span_normalizer
+    if _span_normalizer is None:
+        _span_normalizer = SpanNormalizer(cache_file=cache_file)
+    elif cache_file and _span_normalizer.cache_file is None:
+        _span_normalizer.cache_file = cache_file
+        if os.path.exists(cache_file):
+            _span_normalizer.load(cache_file)
+    return _span_normalizer
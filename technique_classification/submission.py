@@ -4,73 +4,82 @@ import pandas as pd
 import nltk
 nltk.download('punkt')
 nltk.download('stopwords')
-from nltk.stem import PorterStemmer
-from nltk.tokenize import word_tokenize
-from nltk import word_tokenize,sent_tokenize
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from operator import itemgetter
 from sklearn.utils.extmath import softmax
 from sklearn.metrics import accuracy_score, f1_score
-from nltk.corpus import stopwords
-import string
 import pickle
 import os
-from unidecode import unidecode
 from joblib import dump, load
-
-
-def get_insides(data):  
+try:
+    from .normalization import get_span_normalizer
+except ImportError:
+    from normalization import get_span_normalizer
+
+
+def containment_pairs(span_starts, span_ends):
+    """ Yields the (inner, outer) indices of the spans of an article strictly inside another one. The spans are
+        swept by start, the longest first, keeping the seen ones sorted by end: the containers of a span are the
+        seen spans ending after it.
+    """
+    seen_ends, seen_spans = [], []
+    for k in np.lexsort((-np.asarray(span_ends), np.asarray(span_starts))):
+        position = bisect_left(seen_ends, span_ends[k])
+        for outer in seen_spans[position:]:
+            if span_starts[outer] != span_starts[k] or span_ends[outer] != span_ends[k]:
+                yield k, outer
+        position = bisect_right(seen_ends, span_ends[k], lo=position)
+        seen_ends.insert(position, span_ends[k])
+        seen_spans.insert(position, k)
+
+
+def get_insides(data):
+    """ Counts, for every label, the labels of the spans of the same article strictly containing its spans. """
     insides = defaultdict(dict)
-    spans_coords = list(zip(data['span_start'].values, data['span_end'].values))
     labels = data['label'].values
-    article_ids = data['article_id'].values
-    for i in range(len(spans_coords)):
-        for j in range(i):
-            if article_ids[i] == article_ids[j]:
-                if spans_coords[i][0] >= spans_coords[j][0] and spans_coords[i][1] <= spans_coords[j][1]:
-                    if spans_coords[i][0] != spans_coords[j][0] or spans_coords[i][1] != spans_coords[j][1]:
-                        insides[labels[i]][labels[j]] = insides[labels[i]].get(labels[j], 0) + 1
-                if spans_coords[j][0] >= spans_coords[i][0] and spans_coords[j][1] <= spans_coords[i][1]:
-                    if spans_coords[j][0] != spans_coords[i][0] or spans_coords[j][1] != spans_coords[i][1]:
-                        insides[labels[j]][labels[i]] = insides[labels[j]].get(labels[i], 0) + 1
+    span_starts, span_ends = data['span_start'].values, data['span_end'].values
+    for rows in data.groupby('article_id', sort=False).indices.values():
+        for inner, outer in containment_pairs(span_starts[rows], span_ends[rows]):
+            inner_label, outer_label = labels[rows[inner]], labels[rows[outer]]
+            insides[inner_label][outer_label] = insides[inner_label].get(outer_label, 0) + 1
     return insides
 
 
 def correct_preds_for_insides(preds, spans_coords, logits, insides, mapping, inverse_mapping):
-    for i in range(len(preds)):
-        for j in range(len(preds)):
-            if spans_coords[j][0] >= spans_coords[i][0] and spans_coords[j][1] <= spans_coords[i][1]:
-                if spans_coords[j][0] != spans_coords[i][0] or spans_coords[j][1] != spans_coords[i][1]:
-                    def_i = preds[i]
-                    def_j = preds[j]
-                    log = softmax([logits[i]])[0]
-                    login = softmax([logits[j]])[0]
-                    def_prob_i = log[inverse_mapping[preds[i]]]
-                    def_prob_j = login[inverse_mapping[preds[j]]]
-                    while preds[j] not in insides.get(preds[i], []):
-                        if log[inverse_mapping[preds[i]]] > login[inverse_mapping[preds[j]]]:
-                            values = np.sort(login)[-2:]
-                            if values[1] / (values[0] + 1e-6) > 1.4:
-                                preds[i] = def_i
-                                preds[j] = def_j
-                                break
-                            login[inverse_mapping[preds[j]]] = 0
-                            preds[j] = mapping[np.argmax(login)]
-                        else:
-                            values = np.sort(log)[-2:]
-                            if values[1] / (values[0] + 1e-6) > 1.4:
-                                preds[i] = def_i
-                                preds[j] = def_j
-                                break
-                            log[inverse_mapping[preds[i]]] = 0
-                            preds[i] = mapping[np.argmax(log)]
+    if len(preds) == 0:
+        return preds
+    span_starts, span_ends = (np.array(coords) for coords in zip(*spans_coords))
+    probabilities = softmax(np.array(logits))
+    # the nested pairs are resolved by outer span, then by inner span, as the predictions change along the way
+    for j, i in sorted(containment_pairs(span_starts, span_ends), key=itemgetter(1, 0)):
+        def_i = preds[i]
+        def_j = preds[j]
+        log = probabilities[i].copy()
+        login = probabilities[j].copy()
+        while preds[j] not in insides.get(preds[i], []):
+            if log[inverse_mapping[preds[i]]] > login[inverse_mapping[preds[j]]]:
+                values = np.partition(login, -2)[-2:]
+                if values[1] / (values[0] + 1e-6) > 1.4:
+                    preds[i] = def_i
+                    preds[j] = def_j
+                    break
+                login[inverse_mapping[preds[j]]] = 0
+                preds[j] = mapping[np.argmax(login)]
+            else:
+                values = np.partition(log, -2)[-2:]
+                if values[1] / (values[0] + 1e-6) > 1.4:
+                    preds[i] = def_i
+                    preds[j] = def_j
+                    break
+                log[inverse_mapping[preds[i]]] = 0
+                preds[i] = mapping[np.argmax(log)]
     return preds
 
                             
 def stem_spans(spans):
-    ps = PorterStemmer()
     res = []
-    for el in spans:
-        result = " ".join(ps.stem(word) for word in word_tokenize(el.lower()))
+    for result in get_span_normalizer().stem_spans(spans):
         if len(result) > 0:
             res.append(result)
     return res
@@ -91,12 +100,14 @@ def get_train_instances(data, data_dir, save=True):
     return train_instances
                             
     
-def postprocess(x, mapping, inverse_mapping, insides, stop_words, ps, train_instances):
+def postprocess(x, preds, logits, mapping, inverse_mapping, insides, normalizer, train_instances):
+    """ Returns the corrected predictions of the spans `x` of an article, `preds` and `logits` being their rows of
+        the predictions and of the float32 logits matrix (the rows of `logits` are modified).
+    """
     spans_coords = list(zip(x['span_start'].values, x['span_end'].values))
     spans_source = x['span'].values
-    spans_text = [' '.join([ps.stem(word) for word in word_tokenize(span.lower())]) for span in spans_source]
-    spans = [' '.join([ps.stem(word) for word in word_tokenize(unidecode(span.lower())) 
-                       if word not in stop_words and word not in string.punctuation]) for span in spans_source]
+    spans_text = [normalizer.stemmed(span) for span in spans_source]
+    spans = [normalizer.stemmed_content(span) for span in spans_source]
     
     counts = dict()
     for i in range(len(spans)):
@@ -105,8 +116,6 @@ def postprocess(x, mapping, inverse_mapping, insides, stop_words, ps, train_inst
     for el in counts:
         counts[el] = len(counts[el])
         
-    preds = x['pred'].values
-    logits = [np.array(log.split(), dtype=np.float32) for log in x['logits']]
     for i in range(len(preds)):
         log = logits[i]
         
@@ -130,12 +139,9 @@ def postprocess(x, mapping, inverse_mapping, insides, stop_words, ps, train_inst
             for prediction in preds[prev_same]:
                 log[inverse_mapping[prediction]] = 0
         
-        logits[i] = log
         preds[i] = mapping[np.argmax(log)]
         
-    x["pred"] = correct_preds_for_insides(preds, spans_coords, logits, insides, mapping, inverse_mapping)
-    #x["pred"] = preds
-    return x
+    return correct_preds_for_insides(preds, spans_coords, logits, insides, mapping, inverse_mapping)
 
 
 def postprocess_predictions(predictions_logits, data, insides, train_instances):
@@ -147,15 +153,15 @@ def postprocess_predictions(predictions_logits, data, insides, train_instances):
     )}
     inverse_mapping = {b: a for (a, b) in mapping.items()}
     
-    stop_words = set(stopwords.words('english'))
-    ps = PorterStemmer()
+    normalizer = get_span_normalizer()
     
-    predictions = np.argmax(predictions_logits, axis=1)
-    data['pred'] = [mapping[p] for p in predictions]
-    data['logits'] = [' '.join(np.array(log, dtype=str)) for log in predictions_logits]
-    data = data.groupby('article_id', as_index=False).apply(postprocess, mapping, inverse_mapping, insides,
-                                                            stop_words, ps, train_instances)
-    return np.array(data["pred"].values)
+    predictions = np.array([mapping[p] for p in np.argmax(predictions_logits, axis=1)], dtype=object)
+    # every article is postprocessed on its rows of the predictions and of the logits matrix
+    logits = np.asarray(predictions_logits, dtype=np.float32)
+    for rows in data.groupby('article_id', sort=False).indices.values():
+        predictions[rows] = postprocess(data.iloc[rows], predictions[rows], logits[rows], mapping, inverse_mapping,
+                                        insides, normalizer, train_instances)
+    return predictions
 
 
 def softmax_with_temperature(z, T): 
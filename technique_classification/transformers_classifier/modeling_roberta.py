@@ -551,6 +551,15 @@ class RobertaForTokenClassification(BertPreTrainedModel):
         return outputs  # (loss), scores, (hidden_states), (attentions)
 
 
+def masked_mean(features, mask):
+    """ Sums the `features` of the positions after the first one weighted by the (batch_size, sequence_length)
+        `mask` with a single batched product, and divides the sums by the sum of the whole mask. The mask is used
+        on the device and with the dtype of the features.
+    """
+    mask = mask.to(dtype=features.dtype)
+    return torch.bmm(mask[:, None, 1:], features[:, 1:, :]).squeeze(1) / mask.sum(dim=1, keepdim=True)
+
+
 class RobertaClassificationHead(nn.Module):
     """Head for sentence-level classification tasks."""
 
@@ -646,9 +655,7 @@ class RobertaClassificationHeadJoined(nn.Module):
 
     def forward(self, features,  sent_a_length=None, attention_mask=None, **kwargs):
         x = features[:, 0, :]  # take <s> token (equiv. to [CLS])
-        mask = attention_mask.reshape(features.shape[0], features.shape[1], 1).type(torch.FloatTensor).cuda()
-        embs = (features * mask)[:, 1:, :].sum(dim=1) / mask.sum(dim=1)
-        #embs, _ = (features * mask)[:, 1:, :].max(dim=1)
+        embs = masked_mean(features, attention_mask)
         x = torch.cat((x, embs), dim=1)
         x = self.dropout(x)
         x = self.dense(x)
@@ -677,9 +684,9 @@ class RobertaClassificationHeadJoinedAtt(nn.Module):
     def forward(self, features,  sent_a_length, attention_mask, **kwargs):
         x = features[:, 0, :]  # take <s> token (equiv. to [CLS])
         x = torch.cat((x, sent_a_length), dim=1)
-        mask = attention_mask.reshape(features.shape[0], features.shape[1], 1).type(torch.FloatTensor).cuda()
-        att = self.att_weights(features) * mask
-        embs = (features * att)[:, 1:, :].sum(dim=1) / sent_a_length
+        att = self.att_weights(features).squeeze(-1)
+        att = att * attention_mask.to(dtype=att.dtype)
+        embs = torch.bmm(att[:, None, 1:], features[:, 1:, :]).squeeze(1) / sent_a_length
         x = torch.cat((x, embs), dim=1)
         #x = torch.cat((x, features[:, 1:, :].mean(dim=1)), dim=1)
         x = self.dropout(x)
@@ -706,12 +713,12 @@ class RobertaClassificationHeadVoting(nn.Module):
         self.out_proj = nn.Linear(config.hidden_size, config.num_labels)
 
     def forward(self, features, attention_mask, **kwargs):
-        mask = attention_mask.reshape(features.shape[0], features.shape[1], 1).type(torch.FloatTensor).cuda()
-        att = self.att_weights(features) * mask
+        att = self.att_weights(features).squeeze(-1)
+        att = att * attention_mask.to(dtype=att.dtype)
         x = self.dropout(features)
         x = self.dense(x)
         x = torch.tanh(x)
         x = self.dropout(x)
         x = self.out_proj(x)
-        x = (x * att).sum(dim=1)
+        x = torch.bmm(att[:, None, :], x).squeeze(1)
         return x
@@ -1583,8 +1583,8 @@ class SequenceSummary(nn.Module):
             output = torch.cat((output, sent_a_length), dim=1)
         
         if self.join_embeddings:
-            mask = embeddings_mask.reshape(hidden_states.shape[0], hidden_states.shape[1], 1).type(torch.FloatTensor).cuda()
-            embs = (hidden_states * mask)[:, :-1, :].sum(dim=1) / mask.sum(dim=1)
+            mask = embeddings_mask.to(dtype=hidden_states.dtype)
+            embs = torch.bmm(mask[:, None, :-1], hidden_states[:, :-1, :]).squeeze(1) / mask.sum(dim=1, keepdim=True)
             output = torch.cat((output, embs), dim=1)
         
         if self.use_matchings:
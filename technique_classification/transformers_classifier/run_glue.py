@@ -23,10 +23,7 @@ import logging
 import os
 import random
 import json
-
-from nltk.tokenize import word_tokenize
-from nltk.stem import PorterStemmer
-
+from functools import partial
 
 import numpy as np
 import pickle
@@ -65,6 +62,15 @@ from transformers import AdamW, get_linear_schedule_with_warmup
 from .utils import glue_compute_metrics as compute_metrics
 from .utils import glue_output_modes as output_modes
 from .utils import glue_processors as processors
+from .utils import SEQUENCE_FIELDS
+try:
+    from ..normalization import get_span_normalizer
+except ImportError:
+    # technique_classification/__main__.py run as a script imports this package as a top-level one
+    from normalization import get_span_normalizer
+from batching import BucketBatchSampler, restore_order, trim_collate
+from mixed_precision import autocast, autocast_dtype, check_mixed_precision, get_grad_scaler
+from quantization import load_quantized_model, model_signature, quantization_report, write_report
 from transformers import glue_convert_examples_to_features as convert_examples_to_features
 
 logger = logging.getLogger(__name__)
@@ -90,14 +96,28 @@ def set_seed(args):
         torch.cuda.manual_seed_all(args.seed)
 
 
+def get_collate_fn(args):
+    # the roberta head joining the length and the embeddings averages over all the positions, padding included,
+    # so its batches are kept padded to max_seq_length
+    if args.model_type == 'roberta' and args.use_length and args.join_embeddings:
+        return None
+    return partial(trim_collate, sequence_fields=SEQUENCE_FIELDS, pad_on_left=bool(args.model_type in ['xlnet']))
+
+
 def train(args, train_dataset, model, tokenizer):
     """ Train the model """
     if args.local_rank in [-1, 0]:
         tb_writer = SummaryWriter()
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    collate_fn = get_collate_fn(args)
+    if args.bucket_by_length and args.local_rank == -1 and collate_fn is not None:
+        train_sampler = BucketBatchSampler(train_dataset.tensors[1].sum(dim=1).numpy(), args.train_batch_size)
+        train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=collate_fn)
+    else:
+        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size,
+                                      collate_fn=collate_fn)
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -114,18 +134,14 @@ def train(args, train_dataset, model, tokenizer):
 
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=t_total)
-    # if args.fp16:
-    #     try:
-    #         from torch import amp
-    #     except ImportError:
-    #         raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
-    #     model, optimizer = amp.initialize(model, optimizer, opt_level=args.fp16_opt_level)
-
-    # multi-gpu training (should be after apex fp16 initialization)
+    # the loss is scaled with fp16 on a GPU only
+    scaler = get_grad_scaler(args)
+
+    # multi-gpu training
     if args.n_gpu > 1:
         model = torch.nn.DataParallel(model)
 
-    # Distributed training (should be after apex fp16 initialization)
+    # Distributed training
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
                                                           output_device=args.local_rank,
@@ -158,7 +174,7 @@ def train(args, train_dataset, model, tokenizer):
                 inputs['token_type_ids'] = batch[2] if args.model_type in ['bert', 'xlnet'] else None  # XLM, DistilBERT and RoBERTa don't use segment_ids
             if args.use_length:
                 if args.model_type == 'roberta':
-                    inputs['lengths'] = (inputs['attention_mask'] - inputs['token_type_ids']).sum(dim=1, keepdim=True).float()
+                    inputs['lengths'] = (batch[1] - batch[2]).sum(dim=1, keepdim=True).float()
                 if args.model_type == 'xlnet':
                     mask = inputs['attention_mask'] - inputs['token_type_ids']
                     mask[mask < 0] = 0
@@ -167,12 +183,13 @@ def train(args, train_dataset, model, tokenizer):
                 inputs['matchings'] = batch[4]
             if args.join_embeddings:
                 if args.model_type == 'roberta':
-                    inputs['embeddings_mask'] = inputs['attention_mask'] - inputs['token_type_ids']
+                    inputs['embeddings_mask'] = inputs['attention_mask'] - batch[2]
                 if args.model_type == 'xlnet':
                     mask = inputs['attention_mask'] - inputs['token_type_ids']
                     mask[mask < 0] = 0
                     inputs['embeddings_mask'] = mask
-            outputs = model(**inputs)
+            with autocast(args):
+                outputs = model(**inputs)
             loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
 
             if args.n_gpu > 1:
@@ -180,19 +197,22 @@ def train(args, train_dataset, model, tokenizer):
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
 
-            # if args.fp16:
-            #     with amp.scale_loss(loss, optimizer) as scaled_loss:
-            #         scaled_loss.backward()
-            # else:
-                # loss.backward()
+            if scaler is not None:
+                scaler.scale(loss).backward()
+            else:
+                loss.backward()
 
             tr_loss += loss.item()
             if (step + 1) % args.gradient_accumulation_steps == 0:
-                # if args.fp16:
-                #     torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_grad_norm)
+                if scaler is not None:
+                    scaler.unscale_(optimizer)
                 torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
 
-                optimizer.step()
+                if scaler is not None:
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
+                    optimizer.step()
                 scheduler.step()  # Update learning rate schedule
                 model.zero_grad()
                 global_step += 1
@@ -255,9 +275,15 @@ def evaluate(args, model, tokenizer, prefix=""):
             os.makedirs(eval_output_dir)
 
         args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-        # Note that DistributedSampler samples randomly
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        collate_fn = get_collate_fn(args)
+        if collate_fn is not None:
+            # examples of similar lengths are evaluated together, the predictions are put back in order below
+            eval_sampler = BucketBatchSampler(eval_dataset.tensors[1].sum(dim=1).numpy(), args.eval_batch_size,
+                                              shuffle=False)
+            eval_dataloader = DataLoader(eval_dataset, batch_sampler=eval_sampler, collate_fn=collate_fn)
+        else:
+            eval_sampler = SequentialSampler(eval_dataset)
+            eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
 
         # multi-gpu eval
         if args.n_gpu > 1:
@@ -275,7 +301,7 @@ def evaluate(args, model, tokenizer, prefix=""):
             model.eval()
             batch = tuple(t.to(args.device) for t in batch)
 
-            with torch.no_grad():
+            with torch.no_grad(), autocast(args):
                 inputs = {'input_ids':      batch[0],
                           'attention_mask': batch[1],
                           'labels':         batch[3]}
@@ -303,13 +329,16 @@ def evaluate(args, model, tokenizer, prefix=""):
                 eval_loss += tmp_eval_loss.mean().item()
             nb_eval_steps += 1
             if preds is None:
-                preds = logits.detach().cpu().numpy()
+                preds = logits.detach().float().cpu().numpy()
                 out_label_ids = inputs['labels'].detach().cpu().numpy()
             else:
-                preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
+                preds = np.append(preds, logits.detach().float().cpu().numpy(), axis=0)
                 out_label_ids = np.append(out_label_ids, inputs['labels'].detach().cpu().numpy(), axis=0)
 
         eval_loss = eval_loss / nb_eval_steps
+        if isinstance(eval_sampler, BucketBatchSampler):
+            preds = restore_order(preds, eval_sampler.order)
+            out_label_ids = restore_order(out_label_ids, eval_sampler.order)
         
         if args.do_predict:
             try:
@@ -347,7 +376,7 @@ def evaluate(args, model, tokenizer, prefix=""):
     return results
 
 
-def get_matchings(span, train_examples, ps):
+def get_matchings(span, train_examples, normalizer=None):
     mapping = {i: el for i, el in enumerate(['Appeal_to_Authority', 'Doubt', 'Repetition',
        'Appeal_to_fear-prejudice', 'Slogans', 'Black-and-White_Fallacy',
        'Loaded_Language', 'Flag-Waving', 'Name_Calling,Labeling',
@@ -357,7 +386,8 @@ def get_matchings(span, train_examples, ps):
     inverse_mapping = {b:a for (a, b) in mapping.items()}
     
     matchings = np.zeros(len(mapping))
-    clear_span = " ".join([ps.stem(word) for word in word_tokenize(span.lower())])
+    normalizer = normalizer if normalizer is not None else get_span_normalizer()
+    clear_span = normalizer.stemmed(span)
     if len(clear_span) > 0:
         for class_label in train_examples.get(clear_span, set()):
             matchings[inverse_mapping[class_label]] += 1
@@ -411,9 +441,9 @@ def load_and_cache_examples(args, task, tokenizer, evaluate=False, mode=None):
             if args.do_predict:
                 with open(os.path.join(args.data_dir, 'train_instances'), 'rb') as f:
                     train_examples = pickle.load(f)
-            ps = PorterStemmer()
+            normalizer = get_span_normalizer()
             for i in range(len(features)):
-                features[i].matchings = get_matchings(examples[i].text_a, train_examples, ps)
+                features[i].matchings = get_matchings(examples[i].text_a, train_examples, normalizer)
         
         if args.local_rank in [-1, 0] and False:
             logger.info("Saving features into cached file %s", cached_features_file)
@@ -466,8 +496,9 @@ def transformers_clf(args):
     logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                         datefmt = '%m/%d/%Y %H:%M:%S',
                         level = logging.INFO if args.local_rank in [-1, 0] else logging.WARN)
-    # logger.warning("Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
-    #                 args.local_rank, device, args.n_gpu, bool(args.local_rank != -1), args.fp16)
+    logger.warning("Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, mixed precision: %s",
+                   args.local_rank, device, args.n_gpu, bool(args.local_rank != -1), autocast_dtype(args))
+    check_mixed_precision(args)
 
     # Set seed
     set_seed(args)
@@ -539,6 +570,11 @@ def transformers_clf(args):
         model.to(args.device)
 
 
+    if args.quantize and (args.do_eval or args.do_predict):
+        # dynamically quantized models only run on the CPU, in int8 and fp32
+        args.device, args.n_gpu = torch.device("cpu"), 0
+        args.fp16 = args.bf16 = False
+
     # Evaluation
     results = {}
     if args.do_eval or args.do_predict and args.local_rank in [-1, 0]:
@@ -552,9 +588,26 @@ def transformers_clf(args):
             global_step = checkpoint.split('-')[-1] if len(checkpoints) > 1 else ""
             prefix = checkpoint.split('/')[-1] if checkpoint.find('checkpoint') != -1 else ""
             
-            model = model_class.from_pretrained(checkpoint)
-            model.to(args.device)
-            result = evaluate(args, model, tokenizer, prefix=prefix)
+            if args.quantize and args.do_eval:
+                # compare the quantized model with the fp32 one, the predictions are left by the quantized one
+                model = model_class.from_pretrained(checkpoint)
+                quantized_model = load_quantized_model(lambda: model, os.path.join(checkpoint, WEIGHTS_NAME),
+                                                       model_signature(model_class, model.config))
+                eval_dataset = load_and_cache_examples(args, args.task_name, tokenizer, evaluate=True,
+                                                       mode='predict' if args.do_predict else 'eval')
+                result = quantization_report(lambda m: evaluate(args, m, tokenizer, prefix=prefix),
+                                             model, quantized_model, len(eval_dataset), args.per_gpu_eval_batch_size)
+                write_report(result, os.path.join(checkpoint, "quantization_results.txt"))
+            else:
+                if args.quantize:
+                    # the fp32 model is not even built when the quantized one is cached
+                    model = load_quantized_model(lambda: model_class.from_pretrained(checkpoint),
+                                                 os.path.join(checkpoint, WEIGHTS_NAME),
+                                                 model_signature(model_class, config_class.from_pretrained(checkpoint)))
+                else:
+                    model = model_class.from_pretrained(checkpoint)
+                model.to(args.device)
+                result = evaluate(args, model, tokenizer, prefix=prefix)
             result = dict((k + '_{}'.format(global_step), v) for k, v in result.items())
             results.update(result)
 
@@ -35,6 +35,10 @@ def acc_and_f1_macro(preds, labels):
     }
 
 
+# the fields of the features padded to max_seq_length: input ids, attention mask and token type ids
+SEQUENCE_FIELDS = (0, 1, 2)
+
+
 def glue_compute_metrics(task_name, preds, labels):
     assert len(preds) == len(labels)
     if task_name == "prop":
@@ -0,0 +1,24 @@
+# coding=utf-8
+import os
+import sys
+
+import pytest
+from transformers import BertTokenizer
+
+# the top-level modules and the packages are imported from the root of the repository, as by the scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# a WordPiece vocabulary where every letter of a word is a sub-token
+LETTERS_VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "a", "b", "c", "##a", "##b", "##c"]
+
+
+@pytest.fixture(scope="session")
+def vocab_file(tmp_path_factory):
+    vocab_file = tmp_path_factory.mktemp("vocab") / "vocab.txt"
+    vocab_file.write_text("\n".join(LETTERS_VOCAB) + "\n")
+    return str(vocab_file)
+
+
+@pytest.fixture
+def tokenizer(vocab_file):
+    return BertTokenizer(vocab_file, do_lower_case=True)
@@ -0,0 +1,97 @@
+# coding=utf-8
+import os
+
+import pytest
+
+from article_corpus import ArticleCorpus, build_corpus, default_corpus_dir, is_corpus_stale
+
+ARTICLES = {
+    "111": "Plain ASCII article.\nSecond line.\n",
+    "222": "Café “quoted” — naïve résumé.\n",
+    "333": "",
+}
+
+
+def write_articles(folder, articles, extension=".txt"):
+    os.makedirs(str(folder), exist_ok=True)
+    for article_id, text in articles.items():
+        with open(os.path.join(str(folder), "article" + article_id + extension), "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = tmp_path / "articles"
+    write_articles(folder, ARTICLES)
+    return str(folder)
+
+
+def test_round_trip(folder):
+    with ArticleCorpus.from_folder(folder) as corpus:
+        assert corpus.ids == sorted(ARTICLES)
+        assert dict(corpus) == ARTICLES
+        assert list(corpus.texts()) == [ARTICLES[article_id] for article_id in corpus.ids]
+        assert corpus.texts()[1:] == [ARTICLES["222"], ARTICLES["333"]]
+        assert "222" in corpus and "444" not in corpus
+    assert os.path.isdir(default_corpus_dir(folder))
+
+
+@pytest.mark.parametrize("article_id", sorted(ARTICLES))
+def test_slice_matches_str_slicing(folder, article_id):
+    text = ARTICLES[article_id]
+    with ArticleCorpus.from_folder(folder) as corpus:
+        for start in range(-2, len(text) + 2):
+            for end in range(start - 1, len(text) + 3):
+                assert corpus.slice(article_id, start, end) == text[start:end]
+
+
+def test_corpus_is_reused_until_the_folder_changes(folder):
+    corpus_dir = default_corpus_dir(folder)
+    ArticleCorpus.from_folder(folder).close()
+    assert not is_corpus_stale(folder, corpus_dir)
+
+    # a replaced file is detected even if it is older than the corpus and has the same size
+    path = os.path.join(folder, "article111.txt")
+    stat = os.stat(path)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(ARTICLES["111"].upper())
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - 10 ** 9))
+    assert is_corpus_stale(folder, corpus_dir)
+    with ArticleCorpus.from_folder(folder) as corpus:
+        assert corpus["111"] == ARTICLES["111"].upper()
+    assert not is_corpus_stale(folder, corpus_dir)
+
+    write_articles(folder, {"444": "New article.\n"})
+    assert is_corpus_stale(folder, corpus_dir)
+    with ArticleCorpus.from_folder(folder) as corpus:
+        assert corpus.ids == ["111", "222", "333", "444"]
+
+    os.remove(os.path.join(folder, "article222.txt"))
+    with ArticleCorpus.from_folder(folder) as corpus:
+        assert corpus.ids == ["111", "333", "444"]
+
+
+def test_corpus_without_manifest_is_stale(folder, tmp_path):
+    corpus_dir = str(tmp_path / "corpus")
+    build_corpus(folder, corpus_dir)
+    assert not is_corpus_stale(folder, corpus_dir)
+    os.remove(os.path.join(corpus_dir, "manifest.json"))
+    assert is_corpus_stale(folder, corpus_dir)
+
+
+def test_file_patterns_have_their_own_corpus(folder):
+    write_articles(folder, {"900": "Labels, not an article.\n"}, extension=".labels")
+    with ArticleCorpus.from_folder(folder) as articles:
+        with ArticleCorpus.from_folder(folder, file_pattern="*.labels") as labels:
+            assert articles.ids == sorted(ARTICLES)
+            assert labels.ids == ["900"]
+    assert default_corpus_dir(folder, "*.txt") != default_corpus_dir(folder, "*.labels")
+    assert not is_corpus_stale(folder, default_corpus_dir(folder, "*.txt"), "*.txt")
+    assert is_corpus_stale(folder, default_corpus_dir(folder, "*.txt"), "*.labels")
+
+
+def test_empty_folder(tmp_path):
+    folder = str(tmp_path / "empty")
+    os.makedirs(folder)
+    with ArticleCorpus.from_folder(folder) as corpus:
+        assert len(corpus) == 0 and list(corpus.texts()) == []
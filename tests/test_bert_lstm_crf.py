@@ -0,0 +1,144 @@
+# coding=utf-8
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from span_identification.ner.bert_lstm_crf import BertLstmCrf
+
+NUM_LABELS = 3
+VOCAB_SIZE = 20
+HIDDEN_SIZE = 8
+
+
+class BaseModel(nn.Module):
+    def __init__(self):
+        super(BaseModel, self).__init__()
+        self.embeddings = nn.Embedding(VOCAB_SIZE, HIDDEN_SIZE)
+
+    def forward(self, input_ids, attention_mask=None, token_type_ids=None):
+        return (torch.tanh(self.embeddings(input_ids)),)
+
+
+class TokenClassifier(nn.Module):
+    """ Stands for a transformers token classification model: (loss, logits) outputs and a `base_model`. """
+
+    def __init__(self):
+        super(TokenClassifier, self).__init__()
+        self.base_model = BaseModel()
+        self.classifier = nn.Linear(HIDDEN_SIZE, NUM_LABELS)
+
+    def forward(self, input_ids, attention_mask=None, token_type_ids=None, labels=None):
+        return (torch.zeros(()), self.classifier(self.base_model(input_ids, attention_mask)[0]))
+
+
+def make_model(rnn_layers=0, seed=0):
+    torch.manual_seed(seed)
+    return BertLstmCrf(TokenClassifier(), num_labels=NUM_LABELS, embedding_dim=HIDDEN_SIZE, hidden_dim=4,
+                       rnn_layers=rnn_layers, rnn_dropout=0.0, output_dropout=0.0).eval()
+
+
+def make_batch(seed=0):
+    """ Rows of different lengths between [CLS] and [SEP], where the words have one to three sub-tokens. """
+    rng = np.random.RandomState(seed)
+    lengths = [10, 7, 3, 4, 10]
+    input_ids = torch.tensor(rng.randint(1, VOCAB_SIZE, size=(len(lengths), 10)))
+    attention_mask = torch.zeros(len(lengths), 10, dtype=torch.long)
+    labels = torch.full((len(lengths), 10), -100, dtype=torch.long)
+    for i, length in enumerate(lengths):
+        attention_mask[i, :length] = 1
+        position = 1
+        while position < length - 1:
+            labels[i, position] = int(rng.randint(NUM_LABELS))
+            position += int(rng.randint(1, 4))
+    return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+
+def reference_clear_subtokens(logits, labels, mask):
+    """ The row by row selection of the first sub-tokens that `clear_subtokens` replaces. """
+    clear_labels, clear_logits, clear_mask = torch.zeros_like(labels), torch.zeros_like(logits), torch.zeros_like(mask)
+    for i in range(len(labels)):
+        words = labels[i] != -100
+        clear_labels[i][:int(words.sum())] = labels[i][words]
+        clear_logits[i][:int(words.sum())] = logits[i][words]
+        clear_mask[i][:int(words.sum())] = 1
+    return clear_logits, clear_labels, clear_mask
+
+
+def test_clear_subtokens_matches_the_row_loop():
+    model = make_model()
+    batch = make_batch()
+    logits = torch.randn(5, 10, NUM_LABELS)
+    for cleared, expected in zip(model.clear_subtokens(logits, batch["labels"], batch["attention_mask"]),
+                                 reference_clear_subtokens(logits, batch["labels"], batch["attention_mask"])):
+        assert torch.equal(cleared, expected)
+
+
+def test_restore_subtokens_inverts_clear_subtokens():
+    model = make_model()
+    batch = make_batch(1)
+    logits = torch.randn(5, 10, NUM_LABELS)
+    clear_logits, _, _ = model.clear_subtokens(logits, batch["labels"], batch["attention_mask"])
+    restored = model.restore_subtokens(clear_logits, batch["labels"])
+    words = (batch["labels"] != -100).unsqueeze(-1)
+    assert torch.equal(restored, torch.where(words, logits, torch.zeros_like(logits)))
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_forward_matches_the_row_by_row_computation(seed):
+    model = make_model(seed=seed)
+    batch = make_batch(seed)
+    with torch.no_grad():
+        loss, logits, tags = model(**batch)
+        expected_logits = model.bert_encoder(**batch)[1]
+        clear_logits, clear_labels, clear_mask = reference_clear_subtokens(expected_logits, batch["labels"],
+                                                                           batch["attention_mask"])
+        expected_loss = -model.crf(clear_logits, clear_labels, clear_mask)
+        best_paths = model.crf.viterbi_tags(clear_logits, clear_mask, top_k=2)
+
+    assert torch.equal(logits, expected_logits)
+    assert loss.item() == pytest.approx(expected_loss.item(), rel=1e-5)
+    labels = batch["labels"].numpy()
+    for row_tags, row_labels, paths in zip(tags, labels, best_paths):
+        # the tags go back to the positions of the words, the other positions are 0
+        assert list(row_tags[row_labels != -100]) == paths[0][0]
+        assert not row_tags[row_labels == -100].any()
+
+
+
+def test_lstm_reads_the_encoder_hidden_states_of_the_words():
+    model = make_model(rnn_layers=2)
+    batch = make_batch(3)
+    with torch.no_grad():
+        torch.manual_seed(0)
+        _, logits, _ = model(**batch)
+        torch.manual_seed(0)
+        hidden = model.rand_init_hidden(len(batch["input_ids"]))
+        sequence_output = model.bert_encoder.base_model(batch["input_ids"], batch["attention_mask"])[0]
+
+        for i, row_labels in enumerate(batch["labels"]):
+            words = row_labels != -100
+            row_hidden = (hidden[0][:, i:i + 1].contiguous(), hidden[1][:, i:i + 1].contiguous())
+            row_output, _ = model.lstm(sequence_output[i][words].unsqueeze(0), row_hidden)
+            assert torch.allclose(logits[i][words], model.liner(row_output[0]), atol=1e-6)
+            assert not logits[i][~words].any()
+
+
+def test_span_probabilities_only_on_request():
+    model = make_model()
+    batch = make_batch(2)
+    with torch.no_grad():
+        outputs = model(**batch)
+        with_probabilities = model(return_probabilities=True, **batch)
+        clear_logits, _, clear_mask = model.clear_subtokens(outputs[1], batch["labels"], batch["attention_mask"])
+        marginals = model.crf.marginals(clear_logits, clear_mask)
+
+    assert len(outputs) == 3 and len(with_probabilities) == 4
+    assert outputs[0].item() == with_probabilities[0].item()
+    assert [list(tags) for tags in outputs[2]] == [list(tags) for tags in with_probabilities[2]]
+    # the probability of a word to be in a span is 1 - the marginal of O, at the position of the word
+    probabilities = np.array(with_probabilities[3])
+    words = batch["labels"].numpy() != -100
+    expected = (1 - marginals[:, :, 0])[clear_mask.bool()].numpy()
+    assert np.allclose(probabilities[words], expected, atol=1e-6)
+    assert not probabilities[~words].any()
@@ -0,0 +1,80 @@
+# coding=utf-8
+import itertools
+
+import pytest
+import torch
+
+from span_identification.ner.conditional_random_field import ConditionalRandomField, allowed_transitions
+
+NUM_TAGS = 3
+
+
+def make_crf(seed=0, constrained=True):
+    torch.manual_seed(seed)
+    constraints = allowed_transitions("BIO", dict(enumerate(["O", "B", "I"]))) if constrained else None
+    return ConditionalRandomField(NUM_TAGS, constraints, include_start_end_transitions=True)
+
+
+def make_batch(lengths, max_length=None, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    max_length = max_length if max_length else max(lengths)
+    logits = torch.randn(len(lengths), max_length, NUM_TAGS, generator=generator) * 3
+    mask = (torch.arange(max_length).unsqueeze(0) < torch.tensor(lengths).unsqueeze(1)).long()
+    return logits, mask
+
+
+@pytest.mark.parametrize("constrained", [True, False])
+@pytest.mark.parametrize("seed", range(5))
+def test_batched_viterbi_matches_per_sequence_decoding(constrained, seed):
+    crf = make_crf(seed, constrained)
+    logits, mask = make_batch([1, 7, 3, 7, 2, 5], max_length=9, seed=seed)
+    batched = crf.viterbi_tags(logits, mask, top_k=1)
+    # top_k > 1 decodes every sequence on its own with viterbi_decode
+    per_sequence = crf.viterbi_tags(logits, mask, top_k=2)
+    for (batched_path,), top_paths, length in zip(batched, per_sequence, mask.sum(1).tolist()):
+        assert len(batched_path[0]) == length
+        assert batched_path[0] == top_paths[0][0]
+        assert batched_path[1] == pytest.approx(top_paths[0][1], abs=1e-3)
+    assert crf.viterbi_tags(logits, mask) == [paths[0] for paths in batched]
+
+
+def test_batched_viterbi_respects_the_constraints():
+    crf = make_crf()
+    logits, mask = make_batch([8] * 16, seed=1)
+    for path, _ in crf.viterbi_tags(logits, mask):
+        # O -> I is not allowed, and no span starts with I
+        assert path[0] != 2
+        assert all(not (previous == 0 and tag == 2) for previous, tag in zip(path, path[1:]))
+
+
+def test_decoding_follows_the_updated_transitions():
+    crf = make_crf()
+    logits, mask = make_batch([6, 4], seed=2)
+    crf.viterbi_tags(logits, mask)
+    with torch.no_grad():
+        # in place, as an optimizer step: the cached transition matrix must be rebuilt
+        crf.transitions.mul_(-5)
+        crf.start_transitions.add_(3)
+    fresh = make_crf()
+    fresh.load_state_dict(crf.state_dict())
+    assert crf.viterbi_tags(logits, mask) == fresh.viterbi_tags(logits, mask)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_marginals_match_the_enumeration_of_the_paths(seed):
+    crf = make_crf(seed)
+    with torch.no_grad():
+        crf.transitions.normal_(generator=torch.Generator().manual_seed(seed))
+    logits, mask = make_batch([4, 1, 3], max_length=5, seed=seed)
+    marginals = crf.marginals(logits, mask)
+
+    for row_logits, row_mask, row_marginals in zip(logits, mask, marginals):
+        length = int(row_mask.sum())
+        expected = torch.zeros(length, NUM_TAGS)
+        for path in itertools.product(range(NUM_TAGS), repeat=length):
+            tags = torch.tensor([path])
+            # the log-likelihood of one path is its score minus the log partition function
+            expected[torch.arange(length), tags[0]] += crf(row_logits[None, :length], tags, row_mask[None, :length]).exp()
+        assert torch.allclose(row_marginals[:length], expected, atol=1e-5)
+        assert torch.allclose(row_marginals[:length].sum(-1), torch.ones(length), atol=1e-5)
+        assert not row_marginals[length:].any()
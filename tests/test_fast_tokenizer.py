@@ -0,0 +1,64 @@
+# coding=utf-8
+import json
+
+import pytest
+from transformers import BertTokenizer, RobertaTokenizer
+from transformers.tokenization_gpt2 import bytes_to_unicode
+
+from span_identification.ner.utils_ner import InputExample, convert_examples_to_features, get_fast_tokenizer
+
+pytest.importorskip("tokenizers")
+
+LABELS = ["O", "B-PROP", "I-PROP"]
+WORDS = ["Hello", "world", "!", "café", "naïve", "“quoted”", "don't", "ab", "ABC", "x\u200by", " padded ", "2020"]
+
+
+@pytest.fixture(scope="module")
+def roberta_tokenizer(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("roberta")
+    vocab = ["<s>", "<pad>", "</s>", "<unk>"] + list(bytes_to_unicode().values()) + ["Ġa", "ab", "Ġab", "ll", "llo"]
+    merges = ["Ġ a", "a b", "Ġa b", "l l", "ll o"]
+    (folder / "vocab.json").write_text(json.dumps({token: i for i, token in enumerate(vocab)}))
+    (folder / "merges.txt").write_text("#version: 0.2\n" + "\n".join(merges) + "\n")
+    return RobertaTokenizer(str(folder / "vocab.json"), str(folder / "merges.txt"))
+
+
+@pytest.fixture(scope="module")
+def bert_tokenizer(tmp_path_factory):
+    vocab_file = tmp_path_factory.mktemp("bert") / "vocab.txt"
+    pieces = sorted(set("".join(WORDS).lower()))
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + pieces + ["##" + piece for piece in pieces] + ["hello"]
+    vocab_file.write_text("\n".join(vocab) + "\n", encoding="utf-8")
+    return BertTokenizer(str(vocab_file), do_lower_case=True)
+
+
+def make_examples(num_examples=20):
+    return [InputExample("test-%d" % i, [WORDS[(i + j) % len(WORDS)] for j in range(i % 9 + 1)],
+                         [LABELS[(i * j) % 3] for j in range(i % 9 + 1)])
+            for i in range(num_examples)]
+
+
+def features_as_lists(features):
+    return [(f.input_ids, f.input_mask, f.segment_ids, f.label_ids, f.segments) for f in features]
+
+
+@pytest.mark.parametrize("name", ["bert_tokenizer", "roberta_tokenizer"])
+@pytest.mark.parametrize("window_stride", [0, 4])
+def test_fast_tokenizer_gives_the_same_features(request, name, window_stride):
+    tokenizer = request.getfixturevalue(name)
+    fast_tokenizer = get_fast_tokenizer(tokenizer)
+    assert fast_tokenizer is not None
+    kwargs = dict(cls_token=tokenizer.cls_token, sep_token=tokenizer.sep_token,
+                  sep_token_extra=name == "roberta_tokenizer",
+                  pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+                  pad_token_label_id=-100, window_stride=window_stride)
+    examples = make_examples()
+    slow = convert_examples_to_features(examples, LABELS, 12, tokenizer, **kwargs)
+    fast = convert_examples_to_features(examples, LABELS, 12, tokenizer, fast_tokenizer=fast_tokenizer, **kwargs)
+    assert features_as_lists(fast) == features_as_lists(slow)
+
+
+def test_no_fast_tokenizer_with_added_tokens(vocab_file):
+    tokenizer = BertTokenizer(vocab_file, do_lower_case=True)
+    tokenizer.add_tokens(["abcabc"])
+    assert get_fast_tokenizer(tokenizer) is None
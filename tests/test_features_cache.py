@@ -0,0 +1,76 @@
+# coding=utf-8
+import os
+
+import numpy as np
+
+from span_identification.ner import utils_ner
+from span_identification.ner.utils_ner import (InputExample, convert_examples_to_features, features_cache_key,
+                                               features_to_arrays, file_fingerprint, load_features_cache,
+                                               save_features_cache, tokenizer_fingerprint)
+
+LABELS = ["O", "B-PROP", "I-PROP"]
+
+
+def write_bio_file(path, lines):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("".join(line + "\n" for line in lines))
+
+
+def test_round_trip(tokenizer, tmp_path):
+    examples = [InputExample("train-1", ["abc", "a", "cab"], ["O", "B-PROP", "I-PROP"]),
+                InputExample("train-2", ["b"] * 12, ["O"] * 12)]
+    features = convert_examples_to_features(examples, LABELS, 8, tokenizer, pad_token_label_id=-100,
+                                            window_stride=3)
+    arrays, segments = features_to_arrays(features)
+    cache_dir = str(tmp_path / "cached_features")
+    save_features_cache(cache_dir, arrays, segments)
+    loaded_arrays, loaded_segments = load_features_cache(cache_dir)
+
+    assert loaded_segments == [f.segments for f in features]
+    assert sorted(loaded_arrays) == sorted(arrays)
+    for name, array in arrays.items():
+        assert loaded_arrays[name].dtype == array.dtype
+        np.testing.assert_array_equal(loaded_arrays[name], [getattr(f, name) for f in features])
+    # copy-on-write: writing to the loaded arrays leaves the cache unchanged
+    loaded_arrays["input_ids"][0, 0] = -1
+    assert load_features_cache(cache_dir)[0]["input_ids"][0, 0] == arrays["input_ids"][0, 0]
+    assert not [name for name in os.listdir(str(tmp_path)) if ".tmp" in name]
+
+
+def test_cache_key(tokenizer, tmp_path):
+    path = str(tmp_path / "train.txt")
+    write_bio_file(path, ["abc\tO", "a\tB-PROP", "", "b\tO"])
+    key = features_cache_key(path, tokenizer, LABELS, 128, "bert", window_stride=0)
+
+    assert features_cache_key(path, tokenizer, LABELS, 128, "bert", window_stride=0) == key
+    assert features_cache_key(path, tokenizer, LABELS, 64, "bert", window_stride=0) != key
+    assert features_cache_key(path, tokenizer, LABELS, 128, "roberta", window_stride=0) != key
+    assert features_cache_key(path, tokenizer, LABELS, 128, "bert", window_stride=32) != key
+    assert features_cache_key(path, tokenizer, LABELS[:2], 128, "bert", window_stride=0) != key
+
+    stat = os.stat(path)
+    write_bio_file(path, ["abc\tO", "a\tI-PROP", "", "b\tO"])
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert features_cache_key(path, tokenizer, LABELS, 128, "bert", window_stride=0) != key
+
+    tokenizer.add_tokens(["abcabc"])
+    assert features_cache_key(path, tokenizer, LABELS, 128, "bert", window_stride=0) != key
+
+
+def test_fingerprints_are_computed_once(tokenizer, tmp_path, monkeypatch):
+    path = str(tmp_path / "dev.txt")
+    write_bio_file(path, ["abc\tO"])
+    fingerprint = tokenizer_fingerprint(tokenizer)
+    file_hash = file_fingerprint(path)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("hashed again")
+
+    monkeypatch.setattr(utils_ner, "_hash_tokenizer", fail)
+    monkeypatch.setattr(utils_ner, "open", fail)
+    assert tokenizer_fingerprint(tokenizer) == fingerprint
+    assert file_fingerprint(path) == file_hash
+
+
+def test_same_vocabulary_same_fingerprint(tokenizer, vocab_file):
+    assert tokenizer_fingerprint(tokenizer) == tokenizer_fingerprint(type(tokenizer)(vocab_file, do_lower_case=True))
@@ -0,0 +1,76 @@
+# coding=utf-8
+import pytest
+from nltk.stem import PorterStemmer
+
+from technique_classification import normalization
+from technique_classification.normalization import SpanNormalizer
+
+SPANS = ["Crooked Hillary", "the CROOKED elections", "a total disaster", "Disasters everywhere"]
+
+
+def word_tokenize(text):
+    return text.split()
+
+
+@pytest.fixture(autouse=True)
+def whitespace_tokenizer(monkeypatch):
+    """ The memos do not depend on the tokenizer, and the punkt models of nltk may not be downloaded. """
+    monkeypatch.setattr(normalization, "word_tokenize", word_tokenize)
+
+
+def count_stems(normalizer):
+    """ Counts the calls to the stemmer of `normalizer`. """
+    calls = []
+    stem = normalizer.stemmer.stem
+    normalizer.stemmer.stem = lambda word: calls.append(word) or stem(word)
+    return calls
+
+
+def test_stemmed():
+    stemmer = PorterStemmer()
+    normalizer = SpanNormalizer()
+    for span in SPANS:
+        assert normalizer.stemmed(span) == " ".join(stemmer.stem(word) for word in word_tokenize(span.lower()))
+    assert normalizer.stem_spans(SPANS) == [normalizer.stemmed(span) for span in SPANS]
+
+
+def test_words_and_spans_are_normalized_once():
+    normalizer = SpanNormalizer()
+    calls = count_stems(normalizer)
+    normalizer.stem_spans(SPANS + SPANS)
+    words = [word for span in SPANS for word in word_tokenize(span.lower())]
+    assert sorted(calls) == sorted(set(words))
+
+
+def test_least_recently_used_spans_are_evicted():
+    normalizer = SpanNormalizer(max_spans=2)
+    for span in [SPANS[0], SPANS[1], SPANS[0], SPANS[2]]:
+        normalizer.stemmed(span)
+    assert list(normalizer.spans["stemmed"]) == [SPANS[0], SPANS[2]]
+    # the stems of the words are kept
+    assert "elections" in normalizer.word_stems
+
+
+def test_cache_round_trip(tmp_path):
+    cache_file = str(tmp_path / "spans.pkl")
+    normalizer = SpanNormalizer(cache_file=cache_file)
+    expected = normalizer.stem_spans(SPANS)
+    normalizer.save()
+
+    loaded = SpanNormalizer(cache_file=cache_file)
+    calls = count_stems(loaded)
+    assert loaded.stem_spans(SPANS) == expected
+    assert calls == []
+    assert loaded.word_stems == normalizer.word_stems
+
+
+def test_cache_of_another_version_is_ignored(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / "spans.pkl")
+    normalizer = SpanNormalizer()
+    normalizer.stem_spans(SPANS)
+    normalizer.save(cache_file)
+
+    monkeypatch.setattr(normalization, "CACHE_VERSION", normalization.CACHE_VERSION + 1)
+    loaded = SpanNormalizer(cache_file=cache_file)
+    assert loaded.word_stems == {}
+    assert all(len(spans) == 0 for spans in loaded.spans.values())
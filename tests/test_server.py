@@ -0,0 +1,70 @@
+# coding=utf-8
+import asyncio
+import json
+
+import pytest
+
+from inference.server import InferenceServer
+
+
+def predict(texts):
+    """ One span over every text. """
+    return [[(0, len(text), "Loaded_Language")] for text in texts]
+
+
+async def request(server, method, path, body=b""):
+    """ Sends one HTTP request to `server` and returns the status and the decoded JSON response. """
+    reader, writer = await asyncio.open_connection(*server.server.sockets[0].getsockname()[:2])
+    writer.write(("%s %s HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % (method, path, len(body))).encode("latin-1")
+                 + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, data = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(data.decode("utf-8"))
+
+
+def serve(*requests):
+    """ Runs the `requests` (method, path, body) concurrently on a server on a free port. """
+    async def run():
+        server = InferenceServer(predict, port=0, max_batch_size=2)
+        await server.start()
+        try:
+            return await asyncio.gather(*[request(server, *r) for r in requests])
+        finally:
+            await server.stop()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("body", [
+    b'{"texts": "one article"}',
+    b'{"texts": {"text": "one article"}}',
+    b'{"texts": ["one article", 2]}',
+    b'{"text": null}',
+    b'{"article": "one article"}',
+    b'["one article"]',
+    b'"one article"',
+    b'{"text": ',
+    b'\xff',
+])
+def test_invalid_requests_are_rejected(body):
+    (status, response), = serve(("POST", "/predict", body))
+    assert status == 400
+    assert "error" in response
+
+
+def test_routes():
+    responses = serve(("GET", "/health"), ("GET", "/predict"), ("POST", "/unknown", b"{}"))
+    assert [status for status, _ in responses] == [200, 405, 404]
+    assert responses[0][1] == {"status": "ok"}
+
+
+def test_predictions():
+    texts = ["a short one", "a much longer article", "", "mid length"]
+    responses = serve(("POST", "/predict", json.dumps({"text": "one article"}).encode("utf-8")),
+                      ("POST", "/predict", json.dumps({"texts": texts}).encode("utf-8")),
+                      ("POST", "/predict", b'{"texts": []}'))
+    assert responses[0] == (200, {"spans": [{"start": 0, "end": 11, "technique": "Loaded_Language"}]})
+    assert responses[1][0] == 200
+    assert [result["spans"][0]["end"] for result in responses[1][1]["results"]] == [len(text) for text in texts]
+    assert responses[2] == (200, {"results": []})
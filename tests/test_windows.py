@@ -0,0 +1,75 @@
+# coding=utf-8
+import random
+
+import pytest
+
+from span_identification.ner.utils_ner import (InputExample, convert_examples_to_features, merge_window_predictions,
+                                               split_into_windows)
+
+PAD_TOKEN_LABEL_ID = -100
+
+
+def make_examples(num_examples, max_words, seed=0):
+    """ Examples whose label is the index of the word, so the merged predictions show which words came back. """
+    rng = random.Random(seed)
+    examples = []
+    for i in range(num_examples):
+        words = ["".join(rng.choice("abc") for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, max_words))]
+        examples.append(InputExample("test-%d" % i, words, ["L%d" % j for j in range(len(words))]))
+    return examples
+
+
+def predict_labels(features, label_list):
+    """ The "predictions" of the sequences: the labels of their first sub-tokens, in order. """
+    return [[label_list[label_id] for label_id in f.label_ids if label_id != PAD_TOKEN_LABEL_ID] for f in features]
+
+
+def merged_labels(examples, tokenizer, max_seq_length, rule="center", **kwargs):
+    label_list = ["L%d" % j for j in range(max(len(example.words) for example in examples))]
+    features = convert_examples_to_features(examples, label_list, max_seq_length, tokenizer,
+                                            pad_token_label_id=PAD_TOKEN_LABEL_ID, **kwargs)
+    for f in features:
+        assert len(f.input_ids) == max_seq_length
+    return merge_window_predictions([f.segments for f in features], predict_labels(features, label_list),
+                                    len(examples), rule)
+
+
+@pytest.mark.parametrize("rule", ["first", "last", "center"])
+@pytest.mark.parametrize("window_stride", [3, 8, 14])
+@pytest.mark.parametrize("pack", [False, True])
+def test_windows_merge_to_unwindowed_predictions(tokenizer, rule, window_stride, pack):
+    examples = make_examples(30, 20)
+    unwindowed = merged_labels(examples, tokenizer, 128)
+    assert unwindowed == [example.labels for example in examples]
+    windowed = merged_labels(examples, tokenizer, 16, rule, window_stride=window_stride, pack=pack)
+    assert windowed == unwindowed
+
+
+def test_truncation_without_windows_keeps_the_words_starting_before_the_cut(tokenizer):
+    examples = make_examples(10, 20, seed=1)
+    merged = merged_labels(examples, tokenizer, 16)
+    for example, labels in zip(examples, merged):
+        word_starts = [sum(len(word) for word in example.words[:j]) for j in range(len(example.words))]
+        assert labels == example.labels[:len(labels)]
+        assert len(labels) == sum(start < 14 for start in word_starts)
+
+
+def test_split_into_windows():
+    assert split_into_windows([1, 1, 1, 1, 1, 1], 4, 2) == [(0, 4), (2, 6)]
+    assert split_into_windows([1, 1, 1, 1, 1, 1], 4, 4) == [(0, 4), (4, 6)]
+    # a word longer than a window makes a window of its own
+    assert split_into_windows([1, 6, 1], 4, 2) == [(0, 1), (1, 2), (2, 3)]
+
+
+@pytest.mark.parametrize("rule,expected", [("first", list("aaaabb")),
+                                           ("last", list("aabbbb")),
+                                           ("center", list("aaabbb"))])
+def test_overlap_rules(rule, expected):
+    segments = [[(0, 0, 4)], [(0, 2, 6)]]
+    predictions = [list("aaaa"), list("bbbb")]
+    assert merge_window_predictions(segments, predictions, 1, rule) == [expected]
+
+
+def test_unknown_overlap_rule():
+    with pytest.raises(ValueError):
+        merge_window_predictions([], [], 0, "middle")